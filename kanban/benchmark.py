@@ -0,0 +1,233 @@
+"""Benchmarks for kanban.
+
+Run them with C{make benchmark} or C{python -m kanban.benchmark}.  Each
+timing benchmark is run several times and the median time is compared with
+a budget.  Memory benchmarks compare the number of bytes used with a
+budget.  The exit status is non-zero if a benchmark is over its budget.
+"""
+
+from datetime import datetime
+import gc
+import os
+import subprocess
+import sys
+from tempfile import mkstemp
+from time import time
+from types import ModuleType
+
+
+# The number of times each benchmark is run.
+RUNS = 5
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that are slow to import and are only needed to talk to Launchpad
+# or keep a snapshot.
+LAUNCHPAD_MODULES = ["launchpadlib", "lazr.restfulclient", "httplib2",
+                     "sqlite3", "kanban.launchpad", "kanban.snapshot"]
+
+# Commands that should start quickly, with their budgets in seconds and the
+# modules they mustn't import.  Their output is discarded.  Timings vary a
+# lot from one machine to another, and importing everything up front only
+# makes help about 1.7 times slower, so the budgets only catch large
+# slowdowns.  The modules each command imports are checked too, which
+# catches a return to importing everything up front on any machine.
+STARTUP_BENCHMARKS = [
+    ("help", ["help"], 0.5, LAUNCHPAD_MODULES + ["jinja2", "kanban.html"]),
+    ("generate-roadmap",
+     ["generate-roadmap", os.path.join(ROOT, "roadmap.json")], 0.85,
+     LAUNCHPAD_MODULES)]
+
+# A script that runs bin/kanban and writes the names of the modules it
+# imported to a file.
+IMPORTS_SCRIPT = """\
+import sys
+sys.argv = %(argv)r
+try:
+    execfile(sys.argv[0], {"__name__": "__main__"})
+finally:
+    with open(%(path)r, "w") as stream:
+        stream.write("\\n".join(sys.modules))
+"""
+
+# The number of bugs created by the memory benchmark, and the number of
+# bytes each one may use on average.
+BUG_COUNT = 10000
+BUG_FOOTPRINT_BUDGET = 900
+
+# The size of the board rendered by the rendering benchmark, and the time
+# it may take to render it, in seconds.
+RENDER_BUG_COUNT = 2000
+RENDER_STORY_COUNT = 500
+RENDER_BUDGET = 0.25
+
+
+def get_median(values):
+    """Get the median of a C{list} of values."""
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_command(arguments, runs=RUNS):
+    """Get the median time it takes to run C{bin/kanban} with C{arguments}.
+
+    Each run starts a new Python process, so imports are included.
+    """
+    command = [sys.executable, os.path.join(ROOT, "bin", "kanban")]
+    command.extend(arguments)
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for i in range(runs):
+            start = time()
+            subprocess.check_call(command, stdout=devnull, cwd=ROOT)
+            times.append(time() - start)
+    return get_median(times)
+
+
+def get_imported_modules(arguments):
+    """Get the names of the modules imported by C{bin/kanban arguments}."""
+    descriptor, path = mkstemp()
+    os.close(descriptor)
+    try:
+        argv = [os.path.join(ROOT, "bin", "kanban")] + arguments
+        script = IMPORTS_SCRIPT % {"argv": argv, "path": path}
+        with open(os.devnull, "w") as devnull:
+            subprocess.call([sys.executable, "-c", script], stdout=devnull,
+                            cwd=ROOT)
+        with open(path) as stream:
+            return set(stream.read().splitlines())
+    finally:
+        os.unlink(path)
+
+
+def _copy(value):
+    """Get a new copy of the string C{value}.
+
+    Strings decoded from Launchpad's JSON responses or loaded from a
+    snapshot are separate objects, even when they're equal.
+    """
+    return (value + u".")[:-1]
+
+
+def create_bugs(count, story_count=50):
+    """Create C{count} L{Bug}s like the ones fetched from Launchpad.
+
+    @param story_count: Optionally, the number of different C{story-} tags
+        to use.  Defaults to C{50}.
+    """
+    from kanban.board import (
+        Bug, IMPORTANCE_ORDER, IN_PROGRESS, FIX_COMMITTED, NEEDS_REVIEW,
+        TRIAGED)
+    from kanban.snapshot import UTC
+
+    statuses = [TRIAGED, IN_PROGRESS, FIX_COMMITTED]
+    now = datetime.now(UTC)
+    bugs = []
+    for i in range(count):
+        status = statuses[i % len(statuses)]
+        merge_proposal = merge_proposal_status = None
+        if status != TRIAGED:
+            merge_proposal = u"https://code.launchpad.net/~dev/+merge/%d" % i
+            merge_proposal_status = _copy(NEEDS_REVIEW)
+        tags = [_copy(u"story-%d" % (i % story_count))]
+        if i % 2:
+            tags.append(_copy(u"verified"))
+        bugs.append(Bug(
+            i, _copy(u"landscape"),
+            _copy(IMPORTANCE_ORDER[i % len(IMPORTANCE_ORDER)]),
+            _copy(status), u"Bug %d has a fairly typical title" % i,
+            _copy(u"developer-%d" % (i % 20)), now,
+            u"lp:~developer-%d/landscape/branch-%d" % (i % 20, i),
+            merge_proposal, merge_proposal_status, now, tags))
+    return bugs
+
+
+def get_footprint(objects):
+    """Get the number of bytes used by C{objects} and what they refer to.
+
+    Objects referred to more than once are only counted once.  Classes and
+    modules aren't counted.
+    """
+    seen = set()
+    pending = list(objects)
+    size = 0
+    while pending:
+        value = pending.pop()
+        if id(value) in seen or isinstance(value, (type, ModuleType)):
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+        pending.extend(gc.get_referents(value))
+    return size
+
+
+def get_bug_footprint(count=BUG_COUNT):
+    """Get the average number of bytes used by each of C{count} L{Bug}s."""
+    bugs = create_bugs(count)
+    return get_footprint(bugs) / float(count)
+
+
+def time_render(bug_count=RENDER_BUG_COUNT, story_count=RENDER_STORY_COUNT,
+                runs=RUNS):
+    """
+    Get the median time it takes to render a milestone board with
+    C{bug_count} L{Bug}s spread over C{story_count} stories.
+    """
+    from kanban.board import MilestoneBoard
+    from kanban.html import generate_html
+
+    board = MilestoneBoard("landscape", "12.04")
+    for bug in create_bugs(bug_count, story_count):
+        board.add(bug)
+    times = []
+    for i in range(runs):
+        start = time()
+        generate_html(board)
+        times.append(time() - start)
+    return get_median(times)
+
+
+def main(argv):
+    """Run the benchmarks and report the results on stdout.
+
+    @return: C{0} if every benchmark is within budget, otherwise C{1}.
+    """
+    status = 0
+    for name, arguments, budget, heavy_modules in STARTUP_BENCHMARKS:
+        median = time_command(arguments)
+        modules = get_imported_modules(arguments)
+        imported = [module for module in heavy_modules if module in modules]
+        problems = []
+        if median > budget:
+            problems.append("OVER BUDGET")
+        if imported:
+            problems.append("IMPORTS %s" % ", ".join(imported))
+        result = "ok"
+        if problems:
+            result = ", ".join(problems)
+            status = 1
+        print "%-24s %7.0f ms (budget %4.0f ms) %s" % (
+            name, median * 1000, budget * 1000, result)
+    median = time_render()
+    result = "ok"
+    if median > RENDER_BUDGET:
+        result = "OVER BUDGET"
+        status = 1
+    print "%-24s %7.0f ms (budget %4.0f ms) %s" % (
+        "render %d stories" % RENDER_STORY_COUNT, median * 1000,
+        RENDER_BUDGET * 1000, result)
+    footprint = get_bug_footprint()
+    result = "ok"
+    if footprint > BUG_FOOTPRINT_BUDGET:
+        result = "OVER BUDGET"
+        status = 1
+    print "%-24s %7.0f B  (budget %4.0f B)  %s" % (
+        "bug footprint", footprint, BUG_FOOTPRINT_BUDGET, result)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,3 +1,6 @@
+from array import array
+
+
 # Bug status states
 NEW = "New"
 INCOMPLETE = "Incomplete"
@@ -20,6 +23,8 @@ LOW = "Low"
 WISHLIST = "Wishlist"
 UNDECIDED = "Undecided"
 IMPORTANCE_ORDER = [CRITICAL, HIGH, MEDIUM, LOW, WISHLIST, UNDECIDED]
+IMPORTANCE_RANKS = dict((importance, rank)
+                        for rank, importance in enumerate(IMPORTANCE_ORDER))
 
 
 # Merge proposal states
@@ -33,25 +38,164 @@ QUEUED = "Queued"
 SUPERSEDED = "Superseded"
 
 
+# Canonical copies of strings that many bugs share, like statuses, project
+# names and tags.  Bugs fetched from Launchpad or loaded from a snapshot
+# each come with fresh copies of these strings, so interning them means a
+# large board only keeps one copy of each.
+_interned = dict((value, value) for value in [
+    NEW, INCOMPLETE, OPINION, INVALID, WONT_FIX, EXPIRED, CONFIRMED,
+    TRIAGED, IN_PROGRESS, FIX_COMMITTED, FIX_RELEASED, CRITICAL, HIGH,
+    MEDIUM, LOW, WISHLIST, UNDECIDED, WORK_IN_PROGRESS, NEEDS_REVIEW,
+    APPROVED, REJECTED, MERGED, MERGED_FAILED, QUEUED, SUPERSEDED])
+
+
+# The categories bugs are organized into, named after the attributes of
+# BugCollectionMixin that hold them.
+QUEUED_CATEGORY = "queued"
+IN_PROGRESS_CATEGORY = "in_progress"
+NEEDS_REVIEW_CATEGORY = "needs_review"
+NEEDS_TESTING_CATEGORY = "needs_testing"
+NEEDS_RELEASE_CATEGORY = "needs_release"
+RELEASED_CATEGORY = "released"
+CATEGORIES = [QUEUED_CATEGORY, IN_PROGRESS_CATEGORY, NEEDS_REVIEW_CATEGORY,
+              NEEDS_TESTING_CATEGORY, NEEDS_RELEASE_CATEGORY,
+              RELEASED_CATEGORY]
+CATEGORY_POSITIONS = dict(
+    (category, position) for position, category in enumerate(CATEGORIES))
+
+# A decision table mapping (status, has merge proposal, merge proposal
+# status, verified) keys to categories.  Entries are added the first time a
+# bug with a new combination of values is categorized.
+_categories = {}
+
+
+def _intern(value):
+    """Get the canonical copy of C{value}, which may be C{None}."""
+    if value is None:
+        return None
+    return _interned.setdefault(value, value)
+
+
 class Bug(object):
-    """A bug represents a work item."""
+    """A bug represents a work item.
+
+    Boards can hold tens of thousands of bugs, so bugs are kept compact:
+    they don't have an instance C{__dict__}, repeated strings like statuses
+    and importances are interned and tags are stored in a C{tuple}.
+
+    A bug's category is worked out the first time it's needed and then
+    kept, so bugs shouldn't be changed once they've been added to a board.
+    """
+
+    __slots__ = ["id", "project", "importance", "status", "title",
+                 "assignee", "in_progress_date", "branch", "merge_proposal",
+                 "_merge_proposal_status", "merge_proposal_creation_date",
+                 "tags", "_category", "_importance_rank"]
 
     def __init__(self, id, project, importance, status, title, assignee=None,
                  in_progress_date=None, branch=None, merge_proposal=None,
                  merge_proposal_status=None, merge_proposal_creation_date=None,
                  tags=None):
         self.id = id
-        self.project = project
-        self.importance = importance
-        self.status = status
+        self.project = _intern(project)
+        self.importance = _intern(importance)
+        self.status = _intern(status)
         self.title = title
-        self.assignee = assignee
+        self.assignee = _intern(assignee)
         self.in_progress_date = in_progress_date
         self.branch = branch
         self.merge_proposal = merge_proposal
         self.merge_proposal_status = merge_proposal_status
         self.merge_proposal_creation_date = merge_proposal_creation_date
-        self.tags = tags if tags else []
+        self.tags = tuple(_intern(tag) for tag in tags) if tags else ()
+        self._category = None
+        # Unknown importances are sorted after all the others.
+        self._importance_rank = IMPORTANCE_RANKS.get(importance,
+                                                     len(IMPORTANCE_ORDER))
+
+    @property
+    def merge_proposal_status(self):
+        """The status of this bug's merge proposal, or C{None}."""
+        return self._merge_proposal_status
+
+    @merge_proposal_status.setter
+    def merge_proposal_status(self, status):
+        # Merge proposal details are filled in after a bug is created, so
+        # they're interned when they're set.
+        self._merge_proposal_status = _intern(status)
+
+    def __eq__(self, other):
+        """Bugs are equal if they have the same ID."""
+        if not isinstance(other, Bug):
+            return NotImplemented
+        return self.id == other.id
+
+    def __ne__(self, other):
+        if not isinstance(other, Bug):
+            return NotImplemented
+        return self.id != other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __lt__(self, other):
+        """Bugs are ordered like L{compare_bugs} orders them."""
+        if not isinstance(other, Bug):
+            return NotImplemented
+        if self._importance_rank != other._importance_rank:
+            return self._importance_rank < other._importance_rank
+        return self.id < other.id
+
+    def depends_on_merge_proposal(self):
+        """
+        Determine if this bug's category depends on its branch and merge
+        proposal details.
+
+        Only bugs that are L{FIX_RELEASED}, or L{FIX_COMMITTED} with the
+        C{verified} tag, are categorized the same way whatever their merge
+        proposal is.  Any other bug with a merge proposal that needs review
+        is in the 'Needs review' category, for example, even if it's still
+        queued.
+        """
+        return not (self.released() or self.needs_release())
+
+    def get_category(self):
+        """Get the name of the category this bug belongs in.
+
+        The category is looked up in a decision table keyed on the values
+        the category depends on, so the predicates like L{in_progress} are
+        only evaluated once for each combination of values.  Bugs in the
+        'Needs testing' category are put in the 'Needs release' category by
+        collections that don't use it.
+
+        @return: One of L{QUEUED_CATEGORY}, L{IN_PROGRESS_CATEGORY},
+            L{NEEDS_REVIEW_CATEGORY}, L{NEEDS_TESTING_CATEGORY},
+            L{NEEDS_RELEASE_CATEGORY} or L{RELEASED_CATEGORY}.
+        """
+        category = self._category
+        if category is None:
+            key = (self.status, bool(self.merge_proposal),
+                   self.merge_proposal_status, "verified" in self.tags)
+            category = _categories.get(key)
+            if category is None:
+                category = _categories[key] = self._categorize()
+            self._category = category
+        return category
+
+    def _categorize(self):
+        """Work out the category this bug belongs in."""
+        if self.released():
+            return RELEASED_CATEGORY
+        elif self.needs_release():
+            return NEEDS_RELEASE_CATEGORY
+        elif self.needs_testing():
+            return NEEDS_TESTING_CATEGORY
+        elif self.needs_review():
+            return NEEDS_REVIEW_CATEGORY
+        elif self.in_progress():
+            return IN_PROGRESS_CATEGORY
+        else:
+            return QUEUED_CATEGORY
 
     def get_story_tags(self):
         """Get the tags that start with C{story-}."""
@@ -109,59 +253,158 @@ class Bug(object):
         return self.status in [FIX_RELEASED]
 
 
+class BugView(object):
+    """A read-only, sorted sequence of some of the L{Bug}s in a collection.
+
+    A view only refers to the collection's shared array of L{Bug}s and to
+    the array of positions it keeps sorted, so views are cheap to create and
+    always include the L{Bug}s added since they were created.
+
+    @param all_bugs: The C{list} of L{Bug}s shared by the collection.
+    @param indexes: The positions in C{all_bugs} of the L{Bug}s in this
+        view, sorted in L{compare_bugs} order.
+    """
+
+    __slots__ = ["_all_bugs", "_indexes"]
+
+    def __init__(self, all_bugs, indexes):
+        self._all_bugs = all_bugs
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __iter__(self):
+        all_bugs = self._all_bugs
+        for index in self._indexes:
+            yield all_bugs[index]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self._all_bugs[index] for index in self._indexes[position]]
+        return self._all_bugs[self._indexes[position]]
+
+    def __eq__(self, other):
+        """Views are equal to other views and lists with the same L{Bug}s."""
+        if not isinstance(other, (BugView, list)):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "<BugView %r>" % (list(self),)
+
+
+def _view(category, doc):
+    """
+    Create a property for a C{BugCollectionMixin} view of sorted L{Bug}s.
+
+    @param category: The name of the category in the view, or C{None} for a
+        view of every L{Bug} in the collection.
+    @param doc: The docstring for the property.
+    """
+    def get_view(self):
+        if category is None:
+            indexes = self._indexes
+        else:
+            indexes = self._category_indexes[CATEGORY_POSITIONS[category]]
+        return BugView(self._all_bugs, indexes)
+
+    return property(get_view, doc=doc)
+
+
+def get_bug_sort_key(bug):
+    """Get a key that sorts L{Bug}s in L{compare_bugs} order."""
+    return bug._importance_rank, bug.id
+
+
 def compare_bugs(a, b):
     """Compare two L{Bug}s.
 
     Bugs with a higher importance are sorted first.  Bugs with the same
-    importance are ordered by bug number.
+    importance are ordered by bug number.  L{get_bug_sort_key} gives the same
+    order without the cost of a comparison function.
     """
-    a_importance = IMPORTANCE_ORDER.index(a.importance)
-    b_importance = IMPORTANCE_ORDER.index(b.importance)
-    if a_importance < b_importance:
-        return -1
-    elif a_importance > b_importance:
-        return 1
-    else:
-        return cmp(a.id, b.id)
+    return cmp(get_bug_sort_key(a), get_bug_sort_key(b))
 
 
 class BugCollectionMixin(object):
     """A named collecton of L{Bug}s organized into categories.
 
+    L{Bug}s can be added in any order.  Each L{Bug} is kept once, in an
+    array that can be shared with other collections, and the collection only
+    records the positions of its L{Bug}s in that array: one array of
+    positions for all of them and one for each category, each kept in
+    L{compare_bugs} order as L{Bug}s are added.  The C{bugs} property and
+    the properties for each category are L{BugView}s of those arrays.
+
     @param name: The name of the L{Bug} collection.
     @param include_needs_testing: Optionally, a flag indicating whether or not
         to use the 'Needs testing' category.  Defaults to C{False}.
+    @param all_bugs: Optionally, the C{list} of L{Bug}s to keep L{Bug}s in.
+        Defaults to a new one.
     """
 
-    def __init__(self, name, include_needs_testing=None):
+    def __init__(self, name, include_needs_testing=None, all_bugs=None):
         self.name = name
         self.include_needs_testing = include_needs_testing
-        self.bugs = []
-        self.queued = []
-        self.in_progress = []
-        self.needs_review = []
-        self.needs_testing = []
-        self.needs_release = []
-        self.released = []
+        self._all_bugs = all_bugs if all_bugs is not None else []
+        self._indexes = array("I")
+        self._category_indexes = [array("I") for category in CATEGORIES]
 
     def add(self, bug):
         """Add C{bug} to this collection."""
-        self.bugs.append(bug)
-        if bug.released():
-            self.released.append(bug)
-        elif bug.needs_release():
-            self.needs_release.append(bug)
-        elif bug.needs_testing():
-            if self.include_needs_testing:
-                self.needs_testing.append(bug)
+        self._all_bugs.append(bug)
+        self._add_index(len(self._all_bugs) - 1)
+
+    def _add_index(self, index):
+        """Add the L{Bug} at C{index} in the shared array to this collection.
+        """
+        bug = self._all_bugs[index]
+        category = bug.get_category()
+        if (category == NEEDS_TESTING_CATEGORY
+            and not self.include_needs_testing):
+            category = NEEDS_RELEASE_CATEGORY
+        self._insert_index(self._indexes, index)
+        self._insert_index(
+            self._category_indexes[CATEGORY_POSITIONS[category]], index)
+
+    def _insert_index(self, indexes, index):
+        """
+        Insert C{index} into the sorted array C{indexes}, keeping the
+        L{Bug}s they refer to in L{compare_bugs} order.
+        """
+        all_bugs = self._all_bugs
+        bug = all_bugs[index]
+        low, high = 0, len(indexes)
+        # Bugs often arrive in order, so try the end of the array first.
+        if high == 0 or not bug < all_bugs[indexes[-1]]:
+            indexes.append(index)
+            return
+        while low < high:
+            middle = (low + high) // 2
+            if bug < all_bugs[indexes[middle]]:
+                high = middle
             else:
-                self.needs_release.append(bug)
-        elif bug.needs_review():
-            self.needs_review.append(bug)
-        elif bug.in_progress():
-            self.in_progress.append(bug)
-        else:
-            self.queued.append(bug)
+                low = middle + 1
+        indexes.insert(low, index)
+
+    bugs = _view(None, "All the L{Bug}s in this collection.")
+    queued = _view(QUEUED_CATEGORY, "The L{Bug}s that are queued.")
+    in_progress = _view(IN_PROGRESS_CATEGORY,
+                        "The L{Bug}s that are in progress.")
+    needs_review = _view(NEEDS_REVIEW_CATEGORY,
+                         "The L{Bug}s that need review.")
+    needs_testing = _view(NEEDS_TESTING_CATEGORY,
+                          "The L{Bug}s that need testing.")
+    needs_release = _view(NEEDS_RELEASE_CATEGORY,
+                          "The L{Bug}s that need to be released.")
+    released = _view(RELEASED_CATEGORY, "The L{Bug}s that are released.")
 
 
 class Story(BugCollectionMixin):
@@ -170,6 +413,9 @@ class Story(BugCollectionMixin):
     @param name: The name of this story.
     @param include_needs_testing: Optionally, a flag indicating whether or not
         to use the 'Needs testing' category.  Defaults to C{False}.
+    @param all_bugs: Optionally, the C{list} of L{Bug}s to keep L{Bug}s in,
+        usually shared with the collection this story is part of.  Defaults
+        to a new one.
     """
 
 
@@ -185,18 +431,27 @@ class StoryCollectionMixin(BugCollectionMixin):
         super(StoryCollectionMixin, self).__init__(
             name, include_needs_testing=include_needs_testing)
         self._stories = {}
+        self._sorted_stories = None
 
     @property
     def stories(self):
-        """A C{list} of L{Story}s, sorted alphabetically."""
-        return sorted(self._stories.values(), compare_stories)
+        """A C{list} of L{Story}s, sorted alphabetically.
+
+        The list is only sorted again after a new L{Story} is created, so
+        templates can use it as often as they like.  It must not be
+        modified.
+        """
+        if self._sorted_stories is None:
+            self._sorted_stories = sorted(self._stories.itervalues(),
+                                          key=get_story_sort_key)
+        return self._sorted_stories
 
     def add(self, bug):
         """Add C{bug} to this milestone."""
         super(StoryCollectionMixin, self).add(bug)
-        stories = self._get_stories(bug)
-        for story in stories:
-            story.add(bug)
+        index = len(self._all_bugs) - 1
+        for story in self._get_stories(bug):
+            story._add_index(index)
 
     def _get_stories(self, bug):
         """Get the L{Story}s that C{bug} is associated with."""
@@ -209,13 +464,17 @@ class StoryCollectionMixin(BugCollectionMixin):
                     stories.append(story)
                 else:
                     story = Story(
-                        name, include_needs_testing=self.include_needs_testing)
+                        name, include_needs_testing=self.include_needs_testing,
+                        all_bugs=self._all_bugs)
                     self._stories[name] = story
+                    self._sorted_stories = None
                     stories.append(story)
         else:
             if None not in self._stories:
                 self._stories[None] = Story(
-                    None, include_needs_testing=self.include_needs_testing)
+                    None, include_needs_testing=self.include_needs_testing,
+                    all_bugs=self._all_bugs)
+                self._sorted_stories = None
             stories.append(self._stories[None])
 
         return stories
@@ -226,18 +485,26 @@ class MilestoneBoard(StoryCollectionMixin):
     A milestone board contains a collection of L{Bug}s targetted to a
     milestone in Launchpad.
 
+    A board can also show several milestones at once, for example to give
+    an overview of a release that spans milestones in several projects.
+
     @param project_name: The name of the project or project group in Launchpad
         this milestone is part of.
     @param milestone_name: The name of this milestone.
     @param include_needs_testing: Optionally, a flag indicating whether or not
         to use the 'Needs testing' category.  Defaults to C{False}.
+    @param milestones: Optionally, a C{list} of C{(project_name,
+        milestone_name)} pairs for every milestone on this board.  Defaults
+        to just the milestone named by C{project_name} and
+        C{milestone_name}.
     """
 
     def __init__(self, project_name, milestone_name,
-                 include_needs_testing=None):
+                 include_needs_testing=None, milestones=None):
         super(MilestoneBoard, self).__init__(
             milestone_name, include_needs_testing=include_needs_testing)
         self.project_name = project_name
+        self.milestones = milestones or [(project_name, milestone_name)]
 
 
 class PersonBoard(StoryCollectionMixin):
@@ -251,14 +518,15 @@ class PersonBoard(StoryCollectionMixin):
     """
 
 
+def get_story_sort_key(story):
+    """Get a key that sorts L{Story}s in L{compare_stories} order."""
+    return story.name is None, story.name
+
+
 def compare_stories(a, b):
     """Compare two L{Story}s.
 
     L{Story}s are sorted alphabetically.  The default story is always sorted
     last.
     """
-    if a.name is None:
-        return 1
-    if b.name is None:
-        return -1
-    return cmp(a.name, b.name)
+    return cmp(get_story_sort_key(a), get_story_sort_key(b))
@@ -1,17 +1,12 @@
+# Commands are loaded every time kanban runs, even just to show help, so
+# modules that are slow to import, like launchpadlib, jinja2 and
+# kanban.launchpad, are only imported by the commands that use them.
+
 import os
 
 from bzrlib.commands import Command
 from bzrlib.option import Option
 
-from launchpadlib.launchpad import Launchpad
-
-from kanban.board import MilestoneBoard, PersonBoard, compare_bugs
-from kanban.html import generate_html, generate_roadmap_html
-from kanban.launchpad import (
-    get_config_path, get_cache_path, get_launchpad, get_milestone_bugs,
-    get_person_assigned_bugs, SERVICE_ROOT)
-from kanban.roadmap import load_roadmap
-
 
 class cmd_launchpad_login(Command):
     """Create an OAuth token to use with Launchpad commands.
@@ -24,6 +19,10 @@ class cmd_launchpad_login(Command):
     """
 
     def run(self):
+        from launchpadlib.launchpad import Launchpad
+        from kanban.launchpad import (
+            get_cache_path, get_config_path, SERVICE_ROOT)
+
         credentials_path = os.path.join(get_config_path(), "credentials.txt")
         if os.path.exists(credentials_path):
             raise RuntimeError(
@@ -47,51 +46,288 @@ class HTMLOutputMixin(Command):
                 stream.write(html.encode('utf-8'))
 
 
-class cmd_generate_person_kanban(HTMLOutputMixin, Command):
+class LaunchpadMixin(Command):
+
+    _stats = None
+    _recording = None
+    _record_path = None
+
+    def get_launchpad(self, stats=None, record=None, replay=None,
+                      replay_latency=None):
+        """Get a C{Launchpad} instance.
+
+        @param stats: Optionally, a flag indicating whether or not to record
+            statistics about HTTP requests.  They're written to stderr by
+            L{report_stats}.
+        @param record: Optionally, the path of a fixture file to record HTTP
+            exchanges in.  It's written by L{save_recording}.
+        @param replay: Optionally, the path of a fixture file to replay HTTP
+            exchanges from, instead of contacting Launchpad.
+        @param replay_latency: Optionally, the number of milliseconds to
+            wait before each replayed response.
+        """
+        from kanban.launchpad import HttpRecording, RequestStats, get_launchpad
+
+        self._stats = RequestStats() if stats else None
+        self._recording = HttpRecording() if record else None
+        self._record_path = record
+        if replay:
+            replay = HttpRecording.load(replay)
+        return get_launchpad(stats=self._stats, record=self._recording,
+                             replay=replay,
+                             latency=(replay_latency or 0) / 1000.0)
+
+    def report_stats(self):
+        """Write statistics about HTTP requests to stderr, if enabled."""
+        if self._stats is not None:
+            from kanban.launchpad import trace
+            trace(self._stats.format())
+
+    def save_recording(self):
+        """Write recorded HTTP exchanges to a fixture file, if enabled."""
+        if self._recording is not None:
+            self._recording.save(self._record_path)
+
+
+class SnapshotMixin(Command):
+
+    def check_offline_options(self, **options):
+        """
+        Check that options that only make sense when contacting Launchpad
+        aren't used with --offline.
+
+        @param options: The values of the options to check, keyed by option
+            name.
+        @raise RuntimeError: Raised if any of C{options} is set.
+        """
+        names = sorted("--" + name.replace("_", "-")
+                       for name, value in options.iteritems() if value)
+        if names:
+            raise RuntimeError(
+                "--offline can't be used with %s." % ", ".join(names))
+
+    def get_offline_bugs(self, store, scope):
+        """Get the L{Bug}s kept in the local snapshot for C{scope}.
+
+        @raise RuntimeError: Raised if a snapshot isn't available.
+        """
+        if store.get_last_sync(scope) is None:
+            raise RuntimeError(
+                "A local snapshot isn't available.  Run this command without "
+                "--offline first.")
+        return store.get_bugs(scope)
+
+    def get_offline_milestones_bugs(self, store, milestones):
+        """
+        Get the L{Bug}s kept in the local snapshot for several milestones.
+        Bugs targetted to more than one of them are only included once.
+
+        @param milestones: A C{list} of C{(project_name, milestone_name)}
+            pairs.
+        @raise RuntimeError: Raised if a snapshot isn't available for one of
+            the milestones.
+        """
+        from kanban.snapshot import get_milestone_scope
+
+        bugs = []
+        bug_ids = set()
+        for project_name, milestone_name in milestones:
+            scope = get_milestone_scope(project_name, milestone_name)
+            for bug in self.get_offline_bugs(store, scope):
+                if bug.id not in bug_ids:
+                    bug_ids.add(bug.id)
+                    bugs.append(bug)
+        return bugs
+
+
+class cmd_generate_person_kanban(HTMLOutputMixin, LaunchpadMixin,
+                                 SnapshotMixin, Command):
     """Print an HTML kanban board for a person or team to the screen.
 
     The page shows bugs that are either open or were fixed within the last
     month, that are directly assigned to the named person.  If a team is
-    provided the bugs shown will be for members of that team.
+    provided the bugs shown will be for members of that team.  Use
+    --closed-within to change how long fixed bugs are shown for.
+
+    Bugs fetched from Launchpad are kept in a local snapshot in
+    ~/.cache/kanban.  Use --offline to build the board from the snapshot
+    without contacting Launchpad.
+
+    Use --record to save every request made to Launchpad in a fixture file,
+    and --replay to build the board from such a file later, for example to
+    benchmark changes without depending on the network.
     """
 
     takes_args = ["person_name"]
     takes_options = [Option("output-file", short_name="o", type=str,
                             help="Write HTML to file."),
                      Option("include-needs-testing",
-                            help="Include the 'Needs testing' category.")]
+                            help="Include the 'Needs testing' category."),
+                     Option("jobs", short_name="j", type=int,
+                            help="Number of bug tasks to fetch concurrently."),
+                     Option("batch-size", type=int,
+                            help="Number of bug tasks to fetch in each page "
+                                 "of search results."),
+                     Option("fan-out", type=int,
+                            help="Number of team participants to search "
+                                 "concurrently."),
+                     Option("closed-within", type=int,
+                            help="Show bugs released within this many "
+                                 "days."),
+                     Option("offline",
+                            help="Use the local snapshot instead of "
+                                 "Launchpad."),
+                     Option("stats",
+                            help="Print statistics about requests made to "
+                                 "Launchpad on stderr."),
+                     Option("record", type=str,
+                            help="Record requests made to Launchpad in a "
+                                 "fixture file."),
+                     Option("replay", type=str,
+                            help="Replay requests from a fixture file "
+                                 "instead of contacting Launchpad."),
+                     Option("replay-latency", type=int,
+                            help="Milliseconds to wait before each replayed "
+                                 "response.")]
     _see_also = ["launchpad-login"]
 
-    def run(self, person_name, output_file=None, include_needs_testing=None):
-        launchpad = get_launchpad()
+    def run(self, person_name, output_file=None, include_needs_testing=None,
+            jobs=None, batch_size=None, fan_out=None, closed_within=None,
+            offline=None, stats=None, record=None, replay=None,
+            replay_latency=None):
+        from kanban.board import PersonBoard
+        from kanban.html import generate_html
+        from kanban.launchpad import get_snapshot_store, sync_person_bugs
+        from kanban.snapshot import get_person_scope
+
         person_board = PersonBoard(person_name,
                                    include_needs_testing=include_needs_testing)
-        bugs = get_person_assigned_bugs(launchpad, person_name)
-        for bug in sorted(bugs, compare_bugs):
+        store = get_snapshot_store()
+        try:
+            if offline:
+                self.check_offline_options(record=record, replay=replay)
+                bugs = self.get_offline_bugs(
+                    store, get_person_scope(person_name))
+            else:
+                launchpad = self.get_launchpad(stats, record, replay,
+                                               replay_latency)
+                bugs = sync_person_bugs(launchpad, store, person_name,
+                                        jobs=jobs, fan_out=fan_out,
+                                        closed_within=closed_within,
+                                        batch_size=batch_size)
+        finally:
+            store.close()
+        for bug in bugs:
             person_board.add(bug)
         self.write_output(generate_html(person_board), output_file)
+        self.report_stats()
+        self.save_recording()
+
+
+class cmd_generate_milestone_kanban(HTMLOutputMixin, LaunchpadMixin,
+                                    SnapshotMixin, Command):
+    """Print an HTML kanban board for a milestone to the screen.
+
+    Bugs fetched from Launchpad are kept in a local snapshot in
+    ~/.cache/kanban.  Use --incremental to only fetch bugs that changed
+    since the last run.  Bugs moved to a different milestone, and changes
+    to merge proposals that don't change the bug itself, like a review
+    being approved, are only noticed by a full run.  Use --offline to
+    build the board from the snapshot without contacting Launchpad.
 
+    More milestones can be shown on the same board by naming them after the
+    first one, either as 'project:milestone' or, for milestones of the same
+    project, just as 'milestone'.  Bugs from every milestone are fetched
+    together and bugs targetted to several of them are only shown once.
 
-class cmd_generate_milestone_kanban(HTMLOutputMixin, Command):
-    """Print an HTML kanban board for a milestone to the screen."""
+    Launchpad returns the bugs in a project group milestone as one long
+    list of results.  Use --shard to search the milestone of each project
+    in the group separately, so that the searches can run concurrently.
 
-    takes_args = ["project_group", "milestone_name"]
+    Use --record to save every request made to Launchpad in a fixture file,
+    and --replay to build the board from such a file later, for example to
+    benchmark changes without depending on the network.
+    """
+
+    takes_args = ["project_group", "milestone_name", "milestones*"]
     takes_options = [Option("output-file", short_name="o", type=str,
                             help="Write HTML to file."),
                      Option("include-needs-testing",
-                            help="Include the 'Needs testing' category.")]
+                            help="Include the 'Needs testing' category."),
+                     Option("jobs", short_name="j", type=int,
+                            help="Number of bug tasks to fetch concurrently."),
+                     Option("batch-size", type=int,
+                            help="Number of bug tasks to fetch in each page "
+                                 "of search results."),
+                     Option("incremental",
+                            help="Only fetch bugs changed since the last "
+                                 "run."),
+                     Option("shard",
+                            help="Search each project in a project group "
+                                 "separately."),
+                     Option("offline",
+                            help="Use the local snapshot instead of "
+                                 "Launchpad."),
+                     Option("stats",
+                            help="Print statistics about requests made to "
+                                 "Launchpad on stderr."),
+                     Option("record", type=str,
+                            help="Record requests made to Launchpad in a "
+                                 "fixture file."),
+                     Option("replay", type=str,
+                            help="Replay requests from a fixture file "
+                                 "instead of contacting Launchpad."),
+                     Option("replay-latency", type=int,
+                            help="Milliseconds to wait before each replayed "
+                                 "response.")]
     _see_also = ["launchpad-login"]
 
-    def run(self, project_group, milestone_name, output_file=None,
-            include_needs_testing=None):
-        launchpad = get_launchpad()
+    def run(self, project_group, milestone_name, milestones_list=None,
+            output_file=None, include_needs_testing=None, jobs=None,
+            batch_size=None, incremental=None, shard=None, offline=None,
+            stats=None, record=None, replay=None, replay_latency=None):
+        from kanban.board import MilestoneBoard
+        from kanban.html import generate_html
+        from kanban.launchpad import (
+            get_snapshot_store, sync_milestone_bugs, sync_milestones_bugs)
+
+        milestones = [(project_group, milestone_name)]
+        for name in milestones_list or []:
+            if ":" in name:
+                milestones.append(tuple(name.split(":", 1)))
+            else:
+                milestones.append((project_group, name))
         milestone_board = MilestoneBoard(
             project_group, milestone_name,
-            include_needs_testing=include_needs_testing)
-        bugs = get_milestone_bugs(launchpad, project_group, milestone_name)
-        for bug in sorted(bugs, compare_bugs):
-            milestone_board.add(bug)
+            include_needs_testing=include_needs_testing,
+            milestones=milestones)
+        store = get_snapshot_store()
+        try:
+            if offline:
+                self.check_offline_options(incremental=incremental,
+                                           record=record, replay=replay)
+                bugs = self.get_offline_milestones_bugs(store, milestones)
+            else:
+                launchpad = self.get_launchpad(stats, record, replay,
+                                               replay_latency)
+                if len(milestones) == 1:
+                    bugs = sync_milestone_bugs(
+                        launchpad, store, project_group, milestone_name,
+                        jobs=jobs, incremental=incremental,
+                        batch_size=batch_size, shard=shard)
+                else:
+                    bugs = sync_milestones_bugs(
+                        launchpad, store, milestones, jobs=jobs,
+                        incremental=incremental, batch_size=batch_size,
+                        shard=shard)
+            # Bugs are added to the board as they stream in from Launchpad.
+            for bug in bugs:
+                milestone_board.add(bug)
+        finally:
+            store.close()
         self.write_output(generate_html(milestone_board), output_file)
+        self.report_stats()
+        self.save_recording()
 
 
 class cmd_generate_roadmap(HTMLOutputMixin, Command):
@@ -122,6 +358,9 @@ class cmd_generate_roadmap(HTMLOutputMixin, Command):
                             help="Write HTML to file.")]
 
     def run(self, roadmap_json_path, output_file=None):
+        from kanban.html import generate_roadmap_html
+        from kanban.roadmap import load_roadmap
+
         with open(roadmap_json_path, "r") as file:
             json = file.read()
         roadmap = load_roadmap(json)
@@ -51,11 +51,43 @@ class topic_tutorial(DocstringHelpTopic):
 
       $ bin/kanban generate-milestone-kanban storm 0.19 > kanban.html
 
+    Milestone bugs are kept in a local snapshot in $HOME/.cache/kanban.  Once
+    a board has been generated, later runs can fetch only the bugs that
+    changed since the last run::
+
+      $ bin/kanban generate-milestone-kanban --incremental storm 0.19 \
+          > kanban.html
+
+    An incremental run doesn't notice bugs moved to another milestone, or
+    merge proposals that were reviewed or merged without the bug itself
+    changing, so bugs can stay in the 'In progress', 'Needs review' and
+    'Needs testing' columns for too long.  Run without --incremental now
+    and then to catch up.
+
+    Several milestones, even from different projects, can be shown on one
+    board.  Name the extra milestones after the first one, prefixed with
+    their project if it's a different one::
+
+      $ bin/kanban generate-milestone-kanban storm 0.19 0.20 \
+          storm-docs:0.19 > kanban.html
+
+    Milestones of large project groups can be fetched faster by searching
+    each project in the group separately::
+
+      $ bin/kanban generate-milestone-kanban --shard landscape 12.04 \
+          > kanban.html
+
     To see all bugs assigned to a particular person, including bugs 'Fix
     released' in the last month::
 
       $ bin/kanban generate-person-kanban mbp > kanban.html
 
+    Person boards are kept in the snapshot too.  To regenerate a board from
+    the snapshot without contacting Launchpad at all, for example after
+    changing a template::
+
+      $ bin/kanban generate-person-kanban --offline mbp > kanban.html
+
     About bug categories:
 
       The kanban board assumes a set of bug categories: queued, in progress,
@@ -1,6 +1,19 @@
+from base64 import b64decode, b64encode
+from collections import deque
 from datetime import datetime, timedelta
+from hashlib import sha1
+import heapq
+import json
+from math import ceil
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import os
 import sys
+from tempfile import mkstemp
+from threading import Condition, Lock, local
+from time import sleep, time
+from urllib import urlencode
+from urlparse import parse_qsl, urlparse, urlunparse
 
 # Uncomment this to see debug output showing the requests being made to
 # Launchpad.
@@ -8,17 +21,62 @@ import sys
 # import httplib2
 # httplib2.debuglevel = 1
 
+from httplib2 import Response
+from lazr.restfulclient._browser import MultipleRepresentationCache
 from lazr.restfulclient.errors import HTTPError
+from lazr.restfulclient.resource import Collection
+from wadllib.application import Resource as WadlResource
 
-from launchpadlib.credentials import Credentials
+from launchpadlib.credentials import AnonymousAccessToken, Credentials
 from launchpadlib.launchpad import Launchpad
 from launchpadlib.uris import LPNET_SERVICE_ROOT
 
-from kanban.board import Bug
+from kanban.board import Bug, IMPORTANCE_ORDER
+from kanban.snapshot import (
+    SnapshotStore, UTC, get_milestone_scope, get_person_scope)
 
 
 SERVICE_ROOT = LPNET_SERVICE_ROOT
 
+# The number of bug tasks hydrated concurrently when a caller doesn't ask for
+# a specific number.
+DEFAULT_JOBS = 4
+
+# The number of entries requested in each page of a collection after the
+# first one.  Launchpad allows up to 300.
+DEFAULT_BATCH_SIZE = 75
+
+# How long links to milestones are remembered in the snapshot store.
+RESOURCE_INDEX_TTL = timedelta(days=7)
+
+# How long the service root description is served from disk before
+# Launchpad is asked whether it has changed.
+SERVICE_ROOT_TTL = timedelta(days=1)
+
+# The number of requests per second made to Launchpad, and the number that
+# can be made at once after a quiet period.
+DEFAULT_REQUEST_RATE = 20
+DEFAULT_REQUEST_BURST = 10
+
+# The most requests that are ever in flight at once.
+MAX_CONCURRENCY = 16
+
+# Requests that take longer than this many seconds suggest Launchpad is
+# busy, so concurrency isn't increased.
+HEALTHY_LATENCY = 1.0
+
+# The number of times a GET that Launchpad throttled is retried.
+MAX_RETRIES = 5
+
+# How long branch and merge proposal details are remembered in the snapshot
+# store.  Merge proposal statuses change as branches are reviewed, so this is
+# kept short.
+BRANCH_CACHE_TTL = timedelta(hours=1)
+
+# The number of days 'Fix Released' bugs are shown on person boards after
+# they've been closed, when a caller doesn't ask for a specific number.
+DEFAULT_CLOSED_WITHIN = 31
+
 
 def is_unauthorized(error):
     """True if error is HTTP 401 Unauthorized."""
@@ -51,18 +109,594 @@ def get_cache_path():
     return _make_path(".cache/kanban")
 
 
-def get_launchpad():
+def get_snapshot_store():
+    """Get the L{SnapshotStore} kept in the cache directory."""
+    return SnapshotStore(os.path.join(get_cache_path(), "snapshot.db"))
+
+
+class HttpWrapper(object):
+    """Base class for objects that wrap the C{httplib2.Http} client used by
+    launchpadlib.
+
+    Attributes that aren't overridden are looked up on the wrapped client.
+
+    @param http: The C{httplib2.Http}-like object to wrap.
+    """
+
+    def __init__(self, http):
+        self._http = http
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        """Make an HTTP request with the wrapped client."""
+        return self._http.request(uri, method=method, body=body,
+                                  headers=headers, **kwargs)
+
+
+class PooledHttp(object):
+    """An C{httplib2.Http}-like object that can be used by several threads.
+
+    C{httplib2.Http} isn't thread-safe, so each thread is given its own
+    client the first time it makes a request.  Clients keep their
+    connections open between requests, so a pool of worker threads reuses
+    one connection each instead of making a new TLS handshake for every
+    request.  Attributes like C{cache} are looked up on the current
+    thread's client.
+
+    @param factory: A callable that creates a new C{httplib2.Http}-like
+        object.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = local()
+
+    def _get_http(self):
+        """Get the client for the current thread, creating it if needed."""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._local.http = self._factory()
+        return http
+
+    def __getattr__(self, name):
+        return getattr(self._get_http(), name)
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        """Make an HTTP request with the current thread's client."""
+        return self._get_http().request(uri, method=method, body=body,
+                                        headers=headers, **kwargs)
+
+
+class KanbanLaunchpad(Launchpad):
+    """A C{Launchpad} that can be used by several threads at once.
+
+    Its HTTP client is a L{PooledHttp}, wrapped with L{HttpWrapper}s.
+
+    @param wrappers: Optionally, a C{list} of callables that take an
+        C{httplib2.Http}-like object and return a wrapper for it.  They're
+        applied in order, so the last one sees requests first.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._wrappers = kwargs.pop("wrappers", None) or []
+        super(KanbanLaunchpad, self).__init__(*args, **kwargs)
+        # Throttled requests are retried by ScheduledHttp, which honours
+        # Retry-After and slows down every thread at once.  Retrying them
+        # in the browser too would multiply the two, so it's turned off
+        # once the service root has been loaded.
+        self._browser.max_retries = 0
+
+    def httpFactory(self, credentials, cache, timeout, proxy_info):
+        factory = super(KanbanLaunchpad, self).httpFactory
+
+        def create_http():
+            # The cache is told the media type of each request before it's
+            # made, so each thread needs its own.  They share the cache
+            # directory safely because entries are written atomically.
+            thread_cache = cache
+            if isinstance(cache, MultipleRepresentationCache):
+                thread_cache = MultipleRepresentationCache(cache._cache_dir)
+            return factory(credentials, thread_cache, timeout, proxy_info)
+
+        http = PooledHttp(create_http)
+        for wrapper in self._wrappers:
+            http = wrapper(http)
+        return http
+
+
+def get_call_site(uri):
+    """Get the name of the kind of request made to C{uri}.
+
+    @return: One of C{search}, C{bug}, C{branch}, C{merge proposal},
+        C{person}, C{milestone}, C{service} or C{other}.
+    """
+    parsed = urlparse(uri)
+    if "ws.op=searchTasks" in parsed.query:
+        return "search"
+    # The first segment is the web service version.
+    segments = [segment for segment in parsed.path.split("/") if segment][1:]
+    if not segments:
+        return "service"
+    if "+merge" in segments:
+        return "merge proposal"
+    if segments[0] == "bugs" or "+bug" in segments:
+        return "bug"
+    if segments[0].startswith("~"):
+        if len(segments) == 1 or segments[1:] == ["participants"]:
+            return "person"
+        if len(segments) >= 3:
+            return "branch"
+    if "+milestone" in segments:
+        return "milestone"
+    return "other"
+
+
+def get_percentile(values, percentile):
+    """Get the nearest-rank C{percentile} of a sorted C{list} of values."""
+    index = int(ceil(percentile / 100.0 * len(values))) - 1
+    return values[max(0, index)]
+
+
+class RequestStats(object):
+    """Statistics about HTTP requests made to Launchpad, by call site.
+
+    Requests may be recorded from several threads at once.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._requests = {}
+
+    def record(self, call_site, latency, size, from_cache):
+        """Record a request.
+
+        @param call_site: The kind of request, see L{get_call_site}.
+        @param latency: The number of seconds the request took.
+        @param size: The number of bytes in the response body.
+        @param from_cache: A flag indicating whether or not the response was
+            served from the local HTTP cache.
+        """
+        with self._lock:
+            self._requests.setdefault(call_site, []).append(
+                (latency, size, from_cache))
+
+    def get_summary(self, call_site=None):
+        """Summarize the requests made from C{call_site}.
+
+        @param call_site: Optionally, the call site to summarize.  Defaults
+            to summarizing every request.
+        @return: A C{dict} with C{requests}, C{hits}, C{misses}, C{bytes},
+            C{p50}, C{p90} and C{p99} keys.  C{bytes} only counts responses
+            that weren't served from the cache.  Latencies are in
+            seconds.
+        """
+        with self._lock:
+            if call_site is None:
+                requests = sum(self._requests.itervalues(), [])
+            else:
+                requests = list(self._requests.get(call_site, []))
+        latencies = sorted(latency for latency, size, hit in requests)
+        hits = len([hit for latency, size, hit in requests if hit])
+        summary = {"requests": len(requests), "hits": hits,
+                   "misses": len(requests) - hits,
+                   "bytes": sum(size for latency, size, hit in requests
+                                if not hit)}
+        for percentile in (50, 90, 99):
+            summary["p%d" % percentile] = (
+                get_percentile(latencies, percentile) if latencies else 0.0)
+        return summary
+
+    def format(self):
+        """Format these statistics as a table, one line per call site."""
+        row = "%-16s %8s %6s %6s %10s %8s %8s %8s"
+        lines = [row % ("Call site", "Requests", "Hits", "Misses", "Bytes",
+                        "p50 ms", "p90 ms", "p99 ms")]
+        with self._lock:
+            call_sites = sorted(self._requests)
+        for call_site in call_sites + [None]:
+            summary = self.get_summary(call_site)
+            lines.append(row % (
+                call_site or "total", summary["requests"], summary["hits"],
+                summary["misses"], summary["bytes"],
+                "%.0f" % (summary["p50"] * 1000),
+                "%.0f" % (summary["p90"] * 1000),
+                "%.0f" % (summary["p99"] * 1000)))
+        return "\n".join(lines)
+
+
+class InstrumentedHttp(HttpWrapper):
+    """An L{HttpWrapper} that records every request in L{RequestStats}.
+
+    @param http: The C{httplib2.Http}-like object to wrap.
+    @param stats: The L{RequestStats} to record requests in.
+    """
+
+    def __init__(self, http, stats):
+        super(InstrumentedHttp, self).__init__(http)
+        self._stats = stats
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        start = time()
+        response, content = super(InstrumentedHttp, self).request(
+            uri, method=method, body=body, headers=headers, **kwargs)
+        self._stats.record(get_call_site(uri), time() - start,
+                           len(content or ""),
+                           getattr(response, "fromcache", False))
+        return response, content
+
+
+class HttpRecording(object):
+    """A sequence of HTTP exchanges made with Launchpad.
+
+    Recordings are saved as JSON fixture files.  Exchanges are matched by
+    method, URI and body when they're replayed; headers are ignored because
+    OAuth signatures differ on every request.  Identical requests are
+    replayed in the order they were recorded, and the last response is
+    repeated once they run out.
+
+    Exchanges may be added and replayed from several threads at once.
+
+    @param exchanges: Optionally, a C{list} of exchanges, as created by
+        L{HttpRecording.add}.
+    """
+
+    def __init__(self, exchanges=None):
+        self._lock = Lock()
+        self.exchanges = exchanges or []
+        self._responses = None
+
+    @classmethod
+    def load(cls, path):
+        """Load a recording from the fixture file at C{path}."""
+        with open(path, "r") as stream:
+            return cls(json.load(stream)["exchanges"])
+
+    def save(self, path):
+        """Save this recording to a fixture file at C{path}."""
+        with self._lock:
+            exchanges = list(self.exchanges)
+        with open(path, "w") as stream:
+            json.dump({"exchanges": exchanges}, stream, indent=1,
+                      sort_keys=True)
+
+    def add(self, uri, method, body, response, content):
+        """Record an exchange.
+
+        @param uri: The URI requested.
+        @param method: The HTTP method used.
+        @param body: The request body, or C{None}.
+        @param response: The C{httplib2.Response} received.
+        @param content: The response body.
+        """
+        exchange = {"uri": uri, "method": method, "body": body,
+                    "status": response.status, "headers": dict(response)}
+        try:
+            exchange["content"] = content.decode("utf-8")
+        except UnicodeDecodeError:
+            exchange["content"] = b64encode(content)
+            exchange["encoding"] = "base64"
+        with self._lock:
+            self.exchanges.append(exchange)
+
+    def get(self, uri, method, body):
+        """Get the response recorded for a request.
+
+        @raise RuntimeError: Raised if a matching request wasn't recorded.
+        @return: A C{(response, content)} tuple, like C{httplib2.Http}
+            returns.
+        """
+        with self._lock:
+            if self._responses is None:
+                self._responses = {}
+                for exchange in self.exchanges:
+                    key = (exchange["method"], exchange["uri"],
+                           exchange["body"])
+                    self._responses.setdefault(key, []).append(exchange)
+            exchanges = self._responses.get((method, uri, body))
+            if not exchanges:
+                raise RuntimeError(
+                    "No response was recorded for %s %s" % (method, uri))
+            exchange = exchanges.pop(0) if len(exchanges) > 1 else exchanges[0]
+        response = Response(exchange["headers"])
+        response.status = exchange["status"]
+        if exchange.get("encoding") == "base64":
+            content = b64decode(exchange["content"])
+        else:
+            content = exchange["content"].encode("utf-8")
+        return response, content
+
+
+class RecordingHttp(HttpWrapper):
+    """An L{HttpWrapper} that adds every exchange to an L{HttpRecording}.
+
+    @param http: The C{httplib2.Http}-like object to wrap.
+    @param recording: The L{HttpRecording} to add exchanges to.
+    """
+
+    def __init__(self, http, recording):
+        super(RecordingHttp, self).__init__(http)
+        self._recording = recording
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        response, content = super(RecordingHttp, self).request(
+            uri, method=method, body=body, headers=headers, **kwargs)
+        self._recording.add(uri, method, body, response, content)
+        return response, content
+
+
+class ReplayingHttp(HttpWrapper):
+    """An L{HttpWrapper} that answers requests from an L{HttpRecording}.
+
+    The wrapped client is never used to make requests, so no network access
+    is needed.
+
+    @param http: The C{httplib2.Http}-like object to wrap.
+    @param recording: The L{HttpRecording} to replay.
+    @param latency: Optionally, the number of seconds to wait before each
+        response, to simulate a real network.
+    """
+
+    def __init__(self, http, recording, latency=0):
+        super(ReplayingHttp, self).__init__(http)
+        self._recording = recording
+        self._latency = latency
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        if self._latency:
+            sleep(self._latency)
+        return self._recording.get(uri, method, body)
+
+
+class ServiceRootCache(HttpWrapper):
+    """An L{HttpWrapper} that keeps the service root description on disk.
+
+    Every C{Launchpad} instance fetches the WADL description of the web
+    service and the JSON representation of the service root when it's
+    created.  Both are served from files in C{path} for C{ttl} after they
+    were last fetched, without contacting Launchpad.  After that requests
+    are made as usual, and the HTTP cache revalidates them with a
+    conditional request.
+
+    @param http: The C{httplib2.Http}-like object to wrap.
+    @param path: The directory to keep descriptions in.
+    @param ttl: Optionally, a C{timedelta} for how long descriptions are
+        used for.  Defaults to L{SERVICE_ROOT_TTL}.
+    """
+
+    def __init__(self, http, path, ttl=SERVICE_ROOT_TTL):
+        super(ServiceRootCache, self).__init__(http)
+        self._path = path
+        self._ttl = ttl
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        if method != "GET" or get_call_site(uri) != "service":
+            return super(ServiceRootCache, self).request(
+                uri, method=method, body=body, headers=headers, **kwargs)
+        media_type = (headers or {}).get("Accept", "")
+        name = sha1("%s %s" % (uri, media_type)).hexdigest()
+        path = os.path.join(self._path, name)
+        try:
+            age = time() - os.path.getmtime(path + ".json")
+        except OSError:
+            age = None
+        if age is not None and age < self._ttl.total_seconds():
+            try:
+                with open(path + ".json", "r") as stream:
+                    response = Response(json.load(stream))
+                with open(path + ".body", "rb") as stream:
+                    content = stream.read()
+            except (IOError, ValueError):
+                # A missing or damaged file, for example one written by an
+                # older version that didn't replace files atomically, is a
+                # miss.
+                pass
+            else:
+                response.fromcache = True
+                return response, content
+        response, content = super(ServiceRootCache, self).request(
+            uri, method=method, body=body, headers=headers, **kwargs)
+        if response.status == 200:
+            if not os.path.exists(self._path):
+                try:
+                    os.makedirs(self._path)
+                except OSError:
+                    # Another process created it first.
+                    if not os.path.isdir(self._path):
+                        raise
+            # Other kanban processes may be reading the files, so they're
+            # replaced rather than rewritten.  The body is written first,
+            # because the mtime of the .json file is what makes an entry
+            # fresh.
+            self._replace(path + ".body", content)
+            self._replace(path + ".json", json.dumps(dict(response)))
+        return response, content
+
+    def _replace(self, path, data):
+        """Atomically replace the file at C{path} with one holding C{data}.
+
+        The data is written to a temporary file in the same directory, which
+        is then renamed over C{path}, so readers see either the old file or
+        the new one, never a partly written one.
+        """
+        descriptor, temporary_path = mkstemp(dir=self._path,
+                                             prefix=".tmp-")
+        try:
+            with os.fdopen(descriptor, "wb") as stream:
+                stream.write(data)
+            os.rename(temporary_path, path)
+        except:
+            os.unlink(temporary_path)
+            raise
+
+
+class RequestScheduler(object):
+    """Decide when requests can be made to Launchpad.
+
+    Requests are limited by a token bucket: tokens are added at C{rate} per
+    second, up to C{burst}, and each request takes one.  The number of
+    requests in flight at once is limited too.  The limit starts at
+    L{DEFAULT_JOBS}.  It's halved whenever Launchpad throttles a request,
+    and increased by one after a limit's worth of requests have completed
+    in less than L{HEALTHY_LATENCY} seconds.
+
+    The scheduler is shared by every thread making requests.
+
+    @param rate: Optionally, the number of requests per second.
+    @param burst: Optionally, the number of requests that can be made at
+        once after a quiet period.
+    @param concurrency: Optionally, the initial concurrency limit.
+    @param max_concurrency: Optionally, the highest concurrency limit.
+    """
+
+    def __init__(self, rate=DEFAULT_REQUEST_RATE, burst=DEFAULT_REQUEST_BURST,
+                 concurrency=DEFAULT_JOBS, max_concurrency=MAX_CONCURRENCY):
+        self._condition = Condition(Lock())
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self._tokens = float(burst)
+        self._updated = time()
+        self._healthy = 0
+
+    def _refill(self):
+        now = time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Wait until a request can be made."""
+        with self._condition:
+            while True:
+                self._refill()
+                if self.active < self.concurrency and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.active += 1
+                    return
+                if self.active < self.concurrency:
+                    timeout = (1 - self._tokens) / self.rate
+                else:
+                    # Wake up now and then so Ctrl-C isn't ignored.
+                    timeout = 1
+                self._condition.wait(timeout)
+
+    def release(self, latency, throttled=False):
+        """Record that a request has completed.
+
+        @param latency: The number of seconds the request took.
+        @param throttled: Optionally, a flag indicating whether or not
+            Launchpad throttled the request.
+        """
+        with self._condition:
+            self.active -= 1
+            if throttled:
+                self.concurrency = max(1, self.concurrency // 2)
+                self._healthy = 0
+            elif latency < HEALTHY_LATENCY:
+                self._healthy += 1
+                if self._healthy >= self.concurrency:
+                    self.concurrency = min(self.max_concurrency,
+                                           self.concurrency + 1)
+                    self._healthy = 0
+            self._condition.notify_all()
+
+
+def is_throttled(response):
+    """True if C{response} shows Launchpad is throttling requests."""
+    return response.status in (429, 503)
+
+
+class ScheduledHttp(HttpWrapper):
+    """An L{HttpWrapper} that makes requests when a L{RequestScheduler}
+    allows.
+
+    GET requests are idempotent, so they're retried up to L{MAX_RETRIES}
+    times if Launchpad throttles them, waiting as long as the
+    C{Retry-After} header asks or backing off exponentially.  Other
+    requests are never retried.
+
+    @param http: The C{httplib2.Http}-like object to wrap.
+    @param scheduler: The L{RequestScheduler} to use.
+    @param backoff: Optionally, the number of seconds to wait before the
+        first retry.  The wait doubles for each retry after that.
+    """
+
+    def __init__(self, http, scheduler, backoff=1.0):
+        super(ScheduledHttp, self).__init__(http)
+        self._scheduler = scheduler
+        self._backoff = backoff
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        retries = MAX_RETRIES if method == "GET" else 0
+        for retry in range(retries + 1):
+            self._scheduler.acquire()
+            start = time()
+            throttled = False
+            try:
+                response, content = super(ScheduledHttp, self).request(
+                    uri, method=method, body=body, headers=headers, **kwargs)
+                throttled = is_throttled(response)
+            finally:
+                self._scheduler.release(time() - start, throttled)
+            if not throttled or retry == retries:
+                break
+            delay = self._backoff * 2 ** retry
+            try:
+                delay = max(delay, float(response["retry-after"]))
+            except (KeyError, ValueError):
+                pass
+            trace("Launchpad is busy, retrying in %.1f seconds" % delay)
+            sleep(delay)
+        return response, content
+
+
+def get_launchpad(stats=None, record=None, replay=None, latency=0):
     """Get a Launchpad instance.
 
+    @param stats: Optionally, a L{RequestStats} to record every HTTP request
+        made by the instance in.
+    @param record: Optionally, an L{HttpRecording} to add every HTTP
+        exchange made by the instance to.
+    @param replay: Optionally, an L{HttpRecording} to answer HTTP requests
+        from, instead of Launchpad.  Credentials aren't needed in this case.
+    @param latency: Optionally, the number of seconds to wait before each
+        replayed response.
     @raise RuntimeError: Raised if credentials are not available.
     """
     credentials_path = os.path.join(get_config_path(), "credentials.txt")
-    if not os.path.exists(credentials_path):
+    if os.path.exists(credentials_path):
+        credentials = Credentials()
+        credentials.load(open(credentials_path, "r"))
+    elif replay is not None:
+        credentials = Credentials("kanban")
+        credentials.access_token = AnonymousAccessToken()
+    else:
         raise RuntimeError(
             "Run the launchpad-login command to create OAuth credentials.")
-    credentials = Credentials()
-    credentials.load(open(credentials_path, "r"))
-    return Launchpad(credentials, SERVICE_ROOT, get_cache_path())
+    wrappers = []
+    if record is None and replay is None:
+        # Recordings must contain the service root description to be
+        # replayable, so it's only served from disk otherwise.
+        path = os.path.join(get_cache_path(), "service-root")
+        wrappers.append(lambda http: ServiceRootCache(http, path))
+    if replay is not None:
+        wrappers.append(
+            lambda http: ReplayingHttp(http, replay, latency=latency))
+    if record is not None:
+        wrappers.append(lambda http: RecordingHttp(http, record))
+    if stats is not None:
+        wrappers.append(lambda http: InstrumentedHttp(http, stats))
+    if replay is None:
+        # Replayed requests don't reach Launchpad, and benchmarks made with
+        # them should measure the code rather than the rate limit.
+        scheduler = RequestScheduler()
+        wrappers.append(lambda http: ScheduledHttp(http, scheduler))
+    return KanbanLaunchpad(credentials, SERVICE_ROOT, get_cache_path(),
+                           wrappers=wrappers)
 
 
 def get_project_group(launchpad, name):
@@ -71,11 +705,7 @@ def get_project_group(launchpad, name):
     @param launchpad: A C{Launchpad} instance.
     @param name: The name of the project group.
     """
-    result = launchpad.project_groups.search(text=name)
-    for project in result:
-        if project.name == name:
-            return project
-    return None
+    return _get_pillar(launchpad.project_groups, name, "#project_group")
 
 
 def get_project(launchpad, name):
@@ -84,47 +714,98 @@ def get_project(launchpad, name):
     @param launchpad: A C{Launchpad} instance.
     @param name: The name of the project.
     """
-    result = launchpad.projects.search(text=name)
-    for project in result:
-        if project.name == name:
-            return project
-    return None
+    return _get_pillar(launchpad.projects, name, "#project")
+
+
+def _get_pillar(collection, name, resource_type):
+    """Look up a project, project group or distribution by name.
+
+    Pillars share a namespace in Launchpad, so a lookup in one pillar
+    collection can find a pillar of a different type.  C{None} is returned
+    in that case.
+
+    @param collection: The C{Launchpad} collection to look in.
+    @param name: The name of the pillar.
+    @param resource_type: The resource type fragment expected, such as
+        C{#project}.
+    """
+    try:
+        pillar = collection[name]
+    except KeyError:
+        return None
+    if not pillar.resource_type_link.endswith(resource_type):
+        return None
+    return pillar
 
 
-def get_milestone(launchpad, project_name, milestone_name):
+def get_milestone(launchpad, project_name, milestone_name, store=None):
     """Get the milestone for the specified project.
 
+    Milestones are loaded directly by name with a single request.  If a
+    L{SnapshotStore} is provided the link to the milestone is remembered in
+    it for L{RESOURCE_INDEX_TTL}, and a milestone with a remembered link is
+    returned without making any requests at all.
+
     @param launchpad: A C{Launchpad} instance.
     @param project_name: The name of the Launchpad project the milestone
         belongs to.  Optionally, this can be a project group.
     @param milestone_name: The name of the milestone to fetch.
+    @param store: Optionally, a L{SnapshotStore} to use as an index of
+        milestone links.
+    @return: The milestone or C{None} if it doesn't exist.
     """
-    project_group = get_project_group(launchpad, project_name)
-    if project_group:
-        return _get_milestone(launchpad, project_group, milestone_name)
+    name = get_milestone_scope(project_name, milestone_name)
+    if store is not None:
+        links = store.get_resource(name, RESOURCE_INDEX_TTL)
+        if links is not None:
+            return _get_resource(launchpad, *links)
 
-    project = get_project(launchpad, project_name)
-    if project:
-        return _get_milestone(launchpad, project, milestone_name)
+    try:
+        milestone = launchpad.load(
+            "%s/+milestone/%s" % (project_name, milestone_name))
+    except HTTPError, e:
+        if e.response.status == 404:
+            return None
+        raise
+    if store is not None:
+        store.put_resource(name, milestone.self_link,
+                           milestone.resource_type_link, datetime.now(UTC))
+        store.commit()
+    return milestone
 
-    return None
 
+def _get_resource(launchpad, link, resource_type_link):
+    """Get a resource from Launchpad without fetching its representation.
 
-def _get_milestone(launchpad, project, name):
-    """Get the milestone called C{name} from C{project}.
+    This is the same thing C{launchpad.people(name)} does for a person:
+    the representation is only fetched when an attribute is accessed, so
+    calling a named operation on the resource doesn't need an extra
+    request.
 
     @param launchpad: A C{Launchpad} instance.
-    @param project: A C{project} or C{project_group} instance from Launchpad.
-    @param name: The name of the milestone to fetch.
+    @param link: The link to the resource.
+    @param resource_type_link: The link to the resource's type.
     """
-    for milestone in project.all_milestones_collection:
-        if milestone.name == name:
-            return milestone
-    return None
+    wadl_resource = WadlResource(launchpad._wadl, link, resource_type_link)
+    return launchpad._create_bound_resource(launchpad, wadl_resource)
 
 
 RELEVANT_STATUSES = ["New", "Incomplete", "Expired", "Confirmed", "Triaged",
                      "In Progress", "Fix Committed", "Fix Released"]
+ALL_STATUSES = RELEVANT_STATUSES + ["Opinion", "Invalid", "Won't Fix"]
+OPEN_STATUSES = [status for status in RELEVANT_STATUSES
+                 if status != "Fix Released"]
+
+# The order bug tasks are requested in when a search is sharded.
+SHARD_ORDER = ["-importance", "id"]
+
+# Launchpad sorts "-importance" by the value it stores for each importance,
+# which puts Unknown before Critical.  compare_bugs puts it last, so shards
+# are merged in Launchpad's order and the board sorts the merged stream.
+SHARD_IMPORTANCE_ORDER = ["Unknown"] + IMPORTANCE_ORDER
+SHARD_IMPORTANCE_RANKS = dict(
+    (importance, rank)
+    for rank, importance in enumerate(SHARD_IMPORTANCE_ORDER))
 
 
 def trace(message):
@@ -132,79 +813,707 @@ def trace(message):
     sys.stderr.write(unicode(message) + '\n')
 
 
-def get_person_assigned_bugs(launchpad, person_name):
+def get_person_assigned_bugs(launchpad, person_name, jobs=None,
+                             fan_out=None, closed_within=None,
+                             branch_cache=None, batch_size=None):
     """Get a C{list} of L{Bug}s assigned to C{person}.
 
+    If C{person} is a team, bugs assigned to everyone transitively in the
+    team are included.  Team participants are searched C{fan_out} at a time
+    and progress is reported on stderr as each search completes.
+
     @param launchpad: A C{Launchpad} instance.
     @param person_name: The name of the person or team to fetch bugs for.
+    @param jobs: Optionally, the number of bug tasks to fetch concurrently.
+        Defaults to L{DEFAULT_JOBS}.
+    @param fan_out: Optionally, the number of team participants to search
+        concurrently.  Defaults to L{DEFAULT_JOBS}.
+    @param closed_within: Optionally, the number of days 'Fix Released' bugs
+        are included for after they've been closed.  Defaults to
+        L{DEFAULT_CLOSED_WITHIN}.
+    @param branch_cache: Optionally, the L{BranchCache} to use.  Defaults to
+        a new one, shared by every participant.
+    @param batch_size: Optionally, the number of bug tasks to fetch in each
+        page of search results.  Defaults to L{DEFAULT_BATCH_SIZE}.
     """
-    bug_set = set()
     person = launchpad.people[person_name]
-    # Directly assigned bugs.
-    bug_set.update(get_person_directly_assigned_bugs(launchpad, person))
-    # If a team, get everyone transitively in the team.
-    for member in person.participants:
-        trace("check bugs for participant %s" % member)
-        bug_set.update(get_person_directly_assigned_bugs(launchpad, member))
-    return list(bug_set)
+    if branch_cache is None:
+        branch_cache = BranchCache()
+    people = [person]
+    people.extend(person.participants)
+
+    # A bug can be reached through several participants.  Only the first
+    # bug task seen for each bug is hydrated, so the rest don't cost any
+    # requests.
+    bug_ids = set()
+    lock = Lock()
+
+    def claim(bug_task):
+        bug_id = _get_bug_id(bug_task)
+        with lock:
+            if bug_id in bug_ids:
+                return False
+            bug_ids.add(bug_id)
+            return True
+
+    def get_bugs(member):
+        return list(get_person_directly_assigned_bugs(
+            launchpad, member, jobs=jobs, claim=claim,
+            closed_within=closed_within, branch_cache=branch_cache,
+            batch_size=batch_size))
+
+    all_bugs = []
+    results = _map_unordered(get_bugs, people, fan_out or DEFAULT_JOBS)
+    for i, (member, bugs) in enumerate(results):
+        trace("Found %d bugs for %s (%d/%d)"
+              % (len(bugs), member.name, i + 1, len(people)))
+        all_bugs.extend(bugs)
+    return all_bugs
+
+
+def sync_person_bugs(launchpad, store, person_name, jobs=None,
+                     fan_out=None, closed_within=None, batch_size=None):
+    """Replace the L{Bug}s for a person or team in a L{SnapshotStore}.
+
+    @param launchpad: A C{Launchpad} instance.
+    @param store: The L{SnapshotStore} to update.
+    @param person_name: The name of the person or team to fetch bugs for.
+    @param jobs: Optionally, the number of bug tasks to fetch concurrently.
+        Defaults to L{DEFAULT_JOBS}.
+    @param fan_out: Optionally, the number of team participants to search
+        concurrently.  Defaults to L{DEFAULT_JOBS}.
+    @param closed_within: Optionally, the number of days 'Fix Released' bugs
+        are included for after they've been closed.  Defaults to
+        L{DEFAULT_CLOSED_WITHIN}.
+    @param batch_size: Optionally, the number of bug tasks to fetch in each
+        page of search results.  Defaults to L{DEFAULT_BATCH_SIZE}.
+    @return: A C{list} of the L{Bug}s assigned to the person or team.
+    """
+    scope = get_person_scope(person_name)
+    sync_date = datetime.now(UTC)
+    # Person syncs are always full, so they resolve every branch again.
+    # The details are saved for incremental milestone syncs.
+    branch_cache = BranchCache()
+    bugs = get_person_assigned_bugs(launchpad, person_name, jobs=jobs,
+                                    fan_out=fan_out,
+                                    closed_within=closed_within,
+                                    branch_cache=branch_cache,
+                                    batch_size=batch_size)
+    try:
+        store.clear(scope)
+        for bug in bugs:
+            store.put_bug(scope, unicode(bug.id), bug)
+        store.set_last_sync(scope, sync_date)
+        branch_cache.save(store)
+    except:
+        store.rollback()
+        raise
+    store.commit()
+    return bugs
 
 
-def get_person_directly_assigned_bugs(launchpad, person):
+def get_person_directly_assigned_bugs(launchpad, person, jobs=None,
+                                     claim=None, closed_within=None,
+                                     branch_cache=None, batch_size=None):
     """Generator yields L{Bug}s assigned to C{person}.
 
+    Open bug tasks and recently closed ones are fetched with separate
+    searches, so that old 'Fix Released' bug tasks are never sent by
+    Launchpad.
+
     @param launchpad: A C{Launchpad} instance.
     @param person: A C{person} instance from Launchpad.
+    @param jobs: Optionally, the number of bug tasks to fetch concurrently.
+        Defaults to L{DEFAULT_JOBS}.
+    @param claim: Optionally, a callable that takes a bug task and returns
+        C{False} if it shouldn't be hydrated, for example because its bug
+        has already been seen.
+    @param closed_within: Optionally, the number of days 'Fix Released' bugs
+        are included for after they've been closed.  Defaults to
+        L{DEFAULT_CLOSED_WITHIN}.
+    @param branch_cache: Optionally, the L{BranchCache} to use.  Defaults to
+        a new one.
+    @param batch_size: Optionally, the number of bug tasks to fetch in each
+        page of search results.  Defaults to L{DEFAULT_BATCH_SIZE}.
     """
-    for bug_task in person.searchTasks(status=RELEVANT_STATUSES,
-                                       assignee=person):
+    if closed_within is None:
+        closed_within = DEFAULT_CLOSED_WITHIN
+    cutoff = datetime.now(UTC) - timedelta(days=closed_within)
+
+    def get_bug_tasks():
+        bug_tasks = person.searchTasks(status=OPEN_STATUSES, assignee=person)
+        for bug_task in iter_collection(bug_tasks, jobs, batch_size):
+            if claim is None or claim(bug_task):
+                yield bug_task
         # It's nice to see fixed bugs for the sake of a sense of
         # accomplishment, but we don't want the kanban to get too big.
-        trace(bug_task)
-        if (bug_task.status == "Fix Released"):
+        # Launchpad can't search by the date a bug task was closed, but a
+        # bug task is modified when it's closed, so this search only misses
+        # bug tasks we don't want.  Bug tasks modified after being closed
+        # are filtered out here.
+        bug_tasks = person.searchTasks(status=["Fix Released"],
+                                       assignee=person,
+                                       modified_since=cutoff.isoformat())
+        for bug_task in iter_collection(bug_tasks, jobs, batch_size):
             date_closed = bug_task.date_closed
-            age = datetime.now(date_closed.tzinfo) - date_closed
-            if (age > timedelta(days=31)):
-                trace("fixed too long ago, omitting")
+            if date_closed is not None and date_closed < cutoff:
                 continue
-        yield _create_bug(bug_task)
+            if claim is None or claim(bug_task):
+                yield bug_task
 
+    return _create_bugs(get_bug_tasks(), jobs=jobs, branch_cache=branch_cache)
 
-def get_milestone_bugs(launchpad, project_name, milestone_name):
-    """Get a C{list} of L{Bug}s from a milestone in Launchpad.
+
+def sync_milestone_bugs(launchpad, store, project_name, milestone_name,
+                        jobs=None, incremental=None, batch_size=None,
+                        branch_cache=None, commit=True, shard=None):
+    """
+    Sync L{Bug}s from a milestone in Launchpad into a L{SnapshotStore}.
+
+    A full sync replaces the snapshot with every relevant bug task in the
+    milestone, yielding each L{Bug} as soon as it's hydrated.  An
+    incremental sync only asks Launchpad for bug tasks modified since the
+    last successful sync: changed bug tasks are hydrated and stored again,
+    bug tasks that are no longer relevant are removed from the snapshot and
+    the updated snapshot is yielded.  Bug tasks retargeted to a different
+    milestone aren't seen by an incremental sync, and neither are changes
+    to linked branches and merge proposals that don't modify the bug, such
+    as a merge proposal being approved or merged.  An incremental sync
+    also reuses the branch details saved by earlier syncs for
+    L{BRANCH_CACHE_TTL}.  A full sync resolves every linked branch again,
+    so it picks those changes up and is needed now and then.
+
+    The milestone is looked up straight away, and the rest of the sync is
+    done by the generator that's returned.  The sync is only committed once
+    every fetched L{Bug} has been consumed.
 
     @param launchpad: A C{Launchpad} instance.
+    @param store: The L{SnapshotStore} to update.
     @param project_name: The name of the Launchpad project the milestone
         belongs to.  Optionally, this can be a project group.
     @param milestone_name: The name of the milestone to fetch.
+    @param jobs: Optionally, the number of bug tasks to fetch concurrently.
+        Defaults to L{DEFAULT_JOBS}.
+    @param incremental: Optionally, a flag indicating whether or not to only
+        fetch bug tasks changed since the last sync.  A full sync is always
+        made if the milestone hasn't been synced before.  Defaults to
+        C{False}.
+    @param batch_size: Optionally, the number of bug tasks to fetch in each
+        page of search results.  Defaults to L{DEFAULT_BATCH_SIZE}.
+    @param branch_cache: Optionally, the L{BranchCache} to use.  Defaults to
+        one loaded from C{store} for incremental syncs and an empty one for
+        full syncs.  It's saved to C{store} when the sync completes.
+    @param commit: Optionally, a flag indicating whether or not to commit
+        the sync.  Callers that pass C{False} must commit or roll back the
+        store themselves.  Defaults to C{True}.
+    @param shard: Optionally, a flag indicating whether or not to search
+        the milestone of each project in a project group separately.  The
+        searches are run concurrently and their results are merged in
+        L{get_shard_sort_key} order, which isn't quite L{compare_bugs}
+        order.  It has no effect if C{project_name} isn't a project
+        group.  Defaults to C{False}.
+    @return: A generator that yields the L{Bug}s in the milestone.
     """
-    bugs = []
-    milestone = get_milestone(launchpad, project_name, milestone_name)
-    for bug_task in milestone.searchTasks(status=RELEVANT_STATUSES):
-        bugs.append(_create_bug(bug_task))
-    return bugs
+    milestones = None
+    if shard:
+        milestones = get_member_milestones(launchpad, project_name,
+                                           milestone_name, store=store)
+    if not milestones:
+        milestones = [get_milestone(launchpad, project_name, milestone_name,
+                                    store=store)]
+    return _sync_milestone_bugs(
+        store, get_milestone_scope(project_name, milestone_name), milestones,
+        jobs or DEFAULT_JOBS, incremental, batch_size, branch_cache, commit)
+
+
+def _sync_milestone_bugs(store, scope, milestones, jobs, incremental,
+                         batch_size, branch_cache, commit):
+    """Generator does the work for L{sync_milestone_bugs}.
+
+    @param scope: The snapshot scope of the milestone.
+    @param milestones: A C{list} of the milestones to search.  If there's
+        more than one the results are merged in L{get_shard_sort_key}
+        order.
+    """
+    last_sync = store.get_last_sync(scope)
+    incremental = incremental and last_sync is not None
+    # Note the time before searching so that changes made while the sync is
+    # running are picked up by the next one.
+    sync_date = datetime.now(UTC)
+    pool = None
+    try:
+        if incremental:
+            search = {"status": ALL_STATUSES,
+                      "modified_since": last_sync.isoformat()}
+        else:
+            search = {"status": RELEVANT_STATUSES}
+            store.clear(scope)
+
+        def get_relevant_tasks(bug_tasks):
+            for bug_task in iter_collection(bug_tasks, jobs, batch_size,
+                                            pool):
+                if bug_task.status in RELEVANT_STATUSES:
+                    yield bug_task
+                else:
+                    store.remove_bug(scope, bug_task.self_link)
+
+        save_branch_cache = branch_cache is None
+        if save_branch_cache:
+            branch_cache = _get_branch_cache(store, incremental)
+
+        def create_bug(bug_task):
+            return bug_task.self_link, _create_bug(bug_task, branch_cache)
+
+        if len(milestones) == 1:
+            [milestone] = milestones
+            bug_tasks = milestone.searchTasks(**search)
+            results = _map_ordered(create_bug, get_relevant_tasks(bug_tasks),
+                                   jobs)
+        else:
+            # Each shard is sorted by Launchpad, so they can be merged as
+            # they're hydrated, without waiting for every bug task.
+            search["order_by"] = SHARD_ORDER
+            # Every shard's searches, pages and bug tasks are handled by one
+            # pool.  More threads than the scheduler lets make requests at
+            # once would only sit idle.
+            pool = ThreadPool(min(jobs * len(milestones), MAX_CONCURRENCY))
+            searches = _map_ordered(
+                lambda milestone: milestone.searchTasks(**search), milestones,
+                jobs, pool)
+            shards = [_map_ordered(create_bug, get_relevant_tasks(bug_tasks),
+                                   jobs, pool)
+                      for bug_tasks in searches]
+            results = _merge_sorted(
+                shards, lambda result: get_shard_sort_key(result[1]))
+
+        count = 0
+        for key, bug in results:
+            store.put_bug(scope, key, bug)
+            count += 1
+            if not incremental:
+                yield bug
+        store.set_last_sync(scope, sync_date)
+        if save_branch_cache:
+            branch_cache.save(store)
+    except:
+        store.rollback()
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if commit:
+        store.commit()
+    trace("Synced %d changed bug tasks for %s" % (count, scope))
+    if incremental:
+        for bug in store.get_bugs(scope):
+            yield bug
+
+
+def get_member_milestones(launchpad, project_group_name, milestone_name,
+                          store=None):
+    """Get the milestones of the projects in a project group.
+
+    @param launchpad: A C{Launchpad} instance.
+    @param project_group_name: The name of the project group.
+    @param milestone_name: The name of the milestone to fetch from each
+        project.  Projects that don't have a milestone with this name are
+        skipped.
+    @param store: Optionally, a L{SnapshotStore} to use as an index of
+        milestone links.
+    @return: A C{list} of milestones, or C{None} if C{project_group_name}
+        isn't the name of a project group.
+    """
+    project_group = get_project_group(launchpad, project_group_name)
+    if project_group is None:
+        return None
+    milestones = []
+    for project in project_group.projects:
+        milestone = get_milestone(launchpad, project.name, milestone_name,
+                                  store=store)
+        if milestone is not None:
+            milestones.append(milestone)
+    return milestones
+
+
+def sync_milestones_bugs(launchpad, store, milestones, jobs=None,
+                         incremental=None, batch_size=None, shard=None):
+    """
+    Generator syncs L{Bug}s from several milestones in Launchpad into a
+    L{SnapshotStore} and yields each L{Bug} in any of them once.
+
+    Every milestone is synced as described by L{sync_milestone_bugs}, and
+    the syncs are interleaved so bug tasks from all of them are fetched
+    concurrently.  Every milestone is looked up before any of them is
+    synced, and the store is only committed once every milestone has been
+    synced, so a failure leaves every snapshot unchanged.
+
+    @param launchpad: A C{Launchpad} instance.
+    @param store: The L{SnapshotStore} to update.
+    @param milestones: A C{list} of C{(project_name, milestone_name)}
+        pairs.
+    @param jobs: Optionally, the number of bug tasks to fetch concurrently
+        for each milestone.  Defaults to L{DEFAULT_JOBS}.
+    @param incremental: Optionally, a flag indicating whether or not to only
+        fetch bug tasks changed since the last sync of each milestone.
+        Defaults to C{False}.
+    @param batch_size: Optionally, the number of bug tasks to fetch in each
+        page of search results.  Defaults to L{DEFAULT_BATCH_SIZE}.
+    @param shard: Optionally, a flag indicating whether or not to search
+        the milestones of project groups one member project at a time, as
+        described by L{sync_milestone_bugs}.  Defaults to C{False}.
+    """
+    branch_cache = _get_branch_cache(store, incremental)
+    syncs = [sync_milestone_bugs(launchpad, store, project_name,
+                                 milestone_name, jobs=jobs,
+                                 incremental=incremental,
+                                 batch_size=batch_size,
+                                 branch_cache=branch_cache, commit=False,
+                                 shard=shard)
+             for project_name, milestone_name in milestones]
+    bug_ids = set()
+    try:
+        for bug in _interleave(syncs):
+            if bug.id not in bug_ids:
+                bug_ids.add(bug.id)
+                yield bug
+        branch_cache.save(store)
+    except:
+        store.rollback()
+        raise
+    store.commit()
+
+
+def get_shard_sort_key(bug):
+    """
+    Get a key that sorts L{Bug}s in the order of a search ordered by
+    L{SHARD_ORDER}.
+    """
+    return (SHARD_IMPORTANCE_RANKS.get(bug.importance,
+                                       len(SHARD_IMPORTANCE_ORDER)),
+            bug.id)
+
+
+def _get_branch_cache(store, incremental):
+    """Get the L{BranchCache} for a sync.
+
+    Saved details can be out of date, so they're only used by incremental
+    syncs, which miss some merge proposal changes anyway.
+    """
+    if incremental:
+        return BranchCache.load(store)
+    return BranchCache()
+
+
+def _merge_sorted(iterables, key):
+    """Generator merges C{iterables}, each sorted by C{key}, into one stream.
+
+    Only the next item from each iterable is held at a time.  Items with
+    equal keys are yielded in the order of the iterables they came from.
+    """
+    def decorate(index, iterable):
+        for position, item in enumerate(iterable):
+            yield key(item), index, position, item
+
+    decorated = [decorate(index, iterable)
+                 for index, iterable in enumerate(iterables)]
+    for _, _, _, item in heapq.merge(*decorated):
+        yield item
+
+
+def _interleave(iterators):
+    """Generator yields items from each of C{iterators} in turn.
+
+    Exhausted iterators are skipped until they've all been exhausted.
+    """
+    iterators = deque(iter(iterator) for iterator in iterators)
+    while iterators:
+        iterator = iterators.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            continue
+        iterators.append(iterator)
+        yield item
+
 
+class BranchCache(object):
+    """Branch and merge proposal details, keyed by branch link.
 
-def _create_bug(bug_task):
-    """Create a L{Bug} from a C{bug_task} instance loaded from Launchpad."""
+    Several bugs often link the same branch.  Each branch is resolved at
+    most once, even when bugs are hydrated by several threads at once.
+    Details can be saved to a L{SnapshotStore} and loaded again for
+    L{BRANCH_CACHE_TTL}, so that incremental syncs don't need to resolve
+    branches again.  Full syncs start with an empty cache, so they always
+    see the current state of merge proposals.
+
+    @param branches: Optionally, a C{dict} of details to start with, as
+        returned by L{SnapshotStore.get_branches}.
+    """
+
+    def __init__(self, branches=None):
+        self._lock = Lock()
+        self._branches = dict(branches or {})
+        self._locks = {}
+        self._resolved = {}
+
+    @classmethod
+    def load(cls, store):
+        """Create a L{BranchCache} with the details kept in C{store}."""
+        return cls(store.get_branches(BRANCH_CACHE_TTL))
+
+    def save(self, store):
+        """Store the details resolved by this cache in C{store}."""
+        with self._lock:
+            resolved = self._resolved.items()
+        now = datetime.now(UTC)
+        for link, details in resolved:
+            store.put_branch(link, details, now)
+
+    def resolve(self, link, function):
+        """Get the details for the branch at C{link}.
+
+        @param link: The link to the branch.
+        @param function: A callable that returns the details for the branch,
+            used if they aren't cached yet.
+        @return: A C{(bzr_identity, merge_proposal, merge_proposal_status,
+            merge_proposal_creation_date)} tuple.
+        """
+        with self._lock:
+            if link in self._branches:
+                return self._branches[link]
+            lock = self._locks.setdefault(link, Lock())
+        with lock:
+            with self._lock:
+                if link in self._branches:
+                    return self._branches[link]
+            details = function()
+            with self._lock:
+                self._branches[link] = details
+                self._resolved[link] = details
+                del self._locks[link]
+        return details
+
+
+def iter_collection(collection, jobs=None, batch_size=None, pool=None):
+    """Iterate over the entries in a Launchpad collection.
+
+    A lazr collection only fetches its next page when iteration reaches it.
+    Here the size of the collection is used to build links to every
+    remaining page up front, and up to twice C{jobs} pages are fetched
+    ahead while earlier entries are being used.  Collections that don't
+    know their size, and plain iterables, are iterated as usual.
+
+    @param collection: A C{Collection}, such as the result of
+        C{searchTasks}.
+    @param jobs: Optionally, the number of pages to fetch concurrently.
+        Defaults to L{DEFAULT_JOBS}.
+    @param batch_size: Optionally, the number of entries to fetch in each
+        page after the first.  Defaults to L{DEFAULT_BATCH_SIZE}.
+    @param pool: Optionally, a C{ThreadPool} shared with other callers to
+        fetch pages with.  Defaults to a new pool of C{jobs} threads.
+    """
+    if not isinstance(collection, Collection):
+        return iter(collection)
+    collection._ensure_representation()
+    first_page = collection._wadl_resource.representation
+    next_link = first_page.get("next_collection_link")
+    if next_link is None:
+        return iter(collection)
+    try:
+        total_size = len(collection)
+    except TypeError:
+        return iter(collection)
+    browser = collection._root._browser
+
+    def fetch_page(link):
+        return json.loads(browser.get(link))["entries"]
+
+    links = get_page_links(next_link, len(first_page["entries"]), total_size,
+                           batch_size or DEFAULT_BATCH_SIZE)
+    pages = _map_ordered(fetch_page, links, jobs or DEFAULT_JOBS, pool)
+    return _iter_pages(collection, first_page["entries"], pages)
+
+
+def get_page_links(link, start, total_size, batch_size):
+    """Get links to the pages of a collection.
+
+    @param link: A link to any page of the collection.
+    @param start: The index of the first entry to fetch.
+    @param total_size: The number of entries in the collection.
+    @param batch_size: The number of entries in each page.
+    @return: A C{list} of links to pages of C{batch_size} entries, from
+        C{start} to the end of the collection.
+    """
+    parsed = urlparse(link)
+    # Pages are selected by position, so the memo Launchpad uses to find
+    # the next page is dropped.
+    query = [(name, value) for name, value in parse_qsl(parsed.query)
+             if name not in ("ws.start", "ws.size", "memo", "direction")]
+    links = []
+    for offset in range(start, total_size, batch_size):
+        page_query = query + [("ws.start", offset), ("ws.size", batch_size)]
+        links.append(urlunparse(parsed[:4] + (urlencode(page_query),) +
+                                parsed[5:]))
+    return links
+
+
+def _iter_pages(collection, first_entries, pages):
+    """Generator yields the entries in the first page, then in C{pages}."""
+    for entry in collection._convert_dicts_to_entries(first_entries):
+        yield entry
+    for entries in pages:
+        for entry in collection._convert_dicts_to_entries(entries):
+            yield entry
+
+
+def _create_bugs(bug_tasks, jobs=None, branch_cache=None):
+    """Generator yields L{Bug}s created from C{bug_tasks}, in order.
+
+    @param bug_tasks: An iterable of C{bug_task} instances from Launchpad.
+    @param jobs: Optionally, the number of bug tasks to hydrate concurrently.
+        Defaults to L{DEFAULT_JOBS}.
+    @param branch_cache: Optionally, the L{BranchCache} to use.  Defaults to
+        a new one.
+    """
+    if branch_cache is None:
+        branch_cache = BranchCache()
+    return _map_ordered(lambda bug_task: _create_bug(bug_task, branch_cache),
+                        bug_tasks, jobs or DEFAULT_JOBS)
+
+
+def _map_ordered(function, items, jobs, pool=None):
+    """Generator yields C{function(item)} for each of C{items}, in order.
+
+    Items are processed by a pool of C{jobs} worker threads.  At most twice
+    that many items are in flight at once, so a slow item holds up output
+    without letting an unbounded amount of work pile up behind it.  C{items}
+    is consumed in the calling thread.
+
+    @param function: The callable to run for each item.
+    @param items: An iterable of items to pass to C{function}.
+    @param jobs: The number of items to process concurrently.
+    @param pool: Optionally, a C{ThreadPool} shared with other callers to
+        process items with.  The caller is responsible for terminating it.
+        Defaults to a new pool of C{jobs} threads.
+    """
+    if pool is None:
+        if jobs < 2:
+            for item in items:
+                yield function(item)
+            return
+        own_pool = pool = ThreadPool(jobs)
+    else:
+        own_pool = None
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= jobs * 2:
+                yield _wait_for(pending.popleft())
+        while pending:
+            yield _wait_for(pending.popleft())
+    finally:
+        if own_pool is not None:
+            own_pool.terminate()
+
+
+def _wait_for(result):
+    """Wait for an C{AsyncResult} and return its value.
+
+    A timeout is always passed to C{AsyncResult.get} because an untimed wait
+    can't be interrupted with Ctrl-C.
+    """
+    while True:
+        try:
+            return result.get(60)
+        except TimeoutError:
+            continue
+
+
+def _map_unordered(function, items, jobs):
+    """Generator yields C{(item, function(item))} pairs as they complete.
+
+    @param function: The callable to run for each item.
+    @param items: A sequence of items to pass to C{function}.
+    @param jobs: The number of items to process concurrently.
+    """
+    if jobs < 2:
+        for item in items:
+            yield item, function(item)
+        return
+
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.imap_unordered(lambda item: (item, function(item)),
+                                      items)
+        while True:
+            try:
+                yield results.next(60)
+            except TimeoutError:
+                continue
+            except StopIteration:
+                break
+    finally:
+        pool.terminate()
+
+
+def _get_link_name(link):
+    """Get the last path segment of a resource link."""
+    return link.rstrip("/").rsplit("/", 1)[-1]
+
+
+def _get_bug_id(bug_task):
+    """Get the ID of the bug C{bug_task} belongs to without loading it."""
+    return int(_get_link_name(bug_task.bug_link))
+
+
+def _get_assignee_name(bug_task):
+    """
+    Get the name of the person C{bug_task} is assigned to without loading
+    them, or C{None} if it isn't assigned.
+    """
+    if bug_task.assignee_link is None:
+        return None
+    return _get_link_name(bug_task.assignee_link).lstrip("~")
+
+
+def _create_bug(bug_task, branch_cache=None):
+    """Create a L{Bug} from a C{bug_task} instance loaded from Launchpad.
+
+    Linked branches and merge proposals are loaded unless the bug task
+    details alone are enough to categorize the bug, see
+    L{Bug.depends_on_merge_proposal}.
+
+    @param bug_task: The bug task to create a L{Bug} from.
+    @param branch_cache: Optionally, the L{BranchCache} to use.  Defaults to
+        a new one.
+    """
+    # The bug ID and assignee name are part of the links in the bug task's
+    # representation, so the bug is only loaded for its title and tags and
+    # the assignee isn't loaded at all.
     launchpad_bug = bug_task.bug
-    assignee = bug_task.assignee
-    in_progress_date = bug_task.date_in_progress
-
-    if assignee is not None:
-        assignee = assignee.name
-    branch_url = None
-    merge_proposal_url = None
-    merge_proposal_status = None
-    merge_proposal_creation_date = None
+    bug = Bug(_get_bug_id(bug_task), bug_task.bug_target_name,
+              bug_task.importance, bug_task.status, launchpad_bug.title,
+              _get_assignee_name(bug_task), bug_task.date_in_progress,
+              tags=launchpad_bug.tags)
+    if bug.depends_on_merge_proposal():
+        _load_merge_proposal(bug, launchpad_bug, branch_cache or BranchCache())
+    return bug
+
+
+def _load_merge_proposal(bug, launchpad_bug, branch_cache):
+    """
+    Set the branch and merge proposal details for C{bug} from the branches
+    linked to C{launchpad_bug}.
+    """
     try:
         for branch in launchpad_bug.linked_branches:
-            launchpad_branch = branch.branch
-            branch_url = launchpad_branch.bzr_identity
-            for merge_proposal in launchpad_branch.landing_targets:
-                merge_proposal_creation_date = merge_proposal.date_created
-                merge_proposal_status = merge_proposal.queue_status
-                merge_proposal_url = merge_proposal.web_link
-                break
+            details = branch_cache.resolve(
+                branch.branch_link, lambda: _resolve_branch(branch.branch))
+            bug.branch = details[0]
+            if details[1] is not None:
+                (bug.merge_proposal, bug.merge_proposal_status,
+                 bug.merge_proposal_creation_date) = details[1:]
     except HTTPError, e:
         # Due to <http://pad.lv/735346>, at the moment bugs with
         # any private linked branches hide all of them and raise an error.
@@ -213,8 +1522,11 @@ def _create_bug(bug_task):
             pass
         else:
             raise
-    return Bug(launchpad_bug.id, bug_task.bug_target_name, bug_task.importance,
-               bug_task.status, launchpad_bug.title, assignee,
-               in_progress_date, branch_url, merge_proposal_url,
-               merge_proposal_status, merge_proposal_creation_date,
-               launchpad_bug.tags)
+
+
+def _resolve_branch(launchpad_branch):
+    """Get the details for a branch, for a L{BranchCache}."""
+    for merge_proposal in launchpad_branch.landing_targets:
+        return (launchpad_branch.bzr_identity, merge_proposal.web_link,
+                merge_proposal.queue_status, merge_proposal.date_created)
+    return launchpad_branch.bzr_identity, None, None, None
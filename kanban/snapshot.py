@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta, tzinfo
+import sqlite3
+
+from kanban.board import Bug
+
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS bug (
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        id,
+        project TEXT,
+        importance TEXT,
+        status TEXT,
+        title TEXT,
+        assignee TEXT,
+        in_progress_date TEXT,
+        branch TEXT,
+        merge_proposal TEXT,
+        merge_proposal_status TEXT,
+        merge_proposal_creation_date TEXT,
+        tags TEXT,
+        PRIMARY KEY (scope, key))
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sync (
+        scope TEXT NOT NULL PRIMARY KEY,
+        date TEXT NOT NULL)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS resource (
+        name TEXT NOT NULL PRIMARY KEY,
+        link TEXT NOT NULL,
+        resource_type_link TEXT NOT NULL,
+        date TEXT NOT NULL)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS branch (
+        link TEXT NOT NULL PRIMARY KEY,
+        bzr_identity TEXT,
+        merge_proposal TEXT,
+        merge_proposal_status TEXT,
+        merge_proposal_creation_date TEXT,
+        date TEXT NOT NULL)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS branch_date ON branch (date)
+    """]
+
+
+class UTCTimezone(tzinfo):
+    """The UTC timezone."""
+
+    def utcoffset(self, date):
+        return timedelta(0)
+
+    def tzname(self, date):
+        return "UTC"
+
+    def dst(self, date):
+        return timedelta(0)
+
+
+UTC = UTCTimezone()
+
+
+def dump_date(date):
+    """Convert C{date} to a UTC string for storage, or C{None}."""
+    if date is None:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(UTC)
+    return date.strftime(DATE_FORMAT)
+
+
+def load_date(value):
+    """Convert a string created by L{dump_date} back into a C{datetime}."""
+    if value is None:
+        return None
+    return datetime.strptime(value, DATE_FORMAT).replace(tzinfo=UTC)
+
+
+def get_milestone_scope(project_name, milestone_name):
+    """Get the name of the snapshot scope for a milestone."""
+    return "milestone:%s/%s" % (project_name, milestone_name)
+
+
+def get_person_scope(person_name):
+    """Get the name of the snapshot scope for a person or team."""
+    return "person:%s" % person_name
+
+
+class SnapshotStore(object):
+    """A local snapshot of L{Bug}s fetched from Launchpad.
+
+    Bugs are grouped into named scopes, one for each board, and each bug is
+    keyed by a string that is unique within its scope, such as the link of
+    the bug task it was created from.  The time of the last successful sync
+    is recorded per scope so that later syncs only need to fetch bug tasks
+    that changed since then, and so that boards can be built offline.
+
+    @param path: The path to the SQLite database to use.
+    """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+        for statement in SCHEMA:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def get_bugs(self, scope):
+        """Get a C{list} of the L{Bug}s stored in C{scope}."""
+        result = self._connection.execute(
+            "SELECT id, project, importance, status, title, assignee, "
+            "in_progress_date, branch, merge_proposal, merge_proposal_status, "
+            "merge_proposal_creation_date, tags FROM bug WHERE scope = ?",
+            (scope,))
+        bugs = []
+        for row in result:
+            (id, project, importance, status, title, assignee,
+             in_progress_date, branch, merge_proposal, merge_proposal_status,
+             merge_proposal_creation_date, tags) = row
+            bugs.append(Bug(id, project, importance, status, title, assignee,
+                            load_date(in_progress_date), branch,
+                            merge_proposal, merge_proposal_status,
+                            load_date(merge_proposal_creation_date),
+                            tags.split() if tags else None))
+        return bugs
+
+    def put_bug(self, scope, key, bug):
+        """Store C{bug} in C{scope}, replacing any bug stored for C{key}."""
+        self._connection.execute(
+            "INSERT OR REPLACE INTO bug VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (scope, key, bug.id, bug.project, bug.importance, bug.status,
+             bug.title, bug.assignee, dump_date(bug.in_progress_date),
+             bug.branch, bug.merge_proposal, bug.merge_proposal_status,
+             dump_date(bug.merge_proposal_creation_date),
+             " ".join(bug.tags)))
+
+    def clear(self, scope):
+        """Remove all bugs stored in C{scope}."""
+        self._connection.execute("DELETE FROM bug WHERE scope = ?", (scope,))
+
+    def remove_bug(self, scope, key):
+        """Remove the bug stored for C{key} from C{scope}, if there is one."""
+        self._connection.execute(
+            "DELETE FROM bug WHERE scope = ? AND key = ?", (scope, key))
+
+    def get_last_sync(self, scope):
+        """
+        Get the time C{scope} was last synced as a C{datetime}, or C{None} if
+        it has never been synced.
+        """
+        row = self._connection.execute(
+            "SELECT date FROM sync WHERE scope = ?", (scope,)).fetchone()
+        return load_date(row[0]) if row else None
+
+    def set_last_sync(self, scope, date):
+        """Record C{date} as the time C{scope} was last synced."""
+        self._connection.execute(
+            "INSERT OR REPLACE INTO sync VALUES (?, ?)",
+            (scope, dump_date(date)))
+
+    def get_resource(self, name, max_age=None):
+        """Get the links stored for the Launchpad resource called C{name}.
+
+        @param name: The name of the resource.
+        @param max_age: Optionally, a C{timedelta}.  Links stored longer ago
+            than this are ignored.
+        @return: A C{(link, resource_type_link)} tuple, or C{None} if a link
+            isn't available.
+        """
+        row = self._connection.execute(
+            "SELECT link, resource_type_link, date FROM resource "
+            "WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        link, resource_type_link, date = row
+        if max_age is not None:
+            if load_date(date) + max_age < datetime.now(UTC):
+                return None
+        return link, resource_type_link
+
+    def put_resource(self, name, link, resource_type_link, date):
+        """Store the links for the Launchpad resource called C{name}.
+
+        @param name: The name of the resource.
+        @param link: The link to the resource.
+        @param resource_type_link: The link to the resource's type.
+        @param date: The time the links were looked up.
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO resource VALUES (?, ?, ?, ?)",
+            (name, link, resource_type_link, dump_date(date)))
+
+    def get_branches(self, max_age=None):
+        """Get the details stored for branches.
+
+        @param max_age: Optionally, a C{timedelta}.  Details stored longer
+            ago than this are deleted from the store.
+        @return: A C{dict} mapping branch links to C{(bzr_identity,
+            merge_proposal, merge_proposal_status,
+            merge_proposal_creation_date)} tuples.
+        """
+        if max_age is not None:
+            # Dates are stored in a fixed format in UTC, so they sort in
+            # the same order as the times they represent.
+            self._connection.execute(
+                "DELETE FROM branch WHERE date < ?",
+                (dump_date(datetime.now(UTC) - max_age),))
+        result = self._connection.execute(
+            "SELECT link, bzr_identity, merge_proposal, "
+            "merge_proposal_status, merge_proposal_creation_date FROM branch")
+        branches = {}
+        for row in result:
+            (link, bzr_identity, merge_proposal, merge_proposal_status,
+             merge_proposal_creation_date) = row
+            branches[link] = (bzr_identity, merge_proposal,
+                              merge_proposal_status,
+                              load_date(merge_proposal_creation_date))
+        return branches
+
+    def put_branch(self, link, details, date):
+        """Store the details for the branch at C{link}.
+
+        @param link: The link to the branch.
+        @param details: A tuple like those returned by L{get_branches}.
+        @param date: The time the details were looked up.
+        """
+        (bzr_identity, merge_proposal, merge_proposal_status,
+         merge_proposal_creation_date) = details
+        self._connection.execute(
+            "INSERT OR REPLACE INTO branch VALUES (?, ?, ?, ?, ?, ?)",
+            (link, bzr_identity, merge_proposal, merge_proposal_status,
+             dump_date(merge_proposal_creation_date), dump_date(date)))
+
+    def commit(self):
+        """Commit changes made to this store."""
+        self._connection.commit()
+
+    def rollback(self):
+        """Discard changes made to this store since the last commit."""
+        self._connection.rollback()
+
+    def close(self):
+        """Close this store.  Uncommitted changes are discarded."""
+        self._connection.close()
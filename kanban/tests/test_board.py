@@ -2,11 +2,15 @@ from datetime import datetime
 
 from testtools import TestCase
 
+from kanban import board
 from kanban.board import (
     Bug, MilestoneBoard, PersonBoard, Story, compare_bugs, compare_stories,
+    get_bug_sort_key, get_story_sort_key,
     NEW, CONFIRMED, TRIAGED, IN_PROGRESS, FIX_COMMITTED, FIX_RELEASED,
     UNDECIDED, WISHLIST, LOW, MEDIUM, HIGH, CRITICAL, WORK_IN_PROGRESS,
-    NEEDS_REVIEW, APPROVED, MERGED)
+    NEEDS_REVIEW, APPROVED, MERGED, QUEUED_CATEGORY, IN_PROGRESS_CATEGORY,
+    NEEDS_REVIEW_CATEGORY, NEEDS_TESTING_CATEGORY, NEEDS_RELEASE_CATEGORY,
+    RELEASED_CATEGORY)
 
 
 class BugTest(TestCase):
@@ -28,7 +32,7 @@ class BugTest(TestCase):
         self.assertIs(None, bug.merge_proposal)
         self.assertIs(None, bug.merge_proposal_status)
         self.assertIs(None, bug.merge_proposal_creation_date)
-        self.assertEqual([], bug.tags)
+        self.assertEqual((), bug.tags)
 
     def test_instantiate(self):
         """
@@ -47,7 +51,75 @@ class BugTest(TestCase):
         self.assertEqual("merge_url", bug.merge_proposal)
         self.assertEqual(NEEDS_REVIEW, bug.merge_proposal_status)
         self.assertEqual(now, bug.merge_proposal_creation_date)
-        self.assertEqual(["test"], bug.tags)
+        self.assertEqual(("test",), bug.tags)
+
+    def test_bug_is_compact(self):
+        """
+        L{Bug}s don't have an instance C{__dict__}, and statuses,
+        importances and tags are interned so bugs share a single copy of
+        each.
+        """
+        bug1 = Bug("1", "kanban", u"Medium", u"New", "A title",
+                   tags=[u"story-" + u"test"])
+        bug2 = Bug("2", "kanban", u"Medium", u"New", "A title",
+                   tags=[u"story-" + u"test"])
+        self.assertFalse(hasattr(bug1, "__dict__"))
+        self.assertIs(MEDIUM, bug1.importance)
+        self.assertIs(NEW, bug1.status)
+        self.assertIs(bug1.tags[0], bug2.tags[0])
+
+    def test_merge_proposal_status_is_interned(self):
+        """
+        Merge proposal statuses set after a L{Bug} is created are interned.
+        """
+        bug = Bug("1", "kanban", MEDIUM, IN_PROGRESS, "A title")
+        bug.merge_proposal_status = u"Needs " + u"review"
+        self.assertIs(NEEDS_REVIEW, bug.merge_proposal_status)
+
+    def test_equality(self):
+        """L{Bug}s with the same ID are equal and hash the same."""
+        bug1 = Bug("1", "kanban", MEDIUM, IN_PROGRESS, "A title")
+        bug2 = Bug("1", "storm", MEDIUM, NEW, "Another title")
+        bug3 = Bug("2", "kanban", MEDIUM, IN_PROGRESS, "A title")
+        self.assertTrue(bug1 == bug2)
+        self.assertFalse(bug1 != bug2)
+        self.assertEqual(hash(bug1), hash(bug2))
+        self.assertTrue(bug1 != bug3)
+        self.assertFalse(bug1 == bug3)
+        self.assertFalse(bug1 == "1")
+        self.assertEqual(2, len(set([bug1, bug2, bug3])))
+
+    def test_depends_on_merge_proposal(self):
+        """
+        L{Bug.depends_on_merge_proposal} returns C{True} for bugs that aren't
+        released or verified, because a merge proposal can move any of them
+        to another category.
+        """
+        for status in (NEW, CONFIRMED, TRIAGED, IN_PROGRESS, FIX_COMMITTED):
+            bug = Bug("1", "kanban", MEDIUM, status, "A title")
+            self.assertTrue(bug.depends_on_merge_proposal())
+
+    def test_queued_bug_depends_on_merge_proposal(self):
+        """
+        A queued L{Bug} with a merge proposal that needs review is in the
+        'Needs review' category, so it depends on its merge proposal.
+        """
+        bug = Bug("1", "kanban", MEDIUM, TRIAGED, "A title",
+                  merge_proposal="merge_url",
+                  merge_proposal_status=NEEDS_REVIEW)
+        self.assertEqual(NEEDS_REVIEW_CATEGORY, bug.get_category())
+        self.assertTrue(bug.depends_on_merge_proposal())
+
+    def test_does_not_depend_on_merge_proposal(self):
+        """
+        L{Bug.depends_on_merge_proposal} returns C{False} for verified and
+        released bugs.
+        """
+        bug = Bug("1", "kanban", MEDIUM, FIX_RELEASED, "A title")
+        self.assertFalse(bug.depends_on_merge_proposal())
+        bug = Bug("1", "kanban", MEDIUM, FIX_COMMITTED, "A title",
+                  tags=["verified"])
+        self.assertFalse(bug.depends_on_merge_proposal())
 
     def test_get_story_tags_without_matches(self):
         """
@@ -253,6 +325,39 @@ class BugTest(TestCase):
         self.assertFalse(bug.needs_release())
         self.assertTrue(bug.released())
 
+    def test_get_category(self):
+        """
+        L{Bug.get_category} returns the name of the category a L{Bug} is
+        in.
+        """
+        bugs = [(QUEUED_CATEGORY, Bug("1", "kanban", MEDIUM, NEW, "Title")),
+                (IN_PROGRESS_CATEGORY,
+                 Bug("2", "kanban", MEDIUM, IN_PROGRESS, "Title")),
+                (NEEDS_REVIEW_CATEGORY,
+                 Bug("3", "kanban", MEDIUM, IN_PROGRESS, "Title",
+                     merge_proposal="merge_url",
+                     merge_proposal_status=NEEDS_REVIEW)),
+                (NEEDS_TESTING_CATEGORY,
+                 Bug("4", "kanban", MEDIUM, FIX_COMMITTED, "Title")),
+                (NEEDS_RELEASE_CATEGORY,
+                 Bug("5", "kanban", MEDIUM, FIX_COMMITTED, "Title",
+                     tags=["verified"])),
+                (RELEASED_CATEGORY,
+                 Bug("6", "kanban", MEDIUM, FIX_RELEASED, "Title"))]
+        self.assertEqual([category for category, bug in bugs],
+                         [bug.get_category() for category, bug in bugs])
+
+    def test_get_category_with_merge_proposal_without_status(self):
+        """
+        A L{Bug} with a merge proposal that doesn't have a status isn't
+        categorized like a L{Bug} without a merge proposal.
+        """
+        bug1 = Bug("1", "kanban", MEDIUM, IN_PROGRESS, "A title")
+        bug2 = Bug("2", "kanban", MEDIUM, IN_PROGRESS, "A title",
+                   merge_proposal="merge_url")
+        self.assertEqual(IN_PROGRESS_CATEGORY, bug1.get_category())
+        self.assertEqual(QUEUED_CATEGORY, bug2.get_category())
+
 
 class CompareBugsTest(TestCase):
 
@@ -275,6 +380,32 @@ class CompareBugsTest(TestCase):
                 Bug("1", "kanban", UNDECIDED, FIX_RELEASED, "Alpha")]
         self.assertEquals(list(reversed(bugs)), sorted(bugs, compare_bugs))
 
+    def test_get_bug_sort_key(self):
+        """
+        L{get_bug_sort_key} sorts L{Bug}s in the same order as
+        L{compare_bugs}.
+        """
+        bugs = [Bug("3", "kanban", LOW, NEW, "A title"),
+                Bug("2", "kanban", CRITICAL, NEW, "A title"),
+                Bug("1", "kanban", LOW, NEW, "A title")]
+        self.assertEqual(sorted(bugs, compare_bugs),
+                         sorted(bugs, key=get_bug_sort_key))
+
+    def test_bugs_are_ordered(self):
+        """L{Bug}s can be sorted directly, in L{compare_bugs} order."""
+        bugs = [Bug("3", "kanban", LOW, NEW, "A title"),
+                Bug("2", "kanban", CRITICAL, NEW, "A title"),
+                Bug("1", "kanban", LOW, NEW, "A title")]
+        self.assertEqual(sorted(bugs, compare_bugs), sorted(bugs))
+        self.assertTrue(bugs[1] < bugs[0])
+        self.assertFalse(bugs[0] < bugs[2])
+
+    def test_unknown_importance_is_sorted_last(self):
+        """L{Bug}s with an unknown importance are sorted last."""
+        bugs = [Bug("1", "kanban", "Unknown", NEW, "A title"),
+                Bug("2", "kanban", UNDECIDED, NEW, "A title")]
+        self.assertEqual(list(reversed(bugs)), sorted(bugs))
+
 
 class BugCollectionMixinTestBase(object):
 
@@ -402,6 +533,54 @@ class BugCollectionMixinTestBase(object):
         self.assertEqual([], kanban_board.needs_release)
         self.assertEqual([bug], kanban_board.released)
 
+    def test_add_keeps_bugs_sorted(self):
+        """
+        L{Bug}s can be added in any order.  They're stored in
+        L{compare_bugs} order in L{BugCollectionMixin.bugs} and in each
+        category.
+        """
+        bug1 = Bug("1", "kanban", LOW, NEW, "A title")
+        bug2 = Bug("2", "kanban", HIGH, NEW, "A title")
+        bug3 = Bug("3", "kanban", LOW, NEW, "A title")
+        bug4 = Bug("4", "kanban", CRITICAL, FIX_RELEASED, "A title")
+        kanban_board = self.create_test_class()
+        for bug in [bug3, bug1, bug4, bug2]:
+            kanban_board.add(bug)
+        self.assertEqual([bug4, bug2, bug1, bug3], kanban_board.bugs)
+        self.assertEqual([bug2, bug1, bug3], kanban_board.queued)
+        self.assertEqual([bug4], kanban_board.released)
+
+    def test_add_after_reading_views(self):
+        """
+        The views of a L{BugCollectionMixin} include L{Bug}s added after
+        they were last read.
+        """
+        bug1 = Bug("1", "kanban", LOW, NEW, "A title")
+        bug2 = Bug("2", "kanban", HIGH, NEW, "A title")
+        kanban_board = self.create_test_class()
+        kanban_board.add(bug1)
+        self.assertEqual([bug1], kanban_board.queued)
+        kanban_board.add(bug2)
+        self.assertEqual([bug2, bug1], kanban_board.bugs)
+        self.assertEqual([bug2, bug1], kanban_board.queued)
+
+    def test_views_include_bugs_added_later(self):
+        """
+        The views of a L{BugCollectionMixin} aren't copies, so a view read
+        before a L{Bug} is added includes it.
+        """
+        bug1 = Bug("1", "kanban", LOW, NEW, "A title")
+        bug2 = Bug("2", "kanban", HIGH, NEW, "A title")
+        kanban_board = self.create_test_class()
+        kanban_board.add(bug1)
+        bugs = kanban_board.bugs
+        queued = kanban_board.queued
+        kanban_board.add(bug2)
+        self.assertEqual([bug2, bug1], bugs)
+        self.assertEqual([bug2, bug1], queued)
+        self.assertEqual(bug2, queued[0])
+        self.assertEqual(2, len(queued))
+
 
 class StoryCollectionMixinTestBase(object):
 
@@ -417,7 +596,7 @@ class StoryCollectionMixinTestBase(object):
         self.assertEqual([bug], kanban_board.bugs)
         self.assertEqual(1, len(kanban_board.stories))
         story = kanban_board.stories[0]
-        self.assertIs("story-test", story.name)
+        self.assertEqual("story-test", story.name)
         self.assertEqual([bug], story.queued)
         self.assertEqual([], story.in_progress)
         self.assertEqual([], story.needs_review)
@@ -438,7 +617,7 @@ class StoryCollectionMixinTestBase(object):
         kanban_board.add(bug2)
         self.assertEqual(1, len(kanban_board.stories))
         story = kanban_board.stories[0]
-        self.assertIs("story-test", story.name)
+        self.assertEqual("story-test", story.name)
         self.assertEqual([bug1, bug2], story.queued)
         self.assertEqual([], story.in_progress)
         self.assertEqual([], story.needs_review)
@@ -458,13 +637,48 @@ class StoryCollectionMixinTestBase(object):
         self.assertEqual(2, len(kanban_board.stories))
 
         story1 = kanban_board.stories[0]
-        self.assertIs("story-test1", story1.name)
+        self.assertEqual("story-test1", story1.name)
         self.assertEqual([bug], story1.queued)
 
         story2 = kanban_board.stories[1]
-        self.assertIs("story-test2", story2.name)
+        self.assertEqual("story-test2", story2.name)
         self.assertEqual([bug], story2.queued)
 
+    def test_add_bug_categorizes_it_once(self):
+        """
+        A L{Bug} added to a L{StoryCollectionMixin} is only categorized once,
+        even though it's shown in several L{Story}s too.
+        """
+        calls = []
+        categorize = Bug._categorize
+
+        def counting_categorize(bug):
+            calls.append(bug)
+            return categorize(bug)
+
+        self.patch(Bug, "_categorize", counting_categorize)
+        self.patch(board, "_categories", {})
+        bug = Bug("1", "kanban", MEDIUM, NEW, "A title",
+                  tags=["story-test1", "story-test2"])
+        kanban_board = self.create_test_class()
+        kanban_board.add(bug)
+        self.assertEqual([bug], kanban_board.queued)
+        for story in kanban_board.stories:
+            self.assertEqual([bug], story.queued)
+        self.assertEqual([bug], calls)
+
+    def test_stories_share_bugs(self):
+        """
+        L{Story}s don't keep their own copies of the L{Bug}s added to a
+        L{StoryCollectionMixin}, they only record where to find them.
+        """
+        kanban_board = self.create_test_class()
+        kanban_board.add(Bug("1", "kanban", MEDIUM, NEW, "A title",
+                             tags=["story-test1", "story-test2"]))
+        for story in kanban_board.stories:
+            self.assertIs(kanban_board._all_bugs, story._all_bugs)
+            self.assertEqual([0], list(story._indexes))
+
     def test_stories_sorting(self):
         """
         The L{StoryCollectionMixin.stories} property sorts L{Story}s
@@ -480,6 +694,26 @@ class StoryCollectionMixinTestBase(object):
         self.assertEqual(["story-test1", "story-test2", None],
                          [story.name for story in kanban_board.stories])
 
+    def test_stories_are_cached(self):
+        """
+        The sorted list of L{Story}s is only rebuilt when a new L{Story} is
+        created.
+        """
+        kanban_board = self.create_test_class()
+        kanban_board.add(Bug("1", "kanban", MEDIUM, NEW, "A title",
+                             tags=["story-zebra"]))
+        stories = kanban_board.stories
+        kanban_board.add(Bug("2", "kanban", MEDIUM, NEW, "A title",
+                             tags=["story-zebra"]))
+        self.assertIs(stories, kanban_board.stories)
+        kanban_board.add(Bug("3", "kanban", MEDIUM, NEW, "A title",
+                             tags=["story-alpha"]))
+        self.assertEqual(["story-alpha", "story-zebra"],
+                         [story.name for story in kanban_board.stories])
+        kanban_board.add(Bug("4", "kanban", MEDIUM, NEW, "A title"))
+        self.assertEqual(["story-alpha", "story-zebra", None],
+                         [story.name for story in kanban_board.stories])
+
     def test_add_considers_include_needs_testing(self):
         """
         If a L{Bug} with a C{story-<name>} tag is added to a
@@ -515,8 +749,18 @@ class MilestoneBoardTest(BugCollectionMixinTestBase,
         kanban_board = MilestoneBoard("project", "milestone")
         self.assertEqual("project", kanban_board.project_name)
         self.assertEqual("milestone", kanban_board.name)
+        self.assertEqual([("project", "milestone")], kanban_board.milestones)
         self.assertEqual([], kanban_board.stories)
 
+    def test_instantiate_with_milestones(self):
+        """
+        A L{MilestoneBoard} can be given a list of every milestone it shows.
+        """
+        milestones = [("project", "milestone"), ("other", "1.0")]
+        kanban_board = MilestoneBoard("project", "milestone",
+                                      milestones=milestones)
+        self.assertEqual(milestones, kanban_board.milestones)
+
 
 class PersonBoardTest(BugCollectionMixinTestBase, StoryCollectionMixinTestBase,
                       TestCase):
@@ -557,3 +801,12 @@ class CompareStoriesTest(TestCase):
         stories = [Story(None), Story("story-zebra"), Story("story-alpha")]
         self.assertEquals(list(reversed(stories)),
                           sorted(stories, compare_stories))
+
+    def test_get_story_sort_key(self):
+        """
+        L{get_story_sort_key} sorts L{Story}s in the same order as
+        L{compare_stories}.
+        """
+        stories = [Story(None), Story("story-zebra"), Story("story-alpha")]
+        self.assertEquals(list(reversed(stories)),
+                          sorted(stories, key=get_story_sort_key))
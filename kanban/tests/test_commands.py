@@ -0,0 +1,172 @@
+from cStringIO import StringIO
+from datetime import datetime
+import os
+from shutil import rmtree
+import subprocess
+import sys
+from tempfile import mkdtemp
+
+from testtools import TestCase
+
+from kanban import launchpad
+from kanban.board import Bug, MEDIUM, NEW
+from kanban.commands import (
+    LaunchpadMixin, cmd_generate_milestone_kanban, cmd_generate_person_kanban)
+from kanban.snapshot import (
+    SnapshotStore, UTC, get_milestone_scope, get_person_scope)
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# Modules that are slow to import and aren't needed to show help.
+HEAVY_MODULES = ["launchpadlib", "lazr.restfulclient", "httplib2", "jinja2",
+                 "sqlite3", "kanban.launchpad", "kanban.html",
+                 "kanban.snapshot"]
+
+
+class StartupTest(TestCase):
+
+    def test_load_commands(self):
+        """
+        Loading the command modules, as kanban does every time it runs,
+        doesn't import modules that are slow to import.
+        """
+        script = ("import sys\n"
+                  "from kanban import commands, entry_point, help_topics\n"
+                  "print '\\n'.join(sys.modules)\n")
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         cwd=ROOT)
+        modules = set(output.splitlines())
+        self.assertIn("kanban.commands", modules)
+        self.assertEqual([], [name for name in HEAVY_MODULES
+                              if name in modules])
+
+
+class OfflineTest(TestCase):
+
+    def setUp(self):
+        super(OfflineTest, self).setUp()
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.directory = directory
+        self.path = os.path.join(directory, "snapshot.db")
+        self.patch(launchpad, "get_snapshot_store",
+                   lambda: SnapshotStore(self.path))
+
+        def get_launchpad(command, *args, **kwargs):
+            raise AssertionError("Launchpad was contacted.")
+
+        self.patch(LaunchpadMixin, "get_launchpad", get_launchpad)
+
+    def put_bugs(self, scope, bugs):
+        """Store C{bugs} in a snapshot of C{scope}, as a sync would."""
+        store = SnapshotStore(self.path)
+        try:
+            for bug in bugs:
+                store.put_bug(scope, unicode(bug.id), bug)
+            store.set_last_sync(scope, datetime.now(UTC))
+            store.commit()
+        finally:
+            store.close()
+
+    def run_command(self, command, *args, **kwargs):
+        """Run C{command} and return the HTML it writes."""
+        command.outf = StringIO()
+        command.run(*args, **kwargs)
+        return command.outf.getvalue()
+
+    def test_milestone_kanban(self):
+        """
+        With --offline, the milestone board is built from the snapshot
+        without contacting Launchpad.
+        """
+        self.put_bugs(get_milestone_scope("kanban", "1.0"),
+                      [Bug(1, "kanban", MEDIUM, NEW, "Snapshot bug")])
+        html = self.run_command(cmd_generate_milestone_kanban(), "kanban",
+                                "1.0", offline=True)
+        self.assertIn("Snapshot bug", html)
+
+    def test_milestones_kanban_without_duplicates(self):
+        """
+        A bug targetted to several of the milestones on an offline board is
+        only shown once.
+        """
+        bug1 = Bug(1, "kanban", MEDIUM, NEW, "Shared bug")
+        bug2 = Bug(2, "storm", MEDIUM, NEW, "Storm bug")
+        self.put_bugs(get_milestone_scope("kanban", "1.0"), [bug1])
+        self.put_bugs(get_milestone_scope("storm", "0.19"), [bug1, bug2])
+        command = cmd_generate_milestone_kanban()
+        store = SnapshotStore(self.path)
+        self.addCleanup(store.close)
+        bugs = command.get_offline_milestones_bugs(
+            store, [("kanban", "1.0"), ("storm", "0.19")])
+        self.assertEqual([1, 2], [bug.id for bug in bugs])
+        html = self.run_command(command, "kanban", "1.0", ["storm:0.19"],
+                                offline=True)
+        self.assertEqual(1, html.count("Shared bug"))
+        self.assertIn("Storm bug", html)
+
+    def test_person_kanban(self):
+        """
+        With --offline, the person board is built from the snapshot without
+        contacting Launchpad.
+        """
+        self.put_bugs(get_person_scope("jkakar"),
+                      [Bug(1, "kanban", MEDIUM, NEW, "Snapshot bug")])
+        html = self.run_command(cmd_generate_person_kanban(), "jkakar",
+                                offline=True)
+        self.assertIn("Snapshot bug", html)
+
+    def test_milestone_kanban_without_snapshot(self):
+        """
+        An error is raised if a milestone hasn't been synced before.
+        """
+        self.put_bugs(get_milestone_scope("kanban", "1.0"),
+                      [Bug(1, "kanban", MEDIUM, NEW, "Snapshot bug")])
+        error = self.assertRaises(
+            RuntimeError, self.run_command, cmd_generate_milestone_kanban(),
+            "kanban", "1.0", ["2.0"], offline=True)
+        self.assertIn("Run this command without --offline first",
+                      str(error))
+
+    def test_person_kanban_without_snapshot(self):
+        """An error is raised if a person hasn't been synced before."""
+        self.assertRaises(RuntimeError, self.run_command,
+                          cmd_generate_person_kanban(), "jkakar",
+                          offline=True)
+
+    def test_milestone_kanban_with_incremental(self):
+        """--offline can't be combined with --incremental."""
+        self.put_bugs(get_milestone_scope("kanban", "1.0"), [])
+        error = self.assertRaises(
+            RuntimeError, self.run_command, cmd_generate_milestone_kanban(),
+            "kanban", "1.0", offline=True, incremental=True)
+        self.assertEqual("--offline can't be used with --incremental.",
+                         str(error))
+
+    def test_milestone_kanban_with_record(self):
+        """
+        --offline can't be combined with --record, and no fixture file is
+        written.
+        """
+        self.put_bugs(get_milestone_scope("kanban", "1.0"), [])
+        path = os.path.join(self.directory, "fixture.json")
+        error = self.assertRaises(
+            RuntimeError, self.run_command, cmd_generate_milestone_kanban(),
+            "kanban", "1.0", offline=True, incremental=True, record=path)
+        self.assertEqual(
+            "--offline can't be used with --incremental, --record.",
+            str(error))
+        self.assertFalse(os.path.exists(path))
+
+    def test_person_kanban_with_record(self):
+        """--offline can't be combined with --record."""
+        self.put_bugs(get_person_scope("jkakar"), [])
+        path = os.path.join(self.directory, "fixture.json")
+        error = self.assertRaises(
+            RuntimeError, self.run_command, cmd_generate_person_kanban(),
+            "jkakar", offline=True, record=path)
+        self.assertEqual("--offline can't be used with --record.",
+                         str(error))
+        self.assertFalse(os.path.exists(path))
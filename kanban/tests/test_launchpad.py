@@ -0,0 +1,1681 @@
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+import json
+from multiprocessing.pool import ThreadPool
+import os
+from random import random
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import sleep, time
+from urlparse import parse_qsl, urlparse
+
+from httplib2 import Response
+from launchpadlib.launchpad import LaunchpadOAuthAwareHttp
+from lazr.restfulclient._browser import MultipleRepresentationCache
+from lazr.restfulclient.errors import HTTPError
+from lazr.restfulclient.resource import Collection
+from testtools import TestCase
+
+from kanban import launchpad
+from kanban.board import (
+    APPROVED, CRITICAL, HIGH, LOW, MEDIUM, NEW, INVALID, IN_PROGRESS,
+    FIX_COMMITTED, FIX_RELEASED, NEEDS_REVIEW, MilestoneBoard)
+from kanban.launchpad import (
+    BRANCH_CACHE_TTL, OPEN_STATUSES, RESOURCE_INDEX_TTL, BranchCache,
+    HttpRecording, HttpWrapper, InstrumentedHttp, KanbanLaunchpad,
+    PooledHttp, RecordingHttp,
+    ReplayingHttp, RequestScheduler, RequestStats, ScheduledHttp,
+    ServiceRootCache, HEALTHY_LATENCY, MAX_CONCURRENCY, MAX_RETRIES,
+    SHARD_ORDER, _create_bug, _create_bugs, _merge_sorted, get_call_site,
+    get_member_milestones, get_milestone, get_page_links, iter_collection,
+    get_person_assigned_bugs, get_person_directly_assigned_bugs,
+    get_percentile, sync_milestone_bugs, sync_milestones_bugs,
+    sync_person_bugs)
+from kanban.snapshot import (
+    SnapshotStore, UTC, get_milestone_scope, get_person_scope, load_date)
+
+
+class FakeResponse(object):
+    """A fake HTTP response with just enough state for L{HTTPError}."""
+
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeLinkedBranches(object):
+    """A collection of linked branches that raises an L{HTTPError}."""
+
+    def __init__(self, status):
+        self.status = status
+
+    def __iter__(self):
+        raise HTTPError(FakeResponse(self.status), "")
+
+
+class FakeObject(object):
+    """A fake Launchpad resource with arbitrary attributes."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeLinkedBranch(object):
+    """A fake linked branch that counts the times its branch is loaded."""
+
+    def __init__(self, branch_link, branch):
+        self.branch_link = branch_link
+        self._branch = branch
+        self.loads = 0
+
+    @property
+    def branch(self):
+        self.loads += 1
+        return self._branch
+
+
+class FakeBugTask(FakeObject):
+    """A fake bug task that optionally sleeps when its bug is loaded."""
+
+    def __init__(self, bug, delay=None, **kwargs):
+        super(FakeBugTask, self).__init__(**kwargs)
+        self._bug = bug
+        self._delay = delay
+
+    @property
+    def bug(self):
+        if self._delay:
+            sleep(self._delay)
+        return self._bug
+
+
+def create_bug_task(id, status=NEW, linked_branches=None, delay=None,
+                    title=None, importance=MEDIUM, tags=None):
+    """Create a L{FakeBugTask} for a bug with the specified C{id}."""
+    bug = FakeObject(id=id, title=title or "Bug %d" % id,
+                     tags=tags or ["tag"],
+                     linked_branches=linked_branches or [])
+    self_link = "https://api.launchpad.net/1.0/kanban/+bug/%d" % id
+    bug_link = "https://api.launchpad.net/1.0/bugs/%d" % id
+    assignee_link = "https://api.launchpad.net/1.0/~jkakar"
+    return FakeBugTask(bug, delay=delay, assignee_link=assignee_link,
+                       date_in_progress=None, bug_target_name="kanban",
+                       importance=importance, status=status,
+                       self_link=self_link,
+                       bug_link=bug_link)
+
+
+class FakePerson(FakeObject):
+    """A fake person or team that can be searched for bug tasks."""
+
+    def __init__(self, name, bug_tasks=None, participants=None):
+        super(FakePerson, self).__init__(name=name)
+        self.bug_tasks = bug_tasks or []
+        self.participants = participants or []
+        self.searches = []
+
+    def searchTasks(self, status, assignee, **kwargs):
+        kwargs.update(status=status, assignee=assignee)
+        self.searches.append(kwargs)
+        return [bug_task for bug_task in self.bug_tasks
+                if bug_task.status in status]
+
+
+class FakeMilestone(object):
+    """A fake milestone that records the searches made against it."""
+
+    def __init__(self, bug_tasks=None):
+        self.bug_tasks = bug_tasks or []
+        self.searches = []
+
+    def searchTasks(self, **kwargs):
+        self.searches.append(kwargs)
+        return list(self.bug_tasks)
+
+
+class FakeLaunchpad(object):
+    """A fake Launchpad instance that can load milestones by URL."""
+
+    def __init__(self, milestones=None):
+        self.milestones = milestones or {}
+        self.loaded = []
+        self._wadl = "wadl"
+
+    def load(self, url):
+        self.loaded.append(url)
+        try:
+            return self.milestones[url]
+        except KeyError:
+            raise HTTPError(FakeResponse(404), "")
+
+    def _create_bound_resource(self, root, wadl_resource):
+        return FakeObject(root=root, wadl_resource=wadl_resource)
+
+
+class FakeHttp(object):
+    """A fake C{httplib2.Http} that returns canned responses."""
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.requests = []
+        self.cache = "cache"
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.requests.append((uri, method, body, headers))
+        return self.responses[uri]
+
+
+class CreateBugTest(TestCase):
+
+    def test_create_bug(self):
+        """
+        L{_create_bug} creates a L{Bug} from a Launchpad bug task, using
+        details from the bug, its assignee and its linked branches.
+        """
+        now = datetime.utcnow()
+        merge_proposal = FakeObject(date_created=now,
+                                    queue_status=NEEDS_REVIEW,
+                                    web_link="merge_url")
+        branch = FakeObject(bzr_identity="lp:~jkakar/kanban/branch",
+                            landing_targets=[merge_proposal])
+        bug_task = create_bug_task(
+            1, status=IN_PROGRESS,
+            linked_branches=[FakeObject(branch=branch,
+                                        branch_link="branch_link")])
+        bug = _create_bug(bug_task)
+        self.assertEqual(1, bug.id)
+        self.assertEqual("kanban", bug.project)
+        self.assertEqual(MEDIUM, bug.importance)
+        self.assertEqual(IN_PROGRESS, bug.status)
+        self.assertEqual("Bug 1", bug.title)
+        self.assertEqual("jkakar", bug.assignee)
+        self.assertEqual("lp:~jkakar/kanban/branch", bug.branch)
+        self.assertEqual("merge_url", bug.merge_proposal)
+        self.assertEqual(NEEDS_REVIEW, bug.merge_proposal_status)
+        self.assertEqual(now, bug.merge_proposal_creation_date)
+        self.assertEqual(("tag",), bug.tags)
+
+    def test_create_bug_without_assignee(self):
+        """
+        The assignee of a L{Bug} is C{None} if its bug task isn't assigned.
+        """
+        bug_task = create_bug_task(1)
+        bug_task.assignee_link = None
+        self.assertIs(None, _create_bug(bug_task).assignee)
+
+    def test_create_bug_uses_links(self):
+        """
+        The ID and assignee of a L{Bug} are read from the links in the bug
+        task's representation, without loading the bug or person.
+        """
+        bug_task = create_bug_task(1)
+        bug_task.bug_link = "https://api.launchpad.net/1.0/bugs/42"
+        bug_task.assignee_link = "https://api.launchpad.net/1.0/~mbp"
+        bug = _create_bug(bug_task)
+        self.assertEqual(42, bug.id)
+        self.assertEqual("mbp", bug.assignee)
+
+    def test_create_bug_with_forbidden_linked_branches(self):
+        """
+        Linked branches are skipped if Launchpad responds with a 401 or 403
+        error while they're being loaded.
+        """
+        for status in (401, 403):
+            bug_task = create_bug_task(
+                1, status=IN_PROGRESS,
+                linked_branches=FakeLinkedBranches(status))
+            bug = _create_bug(bug_task)
+            self.assertEqual(1, bug.id)
+            self.assertIs(None, bug.branch)
+
+    def test_create_bug_with_linked_branches_error(self):
+        """
+        Errors other than 401 and 403 raised while loading linked branches
+        are not suppressed.
+        """
+        bug_task = create_bug_task(
+            1, status=IN_PROGRESS, linked_branches=FakeLinkedBranches(500))
+        self.assertRaises(HTTPError, _create_bug, bug_task)
+
+    def test_create_bug_without_loading_linked_branches(self):
+        """
+        Linked branches aren't loaded for released or verified bugs, whose
+        category doesn't depend on their merge proposal.
+        """
+        for status, tags in [(FIX_RELEASED, None),
+                             (FIX_COMMITTED, ["verified"])]:
+            bug_task = create_bug_task(
+                1, status=status, tags=tags,
+                linked_branches=FakeLinkedBranches(500))
+            bug = _create_bug(bug_task)
+            self.assertIs(None, bug.branch)
+            self.assertIs(None, bug.merge_proposal)
+
+    def test_create_queued_bug_loads_linked_branches(self):
+        """
+        Linked branches are loaded for queued bugs, so their branch is shown
+        and a merge proposal that needs review puts them in the 'Needs
+        review' category.
+        """
+        merge_proposal = FakeObject(date_created=datetime.utcnow(),
+                                    queue_status=NEEDS_REVIEW,
+                                    web_link="merge_url")
+        branch = FakeObject(bzr_identity="lp:~jkakar/kanban/branch",
+                            landing_targets=[merge_proposal])
+        bug_task = create_bug_task(
+            1, status=NEW,
+            linked_branches=[FakeObject(branch=branch,
+                                        branch_link="branch_link")])
+        bug = _create_bug(bug_task)
+        self.assertEqual("lp:~jkakar/kanban/branch", bug.branch)
+        self.assertEqual(NEEDS_REVIEW, bug.merge_proposal_status)
+        self.assertEqual("needs_review", bug.get_category())
+
+    def test_create_bug_with_branch_cache(self):
+        """
+        Branch details are resolved once for each branch in a
+        L{BranchCache}, no matter how many bugs link the branch.
+        """
+        branch = FakeObject(bzr_identity="lp:~jkakar/kanban/branch",
+                            landing_targets=[])
+        linked_branch = FakeLinkedBranch("branch_link", branch)
+        branch_cache = BranchCache()
+        for id in (1, 2):
+            bug_task = create_bug_task(id, status=IN_PROGRESS,
+                                       linked_branches=[linked_branch])
+            bug = _create_bug(bug_task, branch_cache)
+            self.assertEqual("lp:~jkakar/kanban/branch", bug.branch)
+            self.assertIs(None, bug.merge_proposal)
+        self.assertEqual(1, linked_branch.loads)
+
+
+class BranchCacheTest(TestCase):
+
+    def setUp(self):
+        super(BranchCacheTest, self).setUp()
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.store = SnapshotStore(os.path.join(directory, "snapshot.db"))
+        self.addCleanup(self.store.close)
+        self.details = ("lp:kanban", None, None, None)
+
+    def test_resolve(self):
+        """
+        L{BranchCache.resolve} calls the function provided to get details
+        for a branch the first time it's resolved, and returns the cached
+        details after that.
+        """
+        calls = []
+
+        def resolve():
+            calls.append(True)
+            return self.details
+
+        branch_cache = BranchCache()
+        self.assertEqual(self.details,
+                         branch_cache.resolve("branch_link", resolve))
+        self.assertEqual(self.details,
+                         branch_cache.resolve("branch_link", resolve))
+        self.assertEqual(1, len(calls))
+
+    def test_resolve_concurrently(self):
+        """
+        A branch is only resolved once when several threads resolve it at
+        the same time.
+        """
+        calls = []
+
+        def resolve():
+            calls.append(True)
+            sleep(0.01)
+            return self.details
+
+        branch_cache = BranchCache()
+        pool = ThreadPool(4)
+        self.addCleanup(pool.terminate)
+        results = pool.map(
+            lambda i: branch_cache.resolve("branch_link", resolve), range(8))
+        self.assertEqual([self.details] * 8, results)
+        self.assertEqual(1, len(calls))
+
+    def test_load(self):
+        """
+        L{BranchCache.load} creates a cache with the details kept in a
+        L{SnapshotStore}.
+        """
+        self.store.put_branch("branch_link", self.details, datetime.now(UTC))
+        branch_cache = BranchCache.load(self.store)
+        self.assertEqual(self.details,
+                         branch_cache.resolve("branch_link", None))
+
+    def test_load_ignores_expired_details(self):
+        """
+        Details stored longer ago than L{BRANCH_CACHE_TTL} aren't loaded.
+        """
+        date = datetime.now(UTC) - BRANCH_CACHE_TTL - timedelta(minutes=1)
+        self.store.put_branch("branch_link", self.details, date)
+        branch_cache = BranchCache.load(self.store)
+        details = ("lp:~jkakar/kanban/branch", None, None, None)
+        self.assertEqual(details,
+                         branch_cache.resolve("branch_link", lambda: details))
+
+    def test_save(self):
+        """
+        L{BranchCache.save} stores the details that were resolved in a
+        L{SnapshotStore}.
+        """
+        branch_cache = BranchCache()
+        branch_cache.resolve("branch_link", lambda: self.details)
+        branch_cache.save(self.store)
+        self.assertEqual({"branch_link": self.details},
+                         self.store.get_branches())
+
+
+class GetMilestoneTest(TestCase):
+
+    def setUp(self):
+        super(GetMilestoneTest, self).setUp()
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.store = SnapshotStore(os.path.join(directory, "snapshot.db"))
+        self.addCleanup(self.store.close)
+        self.milestone = FakeObject(
+            self_link="https://api.launchpad.net/1.0/kanban/+milestone/1.0",
+            resource_type_link="https://api.launchpad.net/1.0/#milestone")
+        self.launchpad = FakeLaunchpad({"kanban/+milestone/1.0":
+                                        self.milestone})
+        self.patch(launchpad, "WadlResource",
+                   lambda application, url, resource_type: (
+                       application, url, resource_type))
+
+    def test_get_milestone(self):
+        """
+        L{get_milestone} loads a milestone directly from its URL in
+        Launchpad.
+        """
+        self.assertIs(self.milestone,
+                      get_milestone(self.launchpad, "kanban", "1.0"))
+        self.assertEqual(["kanban/+milestone/1.0"], self.launchpad.loaded)
+
+    def test_get_unknown_milestone(self):
+        """
+        L{get_milestone} returns C{None} if the milestone doesn't exist.
+        """
+        self.assertIs(None, get_milestone(self.launchpad, "kanban", "2.0"))
+
+    def test_get_milestone_remembers_link(self):
+        """
+        When a L{SnapshotStore} is provided the links for a milestone are
+        stored in it.
+        """
+        get_milestone(self.launchpad, "kanban", "1.0", store=self.store)
+        self.assertEqual(
+            (self.milestone.self_link, self.milestone.resource_type_link),
+            self.store.get_resource(get_milestone_scope("kanban", "1.0")))
+
+    def test_get_milestone_with_remembered_link(self):
+        """
+        A milestone with a remembered link is created without making any
+        requests to Launchpad.
+        """
+        get_milestone(self.launchpad, "kanban", "1.0", store=self.store)
+        milestone = get_milestone(self.launchpad, "kanban", "1.0",
+                                  store=self.store)
+        self.assertEqual(1, len(self.launchpad.loaded))
+        self.assertIs(self.launchpad, milestone.root)
+        self.assertEqual(("wadl", self.milestone.self_link,
+                          self.milestone.resource_type_link),
+                         milestone.wadl_resource)
+
+    def test_get_milestone_with_expired_link(self):
+        """Remembered links expire after L{RESOURCE_INDEX_TTL}."""
+        self.store.put_resource(
+            get_milestone_scope("kanban", "1.0"), "old_link", "type_link",
+            datetime.now(UTC) - RESOURCE_INDEX_TTL - timedelta(seconds=1))
+        milestone = get_milestone(self.launchpad, "kanban", "1.0",
+                                  store=self.store)
+        self.assertIs(self.milestone, milestone)
+        self.assertEqual(["kanban/+milestone/1.0"], self.launchpad.loaded)
+
+    def test_get_member_milestones(self):
+        """
+        L{get_member_milestones} gets the milestone with the specified name
+        from each project in a project group.  Projects without the
+        milestone are skipped.
+        """
+        project_group = FakeObject(
+            resource_type_link="https://api.launchpad.net/1.0/"
+                               "#project_group",
+            projects=[FakeObject(name="kanban"), FakeObject(name="storm")])
+        self.launchpad.project_groups = {"group": project_group}
+        self.assertEqual(
+            [self.milestone],
+            get_member_milestones(self.launchpad, "group", "1.0"))
+
+    def test_get_member_milestones_without_project_group(self):
+        """
+        L{get_member_milestones} returns C{None} if the name isn't the name
+        of a project group.
+        """
+        self.launchpad.project_groups = {}
+        self.assertIs(None,
+                      get_member_milestones(self.launchpad, "kanban", "1.0"))
+
+
+class CreateBugsTest(TestCase):
+
+    def test_create_bugs(self):
+        """L{_create_bugs} yields a L{Bug} for each bug task provided."""
+        bug_tasks = [create_bug_task(1), create_bug_task(2)]
+        self.assertEqual([1, 2], [bug.id for bug in _create_bugs(bug_tasks)])
+
+    def test_create_bugs_concurrently_preserves_order(self):
+        """
+        When bug tasks are hydrated by several workers L{Bug}s are still
+        yielded in the same order as the bug tasks they were created from.
+        """
+        bug_tasks = [create_bug_task(id, delay=random() / 100)
+                     for id in range(20)]
+        bugs = _create_bugs(bug_tasks, jobs=4)
+        self.assertEqual(range(20), [bug.id for bug in bugs])
+
+    def test_create_bugs_concurrently_with_forbidden_linked_branches(self):
+        """
+        Bug tasks with forbidden linked branches are still hydrated when
+        several workers are used.
+        """
+        linked_branches = FakeLinkedBranches(403)
+        bug_tasks = [create_bug_task(1),
+                     create_bug_task(2, linked_branches=linked_branches),
+                     create_bug_task(3)]
+        bugs = _create_bugs(bug_tasks, jobs=2)
+        self.assertEqual([1, 2, 3], [bug.id for bug in bugs])
+
+    def test_create_bugs_concurrently_raises_errors(self):
+        """
+        Errors raised by a worker while a bug task is being hydrated are
+        raised by L{_create_bugs}.
+        """
+        linked_branches = FakeLinkedBranches(500)
+        bug_tasks = [create_bug_task(1),
+                     create_bug_task(2, status=IN_PROGRESS,
+                                     linked_branches=linked_branches)]
+        bugs = _create_bugs(bug_tasks, jobs=2)
+        self.assertRaises(HTTPError, list, bugs)
+
+
+class GetPersonAssignedBugsTest(TestCase):
+
+    def setUp(self):
+        super(GetPersonAssignedBugsTest, self).setUp()
+        self.stderr = StringIO()
+        self.patch(sys, "stderr", self.stderr)
+
+    def create_launchpad(self, person):
+        """Create a fake Launchpad instance that knows about C{person}."""
+        return FakeObject(people={person.name: person})
+
+    def test_get_person_assigned_bugs(self):
+        """
+        L{get_person_assigned_bugs} returns the bugs assigned to a person and
+        reports its progress on stderr.
+        """
+        person = FakePerson("jkakar", [create_bug_task(1)])
+        bugs = get_person_assigned_bugs(self.create_launchpad(person),
+                                        "jkakar")
+        self.assertEqual([1], [bug.id for bug in bugs])
+        self.assertEqual("Found 1 bugs for jkakar (1/1)\n",
+                         self.stderr.getvalue())
+
+    def test_get_team_assigned_bugs(self):
+        """
+        When a team is provided the bugs assigned to each of its participants
+        are included.
+        """
+        participants = [FakePerson("member%d" % i, [create_bug_task(i)])
+                        for i in range(1, 6)]
+        team = FakePerson("team", participants=participants)
+        bugs = get_person_assigned_bugs(self.create_launchpad(team), "team")
+        self.assertEqual([1, 2, 3, 4, 5], sorted(bug.id for bug in bugs))
+        self.assertEqual(6, len(self.stderr.getvalue().splitlines()))
+
+    def test_get_team_assigned_bugs_with_fan_out(self):
+        """
+        Team participants can be searched concurrently.  Results are merged
+        as each search completes.
+        """
+        participants = [
+            FakePerson("member%d" % i,
+                       [create_bug_task(i, delay=random() / 100)])
+            for i in range(1, 11)]
+        team = FakePerson("team", participants=participants)
+        bugs = get_person_assigned_bugs(self.create_launchpad(team), "team",
+                                        fan_out=4)
+        self.assertEqual(range(1, 11), sorted(bug.id for bug in bugs))
+        lines = self.stderr.getvalue().splitlines()
+        self.assertEqual(11, len(lines))
+        self.assertTrue(lines[-1].endswith("(11/11)"))
+
+    def test_get_team_assigned_bugs_without_duplicates(self):
+        """
+        A bug reached through several participants is only hydrated once.
+        """
+        participants = [FakePerson("member1",
+                                   [create_bug_task(1), create_bug_task(2)]),
+                        FakePerson("member2", [create_bug_task(1)])]
+        team = FakePerson("team", [create_bug_task(2)],
+                          participants=participants)
+        bugs = get_person_assigned_bugs(self.create_launchpad(team), "team",
+                                        fan_out=2)
+        self.assertEqual([1, 2], sorted(bug.id for bug in bugs))
+
+
+class GetPersonDirectlyAssignedBugsTest(TestCase):
+
+    def assertCutoff(self, expected, modified_since):
+        """
+        Assert that the C{modified_since} value passed to a search is within
+        a minute of the C{expected} date.
+        """
+        cutoff = load_date(modified_since[:26])
+        self.assertTrue(abs(cutoff - expected) < timedelta(minutes=1))
+
+    def test_get_person_directly_assigned_bugs(self):
+        """
+        L{get_person_directly_assigned_bugs} searches for open bug tasks and
+        for 'Fix Released' bug tasks modified within the last 31 days.
+        """
+        now = datetime.now(UTC)
+        bug_task1 = create_bug_task(1)
+        bug_task2 = create_bug_task(2, status=FIX_RELEASED)
+        bug_task2.date_closed = now - timedelta(days=2)
+        person = FakePerson("jkakar", [bug_task1, bug_task2])
+        bugs = get_person_directly_assigned_bugs(None, person)
+        self.assertEqual([1, 2], [bug.id for bug in bugs])
+        [open_search, closed_search] = person.searches
+        self.assertEqual(OPEN_STATUSES, open_search["status"])
+        self.assertNotIn("modified_since", open_search)
+        self.assertEqual([FIX_RELEASED], closed_search["status"])
+        self.assertCutoff(now - timedelta(days=31),
+                          closed_search["modified_since"])
+
+    def test_get_person_directly_assigned_bugs_with_closed_within(self):
+        """
+        The number of days 'Fix Released' bug tasks are included for can be
+        specified.  Bug tasks modified recently but closed before the cutoff
+        are skipped.
+        """
+        now = datetime.now(UTC)
+        bug_task1 = create_bug_task(1, status=FIX_RELEASED)
+        bug_task1.date_closed = now - timedelta(days=2)
+        bug_task2 = create_bug_task(2, status=FIX_RELEASED)
+        bug_task2.date_closed = now - timedelta(days=10)
+        person = FakePerson("jkakar", [bug_task1, bug_task2])
+        bugs = get_person_directly_assigned_bugs(None, person,
+                                                 closed_within=7)
+        self.assertEqual([1], [bug.id for bug in bugs])
+        self.assertCutoff(now - timedelta(days=7),
+                          person.searches[1]["modified_since"])
+
+
+class SyncMilestoneBugsTest(TestCase):
+
+    def setUp(self):
+        super(SyncMilestoneBugsTest, self).setUp()
+        self.patch(sys, "stderr", StringIO())
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.store = SnapshotStore(os.path.join(directory, "snapshot.db"))
+        self.addCleanup(self.store.close)
+        self.milestone = FakeMilestone()
+        self.patch(launchpad, "get_milestone",
+                   lambda launchpad, project_name, milestone_name, store:
+                   self.milestone)
+        self.scope = get_milestone_scope("kanban", "1.0")
+
+    def sync(self, incremental=None):
+        """Sync the fake milestone and return the ids of its bugs."""
+        bugs = sync_milestone_bugs(None, self.store, "kanban", "1.0",
+                                   incremental=incremental)
+        return sorted(bug.id for bug in bugs)
+
+    def test_first_sync(self):
+        """
+        The first sync fetches every relevant bug task in the milestone and
+        stores them in the snapshot.
+        """
+        self.milestone.bug_tasks = [create_bug_task(1), create_bug_task(2)]
+        self.assertEqual([1, 2], self.sync(incremental=True))
+        [search] = self.milestone.searches
+        self.assertNotIn("modified_since", search)
+        self.assertEqual([1, 2], sorted(bug.id for bug in
+                                        self.store.get_bugs(self.scope)))
+        self.assertIsNot(None, self.store.get_last_sync(self.scope))
+
+    def test_full_sync_streams_bugs(self):
+        """
+        A full sync yields each L{Bug} as soon as it's hydrated.  The sync is
+        committed once every L{Bug} has been consumed.
+        """
+        self.milestone.bug_tasks = [create_bug_task(1), create_bug_task(2)]
+        bugs = sync_milestone_bugs(None, self.store, "kanban", "1.0")
+        self.assertEqual(1, next(bugs).id)
+        self.assertIs(None, self.store.get_last_sync(self.scope))
+        self.assertEqual([2], [bug.id for bug in bugs])
+        self.assertIsNot(None, self.store.get_last_sync(self.scope))
+
+    def test_incremental_sync(self):
+        """
+        An incremental sync only asks for bug tasks modified since the last
+        sync and updates the snapshot with them.
+        """
+        self.milestone.bug_tasks = [create_bug_task(1), create_bug_task(2)]
+        self.sync()
+        last_sync = self.store.get_last_sync(self.scope)
+        self.milestone.bug_tasks = [create_bug_task(2, title="Changed"),
+                                    create_bug_task(3)]
+        self.assertEqual([1, 2, 3], self.sync(incremental=True))
+        search = self.milestone.searches[-1]
+        self.assertEqual(last_sync.isoformat(), search["modified_since"])
+        titles = dict((bug.id, bug.title)
+                      for bug in self.store.get_bugs(self.scope))
+        self.assertEqual("Changed", titles[2])
+
+    def test_incremental_sync_removes_irrelevant_bugs(self):
+        """
+        Bug tasks that changed to a status that isn't shown on the board are
+        removed from the snapshot by an incremental sync.
+        """
+        self.milestone.bug_tasks = [create_bug_task(1), create_bug_task(2)]
+        self.sync()
+        self.milestone.bug_tasks = [create_bug_task(2, status=INVALID)]
+        self.assertEqual([1], self.sync(incremental=True))
+
+    def create_bug_task_with_merge_proposal(self):
+        """
+        Create a L{FakeBugTask} with a linked branch that has a merge
+        proposal, and return it with the merge proposal.
+        """
+        merge_proposal = FakeObject(date_created=datetime.now(UTC),
+                                    queue_status=NEEDS_REVIEW,
+                                    web_link="merge_url")
+        branch = FakeObject(bzr_identity="lp:~jkakar/kanban/branch",
+                            landing_targets=[merge_proposal])
+        bug_task = create_bug_task(
+            1, status=IN_PROGRESS,
+            linked_branches=[FakeObject(branch=branch,
+                                        branch_link="branch_link")])
+        return bug_task, merge_proposal
+
+    def test_full_sync_resolves_branches_again(self):
+        """
+        A full sync doesn't use branch details saved by earlier syncs, so it
+        sees merge proposals that changed without the bug changing, even
+        within L{BRANCH_CACHE_TTL}.
+        """
+        bug_task, merge_proposal = self.create_bug_task_with_merge_proposal()
+        self.milestone.bug_tasks = [bug_task]
+        self.sync()
+        merge_proposal.queue_status = APPROVED
+        [bug] = sync_milestone_bugs(None, self.store, "kanban", "1.0")
+        self.assertEqual(APPROVED, bug.merge_proposal_status)
+
+    def test_incremental_sync_uses_saved_branches(self):
+        """
+        An incremental sync uses the branch details saved by earlier syncs
+        for L{BRANCH_CACHE_TTL}.
+        """
+        bug_task, merge_proposal = self.create_bug_task_with_merge_proposal()
+        self.milestone.bug_tasks = [bug_task]
+        self.sync()
+        merge_proposal.queue_status = APPROVED
+        [bug] = sync_milestone_bugs(None, self.store, "kanban", "1.0",
+                                    incremental=True)
+        self.assertEqual(NEEDS_REVIEW, bug.merge_proposal_status)
+
+    def test_full_sync_replaces_snapshot(self):
+        """
+        A full sync replaces the bugs in the snapshot, so bugs that are no
+        longer in the milestone are removed.
+        """
+        self.milestone.bug_tasks = [create_bug_task(1), create_bug_task(2)]
+        self.sync()
+        self.milestone.bug_tasks = [create_bug_task(3)]
+        self.assertEqual([3], self.sync())
+        self.assertNotIn("modified_since", self.milestone.searches[-1])
+
+    def test_failed_sync_is_rolled_back(self):
+        """
+        If a sync fails the snapshot and the last sync time are left
+        unchanged.
+        """
+        self.milestone.bug_tasks = [create_bug_task(1)]
+        self.sync()
+        last_sync = self.store.get_last_sync(self.scope)
+        linked_branches = FakeLinkedBranches(500)
+        self.milestone.bug_tasks = [
+            create_bug_task(2, status=IN_PROGRESS,
+                            linked_branches=linked_branches)]
+        self.assertRaises(HTTPError, self.sync)
+        self.assertEqual([1], [bug.id for bug in
+                               self.store.get_bugs(self.scope)])
+        self.assertEqual(last_sync, self.store.get_last_sync(self.scope))
+
+    def test_sync_without_commit(self):
+        """
+        Changes made by a sync aren't committed if C{commit} is C{False}.
+        """
+        self.milestone.bug_tasks = [create_bug_task(1)]
+        bugs = sync_milestone_bugs(None, self.store, "kanban", "1.0",
+                                   commit=False)
+        self.assertEqual([1], [bug.id for bug in bugs])
+        self.store.rollback()
+        self.assertEqual([], self.store.get_bugs(self.scope))
+        self.assertIs(None, self.store.get_last_sync(self.scope))
+
+    def test_sharded_sync(self):
+        """
+        A sharded sync searches the milestone of each project in a project
+        group, asking for bug tasks in L{SHARD_ORDER}, and merges the
+        results into one stream in that order.
+        """
+        kanban = FakeMilestone([create_bug_task(1, importance=HIGH),
+                                create_bug_task(4)])
+        storm = FakeMilestone([create_bug_task(3, importance=CRITICAL),
+                               create_bug_task(2)])
+        self.patch(launchpad, "get_member_milestones",
+                   lambda launchpad, project_group_name, milestone_name,
+                   store: [kanban, storm])
+        bugs = sync_milestone_bugs(None, self.store, "group", "1.0",
+                                   shard=True)
+        self.assertEqual([3, 1, 2, 4], [bug.id for bug in bugs])
+        self.assertEqual([], self.milestone.searches)
+        self.assertEqual(SHARD_ORDER, kanban.searches[0]["order_by"])
+        self.assertEqual(SHARD_ORDER, storm.searches[0]["order_by"])
+        scope = get_milestone_scope("group", "1.0")
+        self.assertEqual([1, 2, 3, 4], sorted(bug.id for bug in
+                                              self.store.get_bugs(scope)))
+
+    def test_sharded_sync_with_unknown_importance(self):
+        """
+        Launchpad puts bug tasks with an Unknown importance first when it
+        sorts by L{SHARD_ORDER}, so shards are merged in that order.  The
+        board still shows them last.
+        """
+        kanban = FakeMilestone([create_bug_task(5, importance="Unknown"),
+                                create_bug_task(1, importance=CRITICAL),
+                                create_bug_task(4, importance=LOW)])
+        storm = FakeMilestone([create_bug_task(2, importance="Unknown"),
+                               create_bug_task(3, importance=HIGH)])
+        self.patch(launchpad, "get_member_milestones",
+                   lambda launchpad, project_group_name, milestone_name,
+                   store: [kanban, storm])
+        bugs = list(sync_milestone_bugs(None, self.store, "group", "1.0",
+                                        shard=True))
+        self.assertEqual([2, 5, 1, 3, 4], [bug.id for bug in bugs])
+        board = MilestoneBoard("group", "1.0")
+        for bug in bugs:
+            board.add(bug)
+        self.assertEqual([1, 3, 4, 2, 5], [bug.id for bug in board.bugs])
+
+    def test_sharded_sync_shares_one_pool(self):
+        """
+        A sharded sync uses a single thread pool for every shard, no bigger
+        than the number of requests the scheduler allows at once.
+        """
+        pools = []
+
+        def create_pool(processes):
+            pool = ThreadPool(processes)
+            pools.append((processes, pool))
+            return pool
+
+        self.patch(launchpad, "ThreadPool", create_pool)
+        shards = [FakeMilestone([create_bug_task(id)]) for id in range(1, 6)]
+        self.patch(launchpad, "get_member_milestones",
+                   lambda launchpad, project_group_name, milestone_name,
+                   store: shards)
+        bugs = sync_milestone_bugs(None, self.store, "group", "1.0", jobs=4,
+                                   shard=True)
+        self.assertEqual([1, 2, 3, 4, 5], [bug.id for bug in bugs])
+        self.assertEqual([MAX_CONCURRENCY],
+                         [processes for processes, pool in pools])
+
+    def test_sharded_sync_without_project_group(self):
+        """
+        A sharded sync searches the milestone itself if the project isn't a
+        project group.
+        """
+        self.milestone.bug_tasks = [create_bug_task(1)]
+        self.patch(launchpad, "get_member_milestones",
+                   lambda launchpad, project_group_name, milestone_name,
+                   store: None)
+        bugs = sync_milestone_bugs(None, self.store, "kanban", "1.0",
+                                   shard=True)
+        self.assertEqual([1], [bug.id for bug in bugs])
+        self.assertNotIn("order_by", self.milestone.searches[0])
+
+
+class MergeSortedTest(TestCase):
+
+    def test_merge_sorted(self):
+        """
+        L{_merge_sorted} merges sorted iterables into one sorted stream.
+        """
+        self.assertEqual(
+            [1, 2, 3, 4, 5],
+            list(_merge_sorted([[1, 4], [2, 3, 5], []], lambda item: item)))
+
+    def test_merge_sorted_with_equal_keys(self):
+        """
+        Items with equal keys are yielded in the order of the iterables
+        they came from.
+        """
+        items = _merge_sorted([["b1", "a1"], ["b2"], ["a2"]],
+                              lambda item: item[0])
+        self.assertEqual(["a2", "b1", "a1", "b2"], list(items))
+
+
+class SyncMilestonesBugsTest(TestCase):
+
+    def setUp(self):
+        super(SyncMilestonesBugsTest, self).setUp()
+        self.patch(sys, "stderr", StringIO())
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.path = os.path.join(directory, "snapshot.db")
+        self.store = SnapshotStore(self.path)
+        self.addCleanup(self.store.close)
+        self.milestones = {("kanban", "1.0"): FakeMilestone(),
+                           ("kanban", "1.1"): FakeMilestone(),
+                           ("storm", "0.19"): FakeMilestone()}
+        self.patch(launchpad, "get_milestone", self.get_milestone)
+
+    def get_milestone(self, launchpad, project_name, milestone_name, store):
+        """
+        Get a fake milestone.  Like L{get_milestone}, the store is committed
+        when a milestone is looked up.
+        """
+        store.commit()
+        return self.milestones[(project_name, milestone_name)]
+
+    def test_sync_milestones_bugs(self):
+        """
+        L{sync_milestones_bugs} syncs every milestone into its own scope and
+        yields the L{Bug}s of each one, interleaved so they're all fetched
+        together.
+        """
+        self.milestones[("kanban", "1.0")].bug_tasks = [
+            create_bug_task(1), create_bug_task(2)]
+        self.milestones[("storm", "0.19")].bug_tasks = [create_bug_task(3)]
+        bugs = sync_milestones_bugs(None, self.store, [("kanban", "1.0"),
+                                                       ("storm", "0.19")])
+        self.assertEqual([1, 3, 2], [bug.id for bug in bugs])
+        scope = get_milestone_scope("storm", "0.19")
+        self.assertEqual([3], [bug.id for bug in self.store.get_bugs(scope)])
+
+    def test_sync_milestones_bugs_yields_each_bug_once(self):
+        """
+        A L{Bug} targetted to several of the milestones is only yielded
+        once, but it's stored in the snapshot of each milestone.
+        """
+        self.milestones[("kanban", "1.0")].bug_tasks = [create_bug_task(1)]
+        self.milestones[("kanban", "1.1")].bug_tasks = [create_bug_task(1)]
+        bugs = sync_milestones_bugs(None, self.store, [("kanban", "1.0"),
+                                                       ("kanban", "1.1")])
+        self.assertEqual([1], [bug.id for bug in bugs])
+        scope = get_milestone_scope("kanban", "1.1")
+        self.assertEqual([1], [bug.id for bug in self.store.get_bugs(scope)])
+
+    def test_sync_milestones_bugs_commits_once(self):
+        """
+        Nothing is committed until every milestone has been synced, and then
+        the syncs are committed together.
+        """
+        self.milestones[("kanban", "1.0")].bug_tasks = [create_bug_task(1)]
+        self.milestones[("storm", "0.19")].bug_tasks = [create_bug_task(2)]
+        bugs = sync_milestones_bugs(None, self.store, [("kanban", "1.0"),
+                                                       ("storm", "0.19")])
+        store = SnapshotStore(self.path)
+        self.addCleanup(store.close)
+        self.assertEqual([1, 2], [bug.id for bug in bugs])
+        self.assertIsNot(
+            None, store.get_last_sync(get_milestone_scope("kanban", "1.0")))
+        self.assertIsNot(
+            None, store.get_last_sync(get_milestone_scope("storm", "0.19")))
+
+    def test_failed_sync_is_rolled_back(self):
+        """
+        If syncing any of the milestones fails, none of their snapshots are
+        changed.
+        """
+        self.milestones[("kanban", "1.0")].bug_tasks = [create_bug_task(1)]
+        self.milestones[("storm", "0.19")].bug_tasks = [
+            create_bug_task(2, status=IN_PROGRESS,
+                            linked_branches=FakeLinkedBranches(500))]
+        bugs = sync_milestones_bugs(None, self.store, [("kanban", "1.0"),
+                                                       ("storm", "0.19")])
+        self.assertRaises(HTTPError, list, bugs)
+        scope = get_milestone_scope("kanban", "1.0")
+        self.assertEqual([], self.store.get_bugs(scope))
+        self.assertIs(None, self.store.get_last_sync(scope))
+
+
+class SyncPersonBugsTest(TestCase):
+
+    def setUp(self):
+        super(SyncPersonBugsTest, self).setUp()
+        self.patch(sys, "stderr", StringIO())
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.store = SnapshotStore(os.path.join(directory, "snapshot.db"))
+        self.addCleanup(self.store.close)
+        self.scope = get_person_scope("jkakar")
+
+    def test_sync_person_bugs(self):
+        """
+        L{sync_person_bugs} replaces the bugs stored for a person with the
+        ones currently assigned to them.
+        """
+        person = FakePerson("jkakar", [create_bug_task(1)])
+        launchpad = FakeObject(people={"jkakar": person})
+        sync_person_bugs(launchpad, self.store, "jkakar")
+        person.bug_tasks = [create_bug_task(2), create_bug_task(3)]
+        bugs = sync_person_bugs(launchpad, self.store, "jkakar")
+        self.assertEqual([2, 3], sorted(bug.id for bug in bugs))
+        self.assertEqual([2, 3], sorted(bug.id for bug in
+                                        self.store.get_bugs(self.scope)))
+        self.assertIsNot(None, self.store.get_last_sync(self.scope))
+
+
+class HttpWrapperTest(TestCase):
+
+    def test_request(self):
+        """L{HttpWrapper.request} passes requests to the wrapped client."""
+        http = FakeHttp({"uri": ("response", "content")})
+        wrapper = HttpWrapper(http)
+        self.assertEqual(("response", "content"),
+                         wrapper.request("uri", headers={"a": "b"}))
+        self.assertEqual([("uri", "GET", None, {"a": "b"})], http.requests)
+
+    def test_attributes(self):
+        """
+        Attributes that aren't defined by an L{HttpWrapper} are looked up on
+        the wrapped client.
+        """
+        self.assertEqual("cache", HttpWrapper(FakeHttp()).cache)
+
+
+class PooledHttpTest(TestCase):
+
+    def test_request(self):
+        """
+        L{PooledHttp} creates a client the first time a thread makes a
+        request, and uses it for later requests from the same thread.
+        """
+        clients = []
+
+        def create_http():
+            clients.append(FakeHttp({"uri": ("response", "content")}))
+            return clients[-1]
+
+        http = PooledHttp(create_http)
+        self.assertEqual(("response", "content"), http.request("uri"))
+        self.assertEqual(("response", "content"), http.request("uri"))
+        self.assertEqual(1, len(clients))
+        self.assertEqual(2, len(clients[0].requests))
+
+    def test_request_from_several_threads(self):
+        """Each thread that uses a L{PooledHttp} gets its own client."""
+        clients = []
+        lock = Lock()
+
+        def create_http():
+            with lock:
+                clients.append(FakeHttp({"uri": ("response", "content")}))
+                return clients[-1]
+
+        def make_requests():
+            http.request("uri")
+            http.request("uri")
+
+        http = PooledHttp(create_http)
+        threads = [Thread(target=make_requests) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(clients))
+        self.assertEqual([2, 2, 2],
+                         [len(client.requests) for client in clients])
+
+    def test_attributes(self):
+        """Attributes are looked up on the current thread's client."""
+        http = PooledHttp(FakeHttp)
+        self.assertEqual("cache", http.cache)
+
+
+class KanbanLaunchpadTest(TestCase):
+
+    def test_http_factory(self):
+        """
+        L{KanbanLaunchpad.httpFactory} gives each thread that makes requests
+        its own launchpadlib client and representation cache, all keeping
+        their cache in the same directory.
+        """
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        requests = []
+        lock = Lock()
+
+        def request(http, uri, method="GET", body=None, headers=None,
+                    **kwargs):
+            with lock:
+                requests.append(http)
+            return Response({"status": "200"}), "{}"
+
+        self.patch(LaunchpadOAuthAwareHttp, "request", request)
+        # The Launchpad instance is only used to create HTTP clients, so it
+        # isn't initialized, which would contact Launchpad.
+        kanban_launchpad = KanbanLaunchpad.__new__(KanbanLaunchpad)
+        kanban_launchpad._wrappers = []
+        kanban_launchpad.authorization_engine = None
+        http = kanban_launchpad.httpFactory(
+            None, MultipleRepresentationCache(directory), None, None)
+        threads = [Thread(target=http.request, args=("uri",))
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        [client1, client2] = requests
+        self.assertIsNot(client1, client2)
+        self.assertIsNot(client1.cache, client2.cache)
+        self.assertIsInstance(client1.cache, MultipleRepresentationCache)
+        self.assertIsInstance(client2.cache, MultipleRepresentationCache)
+        self.assertEqual([directory, directory],
+                         [client1.cache._cache_dir, client2.cache._cache_dir])
+
+
+class GetCallSiteTest(TestCase):
+
+    def test_get_call_site(self):
+        """
+        L{get_call_site} determines the kind of request being made from its
+        URI.
+        """
+        root = "https://api.launchpad.net/1.0"
+        self.assertEqual("service", get_call_site(root + "/"))
+        self.assertEqual(
+            "search",
+            get_call_site(root + "/kanban/+milestone/1.0?ws.op=searchTasks"))
+        self.assertEqual("bug", get_call_site(root + "/bugs/1"))
+        self.assertEqual("bug",
+                         get_call_site(root + "/bugs/1/linked_branches"))
+        self.assertEqual("bug", get_call_site(root + "/kanban/+bug/1"))
+        self.assertEqual("person", get_call_site(root + "/~jkakar"))
+        self.assertEqual("person",
+                         get_call_site(root + "/~landscape/participants"))
+        self.assertEqual(
+            "person",
+            get_call_site(root + "/~landscape/participants?ws.start=75"))
+        self.assertEqual("branch",
+                         get_call_site(root + "/~jkakar/kanban/trunk"))
+        self.assertEqual(
+            "branch",
+            get_call_site(root + "/~jkakar/kanban/trunk/landing_targets"))
+        self.assertEqual(
+            "merge proposal",
+            get_call_site(root + "/~jkakar/kanban/trunk/+merge/1"))
+        self.assertEqual("milestone",
+                         get_call_site(root + "/kanban/+milestone/1.0"))
+        self.assertEqual("other", get_call_site(root + "/kanban"))
+
+
+class RequestStatsTest(TestCase):
+
+    def test_get_percentile(self):
+        """
+        L{get_percentile} returns the nearest-rank percentile from a sorted
+        list of values.
+        """
+        values = range(1, 11)
+        self.assertEqual(5, get_percentile(values, 50))
+        self.assertEqual(9, get_percentile(values, 90))
+        self.assertEqual(10, get_percentile(values, 99))
+        self.assertEqual(1, get_percentile([1], 50))
+
+    def test_get_summary_without_requests(self):
+        """
+        L{RequestStats.get_summary} returns zeroes when no requests have
+        been recorded.
+        """
+        summary = RequestStats().get_summary()
+        self.assertEqual({"requests": 0, "hits": 0, "misses": 0, "bytes": 0,
+                          "p50": 0.0, "p90": 0.0, "p99": 0.0}, summary)
+
+    def test_get_summary(self):
+        """
+        L{RequestStats.get_summary} summarizes the requests recorded for a
+        call site, or for all call sites.  Only responses that weren't
+        served from the cache count towards the bytes transferred.
+        """
+        stats = RequestStats()
+        stats.record("bug", 0.1, 100, False)
+        stats.record("bug", 0.3, 50, True)
+        stats.record("search", 0.2, 1000, False)
+        summary = stats.get_summary("bug")
+        self.assertEqual(2, summary["requests"])
+        self.assertEqual(1, summary["hits"])
+        self.assertEqual(1, summary["misses"])
+        self.assertEqual(100, summary["bytes"])
+        self.assertEqual(0.1, summary["p50"])
+        self.assertEqual(0.3, summary["p99"])
+        summary = stats.get_summary()
+        self.assertEqual(3, summary["requests"])
+        self.assertEqual(1100, summary["bytes"])
+        self.assertEqual(0.2, summary["p50"])
+
+    def test_format(self):
+        """
+        L{RequestStats.format} renders a table with a line for each call site
+        and a total.
+        """
+        stats = RequestStats()
+        stats.record("search", 0.2, 1000, False)
+        stats.record("bug", 0.1, 100, True)
+        lines = stats.format().splitlines()
+        self.assertEqual(4, len(lines))
+        self.assertEqual(["Call", "site", "Requests"], lines[0].split()[:3])
+        self.assertEqual(["bug", "1", "1", "0", "0", "100", "100", "100"],
+                         lines[1].split())
+        self.assertEqual(["search", "1", "0", "1", "1000"],
+                         lines[2].split()[:5])
+        self.assertEqual(["total", "2", "1", "1", "1000"],
+                         lines[3].split()[:5])
+
+
+class InstrumentedHttpTest(TestCase):
+
+    def test_request(self):
+        """
+        L{InstrumentedHttp} records each request it makes in a
+        L{RequestStats}.
+        """
+        uri = "https://api.launchpad.net/1.0/bugs/1"
+        response = FakeObject(status=200, fromcache=True)
+        stats = RequestStats()
+        http = InstrumentedHttp(FakeHttp({uri: (response, "content")}), stats)
+        self.assertEqual((response, "content"), http.request(uri))
+        summary = stats.get_summary("bug")
+        self.assertEqual(1, summary["requests"])
+        self.assertEqual(1, summary["hits"])
+        self.assertEqual(0, summary["bytes"])
+
+
+class HttpRecordingTest(TestCase):
+
+    def setUp(self):
+        super(HttpRecordingTest, self).setUp()
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.path = os.path.join(directory, "fixture.json")
+        self.uri = "https://api.launchpad.net/1.0/bugs/1"
+
+    def create_response(self, status=200):
+        return Response({"status": str(status),
+                         "content-type": "application/json"})
+
+    def test_get(self):
+        """
+        L{HttpRecording.get} returns the response recorded for a request.
+        """
+        recording = HttpRecording()
+        recording.add(self.uri, "GET", None, self.create_response(), "{}")
+        response, content = recording.get(self.uri, "GET", None)
+        self.assertEqual(200, response.status)
+        self.assertEqual("application/json", response["content-type"])
+        self.assertEqual("{}", content)
+
+    def test_get_without_matching_request(self):
+        """
+        L{HttpRecording.get} raises C{RuntimeError} if a matching request
+        wasn't recorded.
+        """
+        recording = HttpRecording()
+        recording.add(self.uri, "GET", None, self.create_response(), "{}")
+        self.assertRaises(RuntimeError, recording.get, self.uri, "POST", "")
+        self.assertRaises(RuntimeError, recording.get, self.uri + "/x", "GET",
+                          None)
+
+    def test_get_with_repeated_requests(self):
+        """
+        Identical requests are answered in the order they were recorded, and
+        the last response is repeated once they run out.
+        """
+        recording = HttpRecording()
+        recording.add(self.uri, "GET", None, self.create_response(), "1")
+        recording.add(self.uri, "GET", None, self.create_response(), "2")
+        self.assertEqual(
+            ["1", "2", "2"],
+            [recording.get(self.uri, "GET", None)[1] for i in range(3)])
+
+    def test_save_and_load(self):
+        """
+        L{HttpRecording.save} writes exchanges to a fixture file that can be
+        read with L{HttpRecording.load}.
+        """
+        recording = HttpRecording()
+        recording.add(self.uri, "GET", None, self.create_response(404),
+                      "Not found")
+        recording.add(self.uri, "GET", None, self.create_response(),
+                      u"\N{SNOWMAN}".encode("utf-8"))
+        recording.add(self.uri, "GET", None, self.create_response(),
+                      "\xff\x00")
+        recording.save(self.path)
+        recording = HttpRecording.load(self.path)
+        response, content = recording.get(self.uri, "GET", None)
+        self.assertEqual(404, response.status)
+        self.assertEqual("Not found", content)
+        self.assertEqual(u"\N{SNOWMAN}".encode("utf-8"),
+                         recording.get(self.uri, "GET", None)[1])
+        self.assertEqual("\xff\x00",
+                         recording.get(self.uri, "GET", None)[1])
+
+
+class RecordingHttpTest(TestCase):
+
+    def test_request(self):
+        """L{RecordingHttp} adds each exchange to an L{HttpRecording}."""
+        uri = "https://api.launchpad.net/1.0/bugs/1"
+        recording = HttpRecording()
+        http = FakeHttp({uri: (Response({"status": "200"}), "content")})
+        response, content = RecordingHttp(http, recording).request(uri)
+        self.assertEqual("content", content)
+        [exchange] = recording.exchanges
+        self.assertEqual(uri, exchange["uri"])
+        self.assertEqual("GET", exchange["method"])
+        self.assertEqual(200, exchange["status"])
+
+
+class ReplayingHttpTest(TestCase):
+
+    def test_request(self):
+        """
+        L{ReplayingHttp} answers requests from an L{HttpRecording} without
+        using the wrapped client.
+        """
+        uri = "https://api.launchpad.net/1.0/bugs/1"
+        recording = HttpRecording()
+        recording.add(uri, "GET", None, Response({"status": "200"}),
+                      "content")
+        http = FakeHttp()
+        response, content = ReplayingHttp(http, recording).request(
+            uri, headers={"Authorization": "OAuth"})
+        self.assertEqual(200, response.status)
+        self.assertEqual("content", content)
+        self.assertEqual([], http.requests)
+
+    def test_request_with_latency(self):
+        """L{ReplayingHttp} waits before answering if latency is injected."""
+        uri = "https://api.launchpad.net/1.0/bugs/1"
+        recording = HttpRecording()
+        recording.add(uri, "GET", None, Response({"status": "200"}),
+                      "content")
+        http = ReplayingHttp(FakeHttp(), recording, latency=0.05)
+        start = time()
+        http.request(uri)
+        self.assertTrue(time() - start >= 0.05)
+
+
+class ServiceRootCacheTest(TestCase):
+
+    def setUp(self):
+        super(ServiceRootCacheTest, self).setUp()
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.path = os.path.join(directory, "service-root")
+        self.uri = "https://api.launchpad.net/1.0/"
+        self.headers = {"Accept": "application/vnd.sun.wadl+xml"}
+        self.response = Response({"status": "200",
+                                  "content-type": "application/xml"})
+        self.http = FakeHttp({self.uri: (self.response, "<wadl/>")})
+
+    def test_request(self):
+        """
+        The service root description is fetched from Launchpad the first
+        time it's requested, and served from disk after that.
+        """
+        http = ServiceRootCache(self.http, self.path)
+        self.assertEqual((self.response, "<wadl/>"),
+                         http.request(self.uri, headers=self.headers))
+        response, content = http.request(self.uri, headers=self.headers)
+        self.assertEqual(200, response.status)
+        self.assertEqual("application/xml", response["content-type"])
+        self.assertTrue(response.fromcache)
+        self.assertEqual("<wadl/>", content)
+        self.assertEqual(1, len(self.http.requests))
+
+    def test_request_with_different_media_types(self):
+        """
+        Descriptions with different media types are kept separately.
+        """
+        http = ServiceRootCache(self.http, self.path)
+        http.request(self.uri, headers=self.headers)
+        http.request(self.uri, headers={"Accept": "application/json"})
+        self.assertEqual(2, len(self.http.requests))
+
+    def test_request_with_expired_description(self):
+        """
+        Descriptions older than the TTL are fetched from Launchpad again.
+        """
+        http = ServiceRootCache(self.http, self.path, ttl=timedelta(0))
+        http.request(self.uri, headers=self.headers)
+        http.request(self.uri, headers=self.headers)
+        self.assertEqual(2, len(self.http.requests))
+
+    def test_request_with_error(self):
+        """Error responses aren't kept."""
+        self.response.status = 500
+        http = ServiceRootCache(self.http, self.path)
+        http.request(self.uri, headers=self.headers)
+        http.request(self.uri, headers=self.headers)
+        self.assertEqual(2, len(self.http.requests))
+
+    def test_request_with_damaged_description(self):
+        """
+        A description whose files can't be read, like one a process was
+        killed while writing, is fetched from Launchpad again and replaced.
+        """
+        http = ServiceRootCache(self.http, self.path)
+        http.request(self.uri, headers=self.headers)
+        [name] = [name for name in os.listdir(self.path)
+                  if name.endswith(".json")]
+        with open(os.path.join(self.path, name), "w") as stream:
+            stream.write('{"status": "2')
+        response, content = http.request(self.uri, headers=self.headers)
+        self.assertFalse(response.fromcache)
+        self.assertEqual("<wadl/>", content)
+        response, content = http.request(self.uri, headers=self.headers)
+        self.assertTrue(response.fromcache)
+        self.assertEqual(2, len(self.http.requests))
+
+    def test_request_replaces_files(self):
+        """
+        Descriptions are written to temporary files that are renamed into
+        place, so a reader never sees a partly written file, and no
+        temporary files are left behind.
+        """
+        renames = []
+        rename = os.rename
+
+        def recording_rename(source, destination):
+            with open(source, "rb") as stream:
+                renames.append((os.path.basename(destination), stream.read()))
+            rename(source, destination)
+
+        self.patch(os, "rename", recording_rename)
+        http = ServiceRootCache(self.http, self.path)
+        http.request(self.uri, headers=self.headers)
+        self.assertEqual([".body", ".json"],
+                         [os.path.splitext(name)[1] for name, data in renames])
+        self.assertEqual("<wadl/>", renames[0][1])
+        self.assertEqual(sorted(name for name, data in renames),
+                         sorted(os.listdir(self.path)))
+
+    def test_request_other_resources(self):
+        """Requests for other resources are always passed through."""
+        uri = "https://api.launchpad.net/1.0/bugs/1"
+        self.http.responses[uri] = (self.response, "{}")
+        http = ServiceRootCache(self.http, self.path)
+        http.request(uri)
+        http.request(uri)
+        self.assertEqual(2, len(self.http.requests))
+
+
+class SequenceHttp(FakeHttp):
+    """A fake C{httplib2.Http} that returns a sequence of responses."""
+
+    def __init__(self, responses):
+        super(SequenceHttp, self).__init__()
+        self.sequence = list(responses)
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.requests.append((uri, method, body, headers))
+        return self.sequence.pop(0)
+
+
+class RequestSchedulerTest(TestCase):
+
+    def test_acquire(self):
+        """
+        L{RequestScheduler.acquire} takes a token and counts the request as
+        active until it's released.
+        """
+        scheduler = RequestScheduler(rate=100, burst=2, concurrency=2)
+        scheduler.acquire()
+        scheduler.acquire()
+        self.assertEqual(2, scheduler.active)
+        scheduler.release(0.1)
+        self.assertEqual(1, scheduler.active)
+
+    def test_acquire_waits_for_tokens(self):
+        """
+        Requests are limited to the scheduler's rate once the burst has been
+        used up.
+        """
+        scheduler = RequestScheduler(rate=50, burst=1, concurrency=10)
+        start = time()
+        for i in range(4):
+            scheduler.acquire()
+        self.assertTrue(time() - start >= 0.05)
+
+    def test_acquire_waits_for_concurrency(self):
+        """
+        A request waits while the concurrency limit's worth of requests are
+        in flight.
+        """
+        scheduler = RequestScheduler(rate=1000, burst=10, concurrency=1)
+        scheduler.acquire()
+        acquired = []
+
+        def acquire():
+            scheduler.acquire()
+            acquired.append(True)
+
+        thread = Thread(target=acquire)
+        thread.start()
+        sleep(0.05)
+        self.assertEqual([], acquired)
+        scheduler.release(0.1)
+        thread.join()
+        self.assertEqual([True], acquired)
+
+    def test_release_throttled(self):
+        """The concurrency limit is halved when a request is throttled."""
+        scheduler = RequestScheduler(concurrency=8)
+        scheduler.acquire()
+        scheduler.release(0.1, throttled=True)
+        self.assertEqual(4, scheduler.concurrency)
+        for i in range(3):
+            scheduler.acquire()
+            scheduler.release(0.1, throttled=True)
+        self.assertEqual(1, scheduler.concurrency)
+
+    def test_release_healthy(self):
+        """
+        The concurrency limit is increased by one after a limit's worth of
+        requests complete quickly, up to the maximum.
+        """
+        scheduler = RequestScheduler(rate=1000, burst=100, concurrency=2,
+                                     max_concurrency=3)
+        for i in range(2):
+            scheduler.acquire()
+            scheduler.release(0.1)
+        self.assertEqual(3, scheduler.concurrency)
+        for i in range(6):
+            scheduler.acquire()
+            scheduler.release(0.1)
+        self.assertEqual(3, scheduler.concurrency)
+
+    def test_release_slow(self):
+        """The concurrency limit isn't increased by slow requests."""
+        scheduler = RequestScheduler(rate=1000, burst=100, concurrency=2)
+        for i in range(4):
+            scheduler.acquire()
+            scheduler.release(HEALTHY_LATENCY + 1)
+        self.assertEqual(2, scheduler.concurrency)
+
+
+class ScheduledHttpTest(TestCase):
+
+    def setUp(self):
+        super(ScheduledHttpTest, self).setUp()
+        self.stderr = StringIO()
+        self.patch(sys, "stderr", self.stderr)
+        self.scheduler = RequestScheduler(rate=1000, burst=100)
+        self.ok = Response({"status": "200"})
+        self.busy = Response({"status": "503"})
+
+    def test_request(self):
+        """L{ScheduledHttp} makes requests with the wrapped client."""
+        http = SequenceHttp([(self.ok, "content")])
+        scheduled_http = ScheduledHttp(http, self.scheduler)
+        self.assertEqual((self.ok, "content"), scheduled_http.request("uri"))
+        self.assertEqual(0, self.scheduler.active)
+
+    def test_request_retries_throttled_get(self):
+        """
+        A throttled GET is retried, and the scheduler's concurrency limit is
+        reduced.
+        """
+        throttled = Response({"status": "429", "retry-after": "0"})
+        http = SequenceHttp([(self.busy, ""), (throttled, ""),
+                             (self.ok, "content")])
+        scheduled_http = ScheduledHttp(http, self.scheduler, backoff=0)
+        self.assertEqual((self.ok, "content"), scheduled_http.request("uri"))
+        self.assertEqual(3, len(http.requests))
+        # The limit was halved twice, then raised by the successful retry.
+        self.assertEqual(2, self.scheduler.concurrency)
+        self.assertEqual(2, len(self.stderr.getvalue().splitlines()))
+
+    def test_request_gives_up(self):
+        """
+        The throttled response is returned after L{MAX_RETRIES} retries.
+        """
+        http = SequenceHttp([(self.busy, "")] * (MAX_RETRIES + 1))
+        scheduled_http = ScheduledHttp(http, self.scheduler, backoff=0)
+        self.assertEqual((self.busy, ""), scheduled_http.request("uri"))
+        self.assertEqual(MAX_RETRIES + 1, len(http.requests))
+
+    def test_request_does_not_retry_post(self):
+        """Requests other than GETs aren't retried."""
+        http = SequenceHttp([(self.busy, ""), (self.ok, "content")])
+        scheduled_http = ScheduledHttp(http, self.scheduler, backoff=0)
+        self.assertEqual((self.busy, ""),
+                         scheduled_http.request("uri", method="POST"))
+        self.assertEqual(1, len(http.requests))
+
+    def test_request_releases_on_error(self):
+        """The scheduler is released if the request raises an error."""
+        http = SequenceHttp([])
+        scheduled_http = ScheduledHttp(http, self.scheduler)
+        self.assertRaises(IndexError, scheduled_http.request, "uri")
+        self.assertEqual(0, self.scheduler.active)
+
+
+class FakeBrowser(object):
+    """A fake lazr browser that returns pages of a collection."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.links = []
+
+    def get(self, link):
+        self.links.append(link)
+        query = dict(parse_qsl(urlparse(link).query))
+        start = int(query["ws.start"])
+        size = int(query["ws.size"])
+        return json.dumps({"entries": self.entries[start:start + size]})
+
+
+class FakeCollection(Collection):
+    """A fake lazr collection with a first page of entries."""
+
+    def __init__(self, entries, first_page_size, total_size=True):
+        representation = {"entries": entries[:first_page_size]}
+        if first_page_size < len(entries):
+            representation["next_collection_link"] = (
+                "https://api.launchpad.net/1.0/kanban/+milestone/1.0"
+                "?ws.op=searchTasks&memo=%d&ws.start=%d&ws.size=%d"
+                % (first_page_size, first_page_size, first_page_size))
+        self.__dict__.update(
+            _wadl_resource=FakeObject(representation=representation),
+            _root=FakeObject(_browser=FakeBrowser(entries)),
+            entries=entries, has_total_size=total_size)
+
+    def _ensure_representation(self):
+        pass
+
+    def _convert_dicts_to_entries(self, entries):
+        return iter(entries)
+
+    def __len__(self):
+        if not self.has_total_size:
+            raise TypeError("collection size is not available")
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+class IterCollectionTest(TestCase):
+
+    def test_get_page_links(self):
+        """
+        L{get_page_links} returns links to pages of a collection, starting
+        at an offset and ending at the end of the collection.
+        """
+        link = ("https://api.launchpad.net/1.0/kanban?ws.op=searchTasks"
+                "&memo=75&ws.start=75")
+        links = get_page_links(link, 75, 200, 50)
+        self.assertEqual(3, len(links))
+        queries = [parse_qsl(urlparse(link).query) for link in links]
+        self.assertEqual(
+            [[("ws.op", "searchTasks"), ("ws.start", "75"), ("ws.size", "50")],
+             [("ws.op", "searchTasks"), ("ws.start", "125"),
+              ("ws.size", "50")],
+             [("ws.op", "searchTasks"), ("ws.start", "175"),
+              ("ws.size", "50")]],
+            queries)
+        self.assertTrue(links[0].startswith(
+            "https://api.launchpad.net/1.0/kanban?"))
+
+    def test_iter_collection(self):
+        """
+        L{iter_collection} yields every entry in a collection, in order,
+        fetching the pages after the first concurrently.
+        """
+        collection = FakeCollection(range(100), 10)
+        self.assertEqual(range(100),
+                         list(iter_collection(collection, jobs=4,
+                                              batch_size=20)))
+        links = collection._root._browser.links
+        self.assertEqual(5, len(links))
+
+    def test_iter_collection_with_one_page(self):
+        """Collections with a single page are iterated as usual."""
+        collection = FakeCollection(range(10), 10)
+        self.assertEqual(range(10), list(iter_collection(collection)))
+        self.assertEqual([], collection._root._browser.links)
+
+    def test_iter_collection_without_total_size(self):
+        """Collections that don't know their size are iterated as usual."""
+        collection = FakeCollection(range(100), 10, total_size=False)
+        self.assertEqual(range(100), list(iter_collection(collection)))
+        self.assertEqual([], collection._root._browser.links)
+
+    def test_iter_collection_with_iterable(self):
+        """Iterables that aren't collections are iterated as usual."""
+        self.assertEqual([1, 2, 3], list(iter_collection([1, 2, 3])))
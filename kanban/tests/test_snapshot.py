@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta, tzinfo
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from testtools import TestCase
+
+from kanban.board import Bug, MEDIUM, IN_PROGRESS, NEEDS_REVIEW
+from kanban.snapshot import (
+    SnapshotStore, UTC, dump_date, load_date, get_milestone_scope)
+
+
+class FixedOffset(tzinfo):
+    """A timezone with a fixed offset from UTC, in hours."""
+
+    def __init__(self, hours):
+        self.offset = timedelta(hours=hours)
+
+    def utcoffset(self, date):
+        return self.offset
+
+    def dst(self, date):
+        return timedelta(0)
+
+
+class DateTest(TestCase):
+
+    def test_dump_date(self):
+        """
+        L{dump_date} converts a timezone-aware C{datetime} to UTC and
+        formats it as a string.
+        """
+        date = datetime(2012, 6, 1, 14, 30, 0, 0, FixedOffset(2))
+        self.assertEqual("2012-06-01T12:30:00.000000", dump_date(date))
+
+    def test_dump_date_without_date(self):
+        """L{dump_date} returns C{None} if C{None} is provided."""
+        self.assertIs(None, dump_date(None))
+
+    def test_load_date(self):
+        """
+        L{load_date} converts a string created by L{dump_date} back into a
+        UTC C{datetime}.
+        """
+        date = load_date("2012-06-01T12:30:00.000000")
+        self.assertEqual(datetime(2012, 6, 1, 12, 30, 0, 0, UTC), date)
+        self.assertIs(UTC, date.tzinfo)
+
+    def test_load_date_without_value(self):
+        """L{load_date} returns C{None} if C{None} is provided."""
+        self.assertIs(None, load_date(None))
+
+
+class SnapshotStoreTest(TestCase):
+
+    def setUp(self):
+        super(SnapshotStoreTest, self).setUp()
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.path = os.path.join(directory, "snapshot.db")
+        self.store = SnapshotStore(self.path)
+        self.addCleanup(self.store.close)
+        self.scope = get_milestone_scope("kanban", "1.0")
+
+    def test_get_milestone_scope(self):
+        """
+        L{get_milestone_scope} returns a name based on the project and
+        milestone names.
+        """
+        self.assertEqual("milestone:kanban/1.0", self.scope)
+
+    def test_get_bugs_without_bugs(self):
+        """
+        L{SnapshotStore.get_bugs} returns an empty C{list} for a scope that
+        doesn't have any bugs.
+        """
+        self.assertEqual([], self.store.get_bugs(self.scope))
+
+    def test_put_bug(self):
+        """
+        L{SnapshotStore.put_bug} stores a L{Bug} which can be loaded again
+        with L{SnapshotStore.get_bugs}.
+        """
+        now = datetime.now(UTC)
+        bug = Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"A title", "jkakar",
+                  now, "lp:~jkakar/kanban/branch", "merge_url", NEEDS_REVIEW,
+                  now, ["story-test", "verified"])
+        self.store.put_bug(self.scope, "task_link", bug)
+        [loaded_bug] = self.store.get_bugs(self.scope)
+        self.assertEqual(1, loaded_bug.id)
+        self.assertEqual("kanban", loaded_bug.project)
+        self.assertEqual(MEDIUM, loaded_bug.importance)
+        self.assertEqual(IN_PROGRESS, loaded_bug.status)
+        self.assertEqual(u"A title", loaded_bug.title)
+        self.assertEqual("jkakar", loaded_bug.assignee)
+        self.assertEqual(now, loaded_bug.in_progress_date)
+        self.assertEqual("lp:~jkakar/kanban/branch", loaded_bug.branch)
+        self.assertEqual("merge_url", loaded_bug.merge_proposal)
+        self.assertEqual(NEEDS_REVIEW, loaded_bug.merge_proposal_status)
+        self.assertEqual(now, loaded_bug.merge_proposal_creation_date)
+        self.assertEqual(("story-test", "verified"), loaded_bug.tags)
+
+    def test_put_bug_with_default_values(self):
+        """
+        Optional L{Bug} values that aren't set are loaded with their default
+        values.
+        """
+        bug = Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"A title")
+        self.store.put_bug(self.scope, "task_link", bug)
+        [loaded_bug] = self.store.get_bugs(self.scope)
+        self.assertIs(None, loaded_bug.assignee)
+        self.assertIs(None, loaded_bug.in_progress_date)
+        self.assertIs(None, loaded_bug.branch)
+        self.assertIs(None, loaded_bug.merge_proposal)
+        self.assertIs(None, loaded_bug.merge_proposal_status)
+        self.assertIs(None, loaded_bug.merge_proposal_creation_date)
+        self.assertEqual((), loaded_bug.tags)
+
+    def test_put_bug_replaces_existing_bug(self):
+        """
+        Putting a L{Bug} with the same key as an existing one replaces it.
+        """
+        self.store.put_bug(self.scope, "task_link",
+                           Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"Old"))
+        self.store.put_bug(self.scope, "task_link",
+                           Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"New"))
+        bugs = self.store.get_bugs(self.scope)
+        self.assertEqual([u"New"], [bug.title for bug in bugs])
+
+    def test_scopes_are_isolated(self):
+        """L{Bug}s are only returned for the scope they were stored in."""
+        self.store.put_bug(self.scope, "task_link",
+                           Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"A title"))
+        self.assertEqual([], self.store.get_bugs("other"))
+
+    def test_remove_bug(self):
+        """L{SnapshotStore.remove_bug} removes the bug stored for a key."""
+        self.store.put_bug(self.scope, "task_link1",
+                           Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"A title"))
+        self.store.put_bug(self.scope, "task_link2",
+                           Bug(2, "kanban", MEDIUM, IN_PROGRESS, u"A title"))
+        self.store.remove_bug(self.scope, "task_link1")
+        self.assertEqual([2],
+                         [bug.id for bug in self.store.get_bugs(self.scope)])
+
+    def test_clear(self):
+        """L{SnapshotStore.clear} removes all bugs in a scope."""
+        self.store.put_bug(self.scope, "task_link",
+                           Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"A title"))
+        self.store.put_bug("other", "task_link",
+                           Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"A title"))
+        self.store.clear(self.scope)
+        self.assertEqual([], self.store.get_bugs(self.scope))
+        self.assertEqual(1, len(self.store.get_bugs("other")))
+
+    def test_get_last_sync_without_sync(self):
+        """
+        L{SnapshotStore.get_last_sync} returns C{None} if a scope has never
+        been synced.
+        """
+        self.assertIs(None, self.store.get_last_sync(self.scope))
+
+    def test_set_last_sync(self):
+        """
+        L{SnapshotStore.set_last_sync} records the time a scope was last
+        synced.
+        """
+        now = datetime.now(UTC)
+        self.store.set_last_sync(self.scope, now)
+        self.assertEqual(now, self.store.get_last_sync(self.scope))
+
+    def test_commit(self):
+        """Committed changes are visible to other stores."""
+        self.store.put_bug(self.scope, "task_link",
+                           Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"A title"))
+        self.store.commit()
+        store = SnapshotStore(self.path)
+        self.addCleanup(store.close)
+        self.assertEqual(1, len(store.get_bugs(self.scope)))
+
+    def test_rollback(self):
+        """L{SnapshotStore.rollback} discards uncommitted changes."""
+        self.store.put_bug(self.scope, "task_link",
+                           Bug(1, "kanban", MEDIUM, IN_PROGRESS, u"A title"))
+        self.store.rollback()
+        self.assertEqual([], self.store.get_bugs(self.scope))
+
+    def test_get_resource_without_resource(self):
+        """
+        L{SnapshotStore.get_resource} returns C{None} if links haven't been
+        stored for a resource.
+        """
+        self.assertIs(None, self.store.get_resource("name"))
+
+    def test_put_resource(self):
+        """
+        L{SnapshotStore.put_resource} stores the links for a resource, which
+        can be loaded again with L{SnapshotStore.get_resource}.
+        """
+        self.store.put_resource("name", "link", "type_link",
+                                datetime.now(UTC))
+        self.assertEqual(("link", "type_link"),
+                         self.store.get_resource("name"))
+
+    def test_get_resource_with_max_age(self):
+        """
+        Links stored longer ago than the maximum age passed to
+        L{SnapshotStore.get_resource} are ignored.
+        """
+        now = datetime.now(UTC)
+        self.store.put_resource("old", "link", "type_link",
+                                now - timedelta(hours=2))
+        self.store.put_resource("new", "link", "type_link", now)
+        self.assertIs(None,
+                      self.store.get_resource("old", timedelta(hours=1)))
+        self.assertEqual(("link", "type_link"),
+                         self.store.get_resource("new", timedelta(hours=1)))
+
+    def test_get_branches_without_branches(self):
+        """
+        L{SnapshotStore.get_branches} returns an empty C{dict} if no branch
+        details have been stored.
+        """
+        self.assertEqual({}, self.store.get_branches())
+
+    def test_put_branch(self):
+        """
+        L{SnapshotStore.put_branch} stores the details for a branch, which
+        can be loaded again with L{SnapshotStore.get_branches}.
+        """
+        now = datetime.now(UTC)
+        details = ("lp:~jkakar/kanban/branch", "merge_url", NEEDS_REVIEW, now)
+        self.store.put_branch("branch_link", details, now)
+        self.store.put_branch("other_link", ("lp:kanban", None, None, None),
+                              now)
+        self.assertEqual({"branch_link": details,
+                          "other_link": ("lp:kanban", None, None, None)},
+                         self.store.get_branches())
+
+    def test_get_branches_with_max_age(self):
+        """
+        Branch details stored longer ago than the maximum age passed to
+        L{SnapshotStore.get_branches} are ignored and deleted.
+        """
+        now = datetime.now(UTC)
+        details = ("lp:kanban", None, None, None)
+        self.store.put_branch("old", details, now - timedelta(hours=2))
+        self.store.put_branch("new", details, now)
+        self.assertEqual({"new": details},
+                         self.store.get_branches(timedelta(hours=1)))
+        self.assertEqual({"new": details}, self.store.get_branches())